@@ -0,0 +1,379 @@
+"""
+SFU CMPT 756
+Open-loop load generator and benchmark for the user, music and
+playlist services.
+
+The scenarios mirror those of the Gatling simulations
+(`gatling/simulations/proj756/ReadTables.scala`) and draw their
+ids from the same feeder files (`gatling/resources/*.csv`).  Each
+scenario runs at a fixed mean rate: requests are sent at Poisson
+arrival times whether or not earlier requests have completed, so
+a slow service does not slow the load down.  Latency is measured
+from each request's scheduled time, so time spent waiting for a
+free connection counts against the service.
+
+The results, one entry per scenario, are written as JSON.
+"""
+
+# Standard library modules
+import argparse
+import asyncio
+import base64
+import csv
+import importlib.util
+import itertools
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+
+# Installed packages
+import aiohttp
+
+import simplejson as json
+
+# The services check only that we pass an authorization,
+# not whether it's valid
+DEFAULT_AUTH = 'Bearer A'
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RESOURCES = os.path.join(REPO, 'gatling', 'resources')
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+def read_feeder(resources, name):
+    with open(os.path.join(resources, name), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+class Feeders():
+    """The Gatling feeders: music is drawn at random, users and
+    playlists in order, as in the simulations."""
+
+    def __init__(self, resources):
+        self.music = read_feeder(resources, 'music.csv')
+        self.users = itertools.cycle(read_feeder(resources, 'users.csv'))
+        self.playlists = itertools.cycle(
+            read_feeder(resources, 'playlist.csv'))
+
+    def song(self):
+        return random.choice(self.music)
+
+
+# Each scenario returns the (service, method, path, body) of its
+# next request.  Paths are relative to the service's prefix.
+
+def rmusic(feeders):
+    return 'music', 'GET', feeders.song()['music_id'], None
+
+
+def ruser(feeders):
+    return 'user', 'GET', next(feeders.users)['user_id'], None
+
+
+def rplaylist(feeders):
+    return 'playlist', 'GET', next(feeders.playlists)['playlist_id'], None
+
+
+def create_user(feeders):
+    return 'user', 'POST', '', {"lname": "Mathur",
+                                "email": "am@gmail.com",
+                                "fname": "Anisha",
+                                "playlist": []}
+
+
+def create_song(feeders):
+    return 'music', 'POST', '', {"Artist": "Stephanie Beatriz",
+                                 "SongTitle": "We don't talk about Bruno"}
+
+
+def create_playlist(feeders):
+    return 'playlist', 'POST', '', {
+        "title": next(feeders.playlists)['title'],
+        "user_id": next(feeders.users)['user_id']}
+
+
+def add_song(feeders):
+    return 'playlist', 'PUT', next(feeders.playlists)['playlist_id'], {
+        "music_id": feeders.song()['music_id']}
+
+
+SCENARIOS = {
+    'rmusic': rmusic,
+    'ruser': ruser,
+    'rplaylist': rplaylist,
+    'create_user': create_user,
+    'create_song': create_song,
+    'create_playlist': create_playlist,
+    'add_song': add_song,
+}
+
+PREFIXES = {
+    'user': 'api/v1/user/',
+    'music': 'api/v1/music/',
+    'playlist': 'api/v1/playlist/',
+}
+
+
+class Results():
+    """Outcomes of the requests of one scenario."""
+
+    def __init__(self):
+        self.latencies = []
+        self.status = {}
+        self.errors = 0
+        self.dropped = 0
+
+    def record(self, status, seconds):
+        self.status[status] = self.status.get(status, 0) + 1
+        if status == 'error' or int(status) >= 400:
+            self.errors += 1
+        else:
+            self.latencies.append(seconds)
+
+    def summary(self, duration):
+        sent = sum(self.status.values())
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            # Nearest rank
+            rank = max(1, math.ceil(p / 100 * len(latencies)))
+            return round(1000 * latencies[rank - 1], 3)
+
+        return {
+            "requests": sent,
+            "errors": self.errors,
+            "error_rate": self.errors / sent if sent else 0.0,
+            "dropped": self.dropped,
+            "throughput_rps": (sent - self.errors) / duration,
+            "latency_ms": dict(
+                [("p{:g}".format(p), percentile(p)) for p in PERCENTILES] +
+                [("mean", round(1000 * sum(latencies) / len(latencies), 3)
+                  if latencies else None),
+                 ("max", round(1000 * latencies[-1], 3)
+                  if latencies else None)]),
+            "status": {str(k): v for k, v in sorted(self.status.items(),
+                                                    key=str)},
+        }
+
+
+async def send(session, urls, auth, request, scheduled, results):
+    service, method, path, body = request
+    try:
+        async with session.request(method,
+                                   urls[service] + PREFIXES[service] + path,
+                                   json=body,
+                                   headers={'Authorization': auth}) as r:
+            await r.read()
+            status = r.status
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        status = 'error'
+    results.record(status, time.perf_counter() - scheduled)
+
+
+async def run_scenario(session, urls, auth, scenario, rate, duration,
+                       max_in_flight, feeders, results):
+    """Send `scenario` requests at Poisson arrival times averaging
+    `rate` per second for `duration` seconds."""
+    in_flight = set()
+    start = time.perf_counter()
+    scheduled = start
+    while True:
+        scheduled += random.expovariate(rate)
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(in_flight) >= max_in_flight:
+            results.dropped += 1
+            continue
+        task = asyncio.ensure_future(
+            send(session, urls, auth, SCENARIOS[scenario](feeders),
+                 scheduled, results))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.wait(in_flight)
+
+
+async def run(urls, args, feeders):
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    results = {scenario: Results() for scenario, _ in args.scenario}
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            run_scenario(session, urls, args.auth, scenario, rate,
+                         args.duration, args.max_in_flight, feeders,
+                         results[scenario])
+            for scenario, rate in args.scenario])
+        elapsed = time.perf_counter() - start
+    return {scenario: r.summary(elapsed) for scenario, r in results.items()}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_healthy(url, deadline=30):
+    end = time.time() + deadline
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except OSError:
+            if time.time() > end:
+                raise
+            time.sleep(0.1)
+
+
+def seed(db_url, resources, token):
+    """Load the feeder files into the database service, building
+    the objects as the loader's batch mode does."""
+    # Only `--local` runs need the loader (and its requirements)
+    spec = importlib.util.spec_from_file_location(
+        'loader', os.path.join(REPO, 'loader', 'app.py'))
+    loader = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loader)
+    objects = []
+    for name, to_object in (('users.csv', loader.user_object),
+                            ('music.csv', loader.song_object),
+                            ('playlist.csv', loader.playlist_object)):
+        objects.extend(to_object(list(row.values()))
+                       for row in read_feeder(resources, name))
+    credentials = base64.b64encode(
+        ('svc-loader:' + token).encode()).decode()
+    urllib.request.urlopen(urllib.request.Request(
+        db_url + '/batch_load',
+        data=json.dumps({"objects": objects}).encode(),
+        headers={'Content-Type': 'application/json',
+                 'Authorization': 'Basic ' + credentials}))
+
+
+def start_local(resources):
+    """Start the database service, on its in-memory storage driver,
+    and the three services on local ports, returning (urls, processes)."""
+    processes = []
+    db_port = free_port()
+    db_url = 'http://127.0.0.1:{}/api/v1/datastore'.format(db_port)
+    token = str(uuid.uuid4())
+    processes.append(subprocess.Popen(
+        [sys.executable, 'app-tpl.py', str(db_port)],
+        cwd=os.path.join(REPO, 'db'),
+        env=dict(os.environ, STORAGE_DRIVER='memory',
+                 SVC_LOADER_TOKEN=token),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL))
+    wait_healthy(db_url + '/health')
+    seed(db_url, resources, token)
+    env = dict(os.environ, DB_URL=db_url)
+    urls = {}
+    for service, directory in (('user', 's1'),
+                               ('music', os.path.join('s2', 'v1')),
+                               ('playlist', 's3')):
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, 'app.py', str(port)],
+            cwd=os.path.join(REPO, directory),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL))
+        urls[service] = 'http://127.0.0.1:{}/'.format(port)
+    for service, url in urls.items():
+        wait_healthy(url + PREFIXES[service] + 'health')
+    return urls, processes
+
+
+def scenario_rate(arg):
+    name, _, rate = arg.partition('=')
+    if name not in SCENARIOS:
+        raise argparse.ArgumentTypeError(
+            "unknown scenario {} (choose from {})".format(
+                name, ', '.join(SCENARIOS)))
+    return name, float(rate or 10)
+
+
+def parse_args():
+    argp = argparse.ArgumentParser(
+        'bench',
+        description='Open-loop benchmark of the user, music and '
+                    'playlist services')
+    target = argp.add_mutually_exclusive_group(required=True)
+    target.add_argument(
+        '--target',
+        help="Base URL of the services, such as http://<ingress IP>/")
+    target.add_argument(
+        '--local',
+        action='store_true',
+        help="Run the services locally against an in-memory datastore")
+    argp.add_argument(
+        '--scenario',
+        action='append',
+        type=scenario_rate,
+        required=True,
+        metavar='NAME[=RATE]',
+        help="Scenario and its mean requests per second (default 10); "
+             "repeat to run several at once. Scenarios: " +
+             ', '.join(SCENARIOS))
+    argp.add_argument('--duration', type=float, default=30,
+                      help="Seconds of load (default 30)")
+    argp.add_argument('--connections', type=int, default=100,
+                      help="Connections to the services (default 100)")
+    argp.add_argument('--max-in-flight', type=int, default=1000,
+                      help="Requests outstanding per scenario before "
+                           "further arrivals are dropped (default 1000)")
+    argp.add_argument('--timeout', type=float, default=10,
+                      help="Seconds before a request fails (default 10)")
+    argp.add_argument('--auth', default=DEFAULT_AUTH,
+                      help="Authorization header to send")
+    argp.add_argument('--resources', default=DEFAULT_RESOURCES,
+                      help="Directory holding the Gatling feeder files")
+    argp.add_argument('--output',
+                      help="File for the JSON results (default stdout)")
+    return argp.parse_args()
+
+
+def main():
+    args = parse_args()
+    feeders = Feeders(args.resources)
+    processes = []
+    try:
+        if args.local:
+            urls, processes = start_local(args.resources)
+        else:
+            base = args.target.rstrip('/') + '/'
+            urls = {service: base for service in PREFIXES}
+        results = asyncio.get_event_loop().run_until_complete(
+            run(urls, args, feeders))
+    finally:
+        for p in processes:
+            p.terminate()
+            p.wait()
+    report = {
+        "mode": "local" if args.local else "target",
+        "duration_sec": args.duration,
+        "rates": dict(args.scenario),
+        "scenarios": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
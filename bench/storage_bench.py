@@ -0,0 +1,268 @@
+"""
+SFU CMPT 756
+Benchmark of the database service's storage drivers.
+
+Runs one workload against each selected driver (see `db/storage.py`)
+through the DynamoDB `Table` interface the routes use, making the
+same calls, with the same expressions, as the routes of
+`db/app-tpl.py`.  Every driver sees the same sequence of keys and
+values.  The phases are:
+
+load     write every object in one batch writer, as `/batch_load`
+read     get an object, as `/read`
+update   set an attribute of an existing object, as `/update?exists=true`
+append   append to a list attribute, as `/list_append`
+query    read the first page of an artist's songs, as `/query`
+scan     read every object, a page at a time, as `/scan`
+
+The dynamodb driver creates a table, with an index on `Artist`, for
+the run and deletes it afterwards.  Give `--dynamodb-url` to use
+DynamoDB Local rather than AWS.
+
+The results, for each driver and phase, are written as JSON.
+"""
+
+# Standard library modules
+import argparse
+import concurrent.futures
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+# Installed packages
+import boto3
+from boto3.dynamodb.conditions import Key
+
+import simplejson as json
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, 'db'))
+
+# Local modules
+import storage  # noqa: E402
+
+DRIVERS = ('memory', 'sqlite', 'dynamodb')
+PHASES = ('load', 'read', 'update', 'append', 'query', 'scan')
+PERCENTILES = (50, 95, 99, 99.9)
+KEY = 'music_id'
+INDEX = 'Artist'
+# Pages of `/query` and `/scan`, at their default limit
+PAGE = 100
+
+# As the routes build them
+BUMP_VERSION = '#v = if_not_exists(#v, :zero) + :one'
+BUMP_VALUES = {':zero': 0, ':one': 1}
+
+
+def open_table(driver, args):
+    """Return (table, cleanup) for a new, empty table on `driver`."""
+    name = 'bench-music-' + uuid.uuid4().hex[:8]
+    if driver == 'memory':
+        return storage.MemoryResource({name: KEY}).Table(name), None
+    if driver == 'sqlite':
+        path = args.sqlite_path or os.path.join(tempfile.mkdtemp(),
+                                                'bench.sqlite')
+        resource = storage.SQLiteResource(
+            path, {name: KEY}, indexes={name: [INDEX]},
+            synchronous=args.sqlite_synchronous)
+
+        def cleanup():
+            with resource.connection() as conn:
+                conn.execute('DROP TABLE "{}"'.format(name))
+            resource.close()
+            if not args.sqlite_path:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+        return resource.Table(name), cleanup
+    kwargs = {'region_name': os.getenv('AWS_REGION', 'us-east-1')}
+    if args.dynamodb_url:
+        kwargs['endpoint_url'] = args.dynamodb_url
+    dynamodb = boto3.resource('dynamodb', **kwargs)
+    table = dynamodb.create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': KEY, 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': KEY, 'AttributeType': 'S'},
+                              {'AttributeName': INDEX,
+                               'AttributeType': 'S'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': INDEX + '-index',
+            'KeySchema': [{'AttributeName': INDEX, 'KeyType': 'HASH'}],
+            'Projection': {'ProjectionType': 'ALL'}}],
+        BillingMode='PAY_PER_REQUEST')
+    table.wait_until_exists()
+    return table, table.delete
+
+
+class Workload():
+    """The keys and values of one run, the same for every driver."""
+
+    def __init__(self, objects, ops, artists, seed):
+        rng = random.Random(seed)
+        self.objects = [{KEY: str(uuid.UUID(int=rng.getrandbits(128))),
+                         INDEX: 'Artist {}'.format(rng.randrange(artists)),
+                         'SongTitle': 'Song {}'.format(i)}
+                        for i in range(objects)]
+        keys = [obj[KEY] for obj in self.objects]
+        self.keys = [rng.choice(keys) for _ in range(ops)]
+        self.artists = ['Artist {}'.format(rng.randrange(artists))
+                        for _ in range(ops)]
+
+
+def load(table, workload):
+    with table.batch_writer(overwrite_by_pkeys=[KEY]) as batch:
+        for obj in workload.objects:
+            batch.put_item(Item=obj)
+
+
+def read(table, workload, i):
+    table.get_item(Key={KEY: workload.keys[i]})
+
+
+def update(table, workload, i):
+    table.update_item(
+        Key={KEY: workload.keys[i]},
+        UpdateExpression='SET SongTitle = :val1, ' + BUMP_VERSION,
+        ConditionExpression='attribute_exists(#k)',
+        ExpressionAttributeNames={'#v': 'version', '#k': KEY},
+        ExpressionAttributeValues=dict(BUMP_VALUES,
+                                       **{':val1': 'Title {}'.format(i)}))
+
+
+def append(table, workload, i):
+    table.update_item(
+        Key={KEY: workload.keys[i]},
+        UpdateExpression='SET #a = list_append(if_not_exists(#a, :empty), '
+                         ':vals), ' + BUMP_VERSION,
+        ConditionExpression='attribute_exists(#k)',
+        ExpressionAttributeNames={'#a': 'plays', '#k': KEY,
+                                  '#v': 'version'},
+        ExpressionAttributeValues=dict(BUMP_VALUES, **{
+            ':empty': [], ':vals': [i]}))
+
+
+def query(table, workload, i):
+    table.query(IndexName=INDEX + '-index',
+                KeyConditionExpression=Key(INDEX).eq(workload.artists[i]),
+                Limit=PAGE)
+
+
+def scan(table, workload, i):
+    kwargs = {'Limit': PAGE}
+    while True:
+        response = table.scan(**kwargs)
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+OPERATIONS = {'read': read, 'update': update, 'append': append,
+              'query': query, 'scan': scan}
+
+
+def summary(latencies, ops, seconds):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        # Nearest rank
+        rank = max(1, math.ceil(p / 100 * len(latencies)))
+        return round(1000 * latencies[rank - 1], 3)
+
+    return {
+        "ops": ops,
+        "seconds": round(seconds, 3),
+        "ops_per_sec": round(ops / seconds, 1) if seconds else None,
+        "latency_ms": dict(
+            [("p{:g}".format(p), percentile(p)) for p in PERCENTILES] +
+            [("mean", round(1000 * sum(latencies) / len(latencies), 3)),
+             ("max", round(1000 * latencies[-1], 3))]),
+    }
+
+
+def timed(operation, table, workload, i):
+    start = time.perf_counter()
+    operation(table, workload, i)
+    return time.perf_counter() - start
+
+
+def run_driver(driver, workload, args):
+    table, cleanup = open_table(driver, args)
+    results = {}
+    try:
+        start = time.perf_counter()
+        load(table, workload)
+        seconds = time.perf_counter() - start
+        results['load'] = summary([seconds], len(workload.objects), seconds)
+        with concurrent.futures.ThreadPoolExecutor(args.threads) as pool:
+            for phase in PHASES[1:]:
+                # A full scan per op would swamp the other phases
+                ops = max(1, args.ops // PAGE) if phase == 'scan' \
+                    else args.ops
+                start = time.perf_counter()
+                latencies = list(pool.map(
+                    lambda i: timed(OPERATIONS[phase], table, workload, i),
+                    range(ops)))
+                results[phase] = summary(latencies, ops,
+                                         time.perf_counter() - start)
+    finally:
+        if cleanup:
+            cleanup()
+    return results
+
+
+def parse_args():
+    argp = argparse.ArgumentParser(
+        'storage_bench',
+        description="Benchmark the database service's storage drivers")
+    argp.add_argument('--driver', action='append', choices=DRIVERS,
+                      help="Driver to run; repeat for several "
+                           "(default memory and sqlite)")
+    argp.add_argument('--objects', type=int, default=5000,
+                      help="Objects loaded (default 5000)")
+    argp.add_argument('--ops', type=int, default=5000,
+                      help="Operations in each phase; the scan phase "
+                           "makes one full scan per 100 (default 5000)")
+    argp.add_argument('--threads', type=int, default=8,
+                      help="Threads making the calls (default 8)")
+    argp.add_argument('--artists', type=int, default=100,
+                      help="Distinct artists, which sets the number of "
+                           "songs each query finds (default 100)")
+    argp.add_argument('--seed', type=int, default=756,
+                      help="Seed of the workload (default 756)")
+    argp.add_argument('--sqlite-path',
+                      help="SQLite database file (default a temporary file)")
+    argp.add_argument('--sqlite-synchronous', default='NORMAL',
+                      help="SQLite synchronous setting (default NORMAL)")
+    argp.add_argument('--dynamodb-url',
+                      help="DynamoDB endpoint, such as DynamoDB Local's "
+                           "(default AWS)")
+    argp.add_argument('--output',
+                      help="File for the JSON results (default stdout)")
+    return argp.parse_args()
+
+
+def main():
+    args = parse_args()
+    drivers = args.driver or ['memory', 'sqlite']
+    workload = Workload(args.objects, args.ops, args.artists, args.seed)
+    report = {
+        "objects": args.objects,
+        "ops": args.ops,
+        "threads": args.threads,
+        "drivers": {driver: run_driver(driver, workload, args)
+                    for driver in drivers},
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
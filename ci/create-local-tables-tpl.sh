@@ -27,4 +27,10 @@ aws dynamodb create-table \
   --attribute-definitions '[{ "AttributeName": "playlist_id", "AttributeType": "S" }]' \
   --key-schema '[{ "AttributeName": "playlist_id", "KeyType": "HASH" }]' \
   --provisioned-throughput '{"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}'
-
+aws dynamodb create-table \
+  --endpoint-url http://0.0.0.0:8000 \
+  --region us-west-2 \
+  --table-name Idempotency-ZZ-REG-ID \
+  --attribute-definitions '[{ "AttributeName": "idempotency_id", "AttributeType": "S" }]' \
+  --key-schema '[{ "AttributeName": "idempotency_id", "KeyType": "HASH" }]' \
+  --provisioned-throughput '{"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}'
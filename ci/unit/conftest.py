@@ -0,0 +1,148 @@
+"""
+Configure pytest for the unit tests.
+
+The unit tests run the services' modules in-process, without
+Docker, a network or DynamoDB.  This puts the database and playlist
+service directories on the module path, so the tests import their
+modules the way the services do, and provides the database service
+itself, running on its in-memory storage driver, and the user, music
+and playlist services, whose calls to it go to that database service.
+"""
+
+# Standard libraries
+import importlib.util
+import os
+import sys
+import urllib.parse
+
+# Installed packages
+import prometheus_client
+
+import pytest
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+REPO = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+for directory in ('db', 's3'):
+    sys.path.insert(0, os.path.join(REPO, directory))
+
+# The loader authorization the database service is started with
+LOADER_TOKEN = 'unit-test-token'
+
+
+@pytest.fixture(scope='session')
+def dbapp():
+    """
+    The database service's module, `db/app-tpl.py`, on the memory
+    driver.
+
+    The module is loaded once, so its tables, caches and metrics are
+    shared by every test; tests use fresh keys rather than rely on
+    empty tables.
+    """
+    os.environ['STORAGE_DRIVER'] = 'memory'
+    os.environ['SVC_LOADER_TOKEN'] = LOADER_TOKEN
+    spec = importlib.util.spec_from_file_location(
+        'dbapp', os.path.join(REPO, 'db', 'app-tpl.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def dbclient(dbapp):
+    """A Flask test client of the database service."""
+    return dbapp.app.test_client()
+
+
+class DatabaseAdapter(BaseAdapter):
+    """Sends a `requests.Session`'s calls to a Flask test client of
+    the database service, rather than over the network."""
+
+    def __init__(self, client):
+        super().__init__()
+        self._client = client
+
+    def send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        answer = self._client.open(url.path, method=request.method,
+                                   query_string=url.query,
+                                   headers=dict(request.headers),
+                                   data=request.body)
+        response = requests.Response()
+        response.status_code = answer.status_code
+        response.headers = CaseInsensitiveDict(answer.headers)
+        response._content = answer.data
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def load_module(directory, name, filename='app.py'):
+    """
+    Load `filename` in `directory` as module `name`.
+
+    The module imports its own copies of the modules its directory
+    shares with others, such as `auth.py` and `dbclient.py`, and
+    registers its metrics in a registry of its own, as each service
+    does in its own process.
+    """
+    path = os.path.join(REPO, directory)
+    local = [f[:-3] for f in os.listdir(path) if f.endswith('.py')]
+    saved = {m: sys.modules.pop(m) for m in local if m in sys.modules}
+    registry = prometheus_client.REGISTRY
+    prometheus_client.REGISTRY = prometheus_client.CollectorRegistry()
+    # Metrics created without a registry go to the one bound as their
+    # default, whatever prometheus_client.REGISTRY is by then
+    collectors = set(registry._collector_to_names)
+    sys.path.insert(0, path)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            name, os.path.join(path, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(path)
+        prometheus_client.REGISTRY = registry
+        for collector in set(registry._collector_to_names) - collectors:
+            registry.unregister(collector)
+        for m in local:
+            sys.modules.pop(m, None)
+        sys.modules.update(saved)
+    return module
+
+
+def load_service(directory, name, dbapp):
+    """
+    Load the service in `directory` as module `name`, its calls to
+    the database service going to `dbapp`.
+    """
+    module = load_module(directory, name)
+    adapter = DatabaseAdapter(dbapp.app.test_client())
+    module.db.session().mount('http://', adapter)
+    return module
+
+
+@pytest.fixture(scope='session')
+def userapp(dbapp):
+    """The user service's module, `s1/app.py`."""
+    return load_service('s1', 'userapp', dbapp)
+
+
+@pytest.fixture(scope='session')
+def musicapp(dbapp):
+    """The music service's module, `s2/v1/app.py`."""
+    return load_service(os.path.join('s2', 'v1'), 'musicapp', dbapp)
+
+
+@pytest.fixture(scope='session')
+def playlistapp(dbapp):
+    """The playlist service's module, `s3/app.py`."""
+    return load_service('s3', 'playlistapp', dbapp)
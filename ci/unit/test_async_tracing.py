@@ -0,0 +1,57 @@
+"""
+Test that the asyncio version of the playlist service, `s3/app_async.py`,
+passes its requests' tracing headers on to the database service through
+`s3/aiodbclient.py`, and attaches their trace ids to its call timings.
+"""
+
+# Standard libraries
+import asyncio
+
+# Installed packages
+from aiohttp import web
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+# Local modules
+import dbclient
+
+from conftest import load_module
+
+TRACE = {'x-request-id': 'r1', 'x-b3-traceid': '463ac35c9f6413ad',
+         'x-b3-spanid': 'a2fb4a1d1a96d312', 'x-b3-sampled': '1'}
+
+
+async def get_playlist(app_async, headers):
+    """GET a playlist through the service, whose database service is
+    a stand-in; return the headers the stand-in received."""
+    received = []
+
+    async def read(request):
+        received.append(request.headers.copy())
+        return web.json_response({'Count': 0, 'Items': []})
+    database = web.Application()
+    database.router.add_get('/api/v1/datastore/read', read)
+    async with TestServer(database) as server:
+        app_async.db._url = str(server.make_url('/api/v1/datastore'))
+        async with TestClient(TestServer(app_async.make_app())) as client:
+            response = await client.get('/api/v1/playlist/p1',
+                                        headers=headers)
+            assert response.status == 200
+    return received
+
+
+def test_trace_headers_passed_on():
+    app_async = load_module('s3', 'playlist_async', 'app_async.py')
+    headers = dict(TRACE, Authorization='Bearer unit-test')
+    received = asyncio.run(get_playlist(app_async, headers))
+    assert len(received) == 1
+    for name, value in headers.items():
+        assert received[0][name] == value
+
+    exemplars = [sample.exemplar
+                 for metric in app_async.db._duration.collect()
+                 for sample in metric.samples
+                 if sample.name.endswith('_bucket') and sample.exemplar]
+    if dbclient.EXEMPLARS:
+        assert [e.labels for e in exemplars] == \
+            [{'trace_id': TRACE['x-b3-traceid']}]
@@ -0,0 +1,201 @@
+"""
+Test the services' JWT checks, `auth.py`.
+
+The user, music and playlist services hold identical copies of
+`auth.py`; these tests import the playlist service's.  Users'
+revocation times are kept in `FakeUserRecords`, and through the
+database service in `test_user_records`.
+"""
+
+# Standard libraries
+import time
+
+# Installed packages
+import jwt
+
+import pytest
+
+import simplejson as json
+
+# Local modules
+import auth
+
+SECRET = 'a key long enough for HS256 to be content with it'
+
+
+@pytest.fixture
+def authenticator(monkeypatch):
+    monkeypatch.setenv('AUTH_MODE', 'jwt')
+    monkeypatch.setenv('JWT_SECRET', SECRET)
+    monkeypatch.setenv('AUTH_CACHE_SIZE', '4')
+    return auth.Authenticator()
+
+
+def bearer(token):
+    return {'Authorization': 'Bearer ' + token}
+
+
+def test_presence_mode(monkeypatch):
+    monkeypatch.setenv('AUTH_MODE', 'presence')
+    authenticator = auth.Authenticator()
+    assert authenticator.authorized({'Authorization': 'anything'})
+    assert not authenticator.authorized({})
+
+
+def test_issued_tokens_verify(authenticator):
+    token = authenticator.issue('u1')
+    assert authenticator.authorized(bearer(token))
+    # Answered from the cache the second time
+    assert authenticator.authorized(bearer(token))
+    assert not authenticator.authorized({'Authorization': token})
+
+
+def test_bad_tokens_refused(authenticator):
+    other = jwt.encode({'user_id': 'u1', 'exp': int(time.time()) + 60},
+                       'another key entirely, just as long as the first',
+                       algorithm='HS256')
+    expired = jwt.encode({'user_id': 'u1', 'exp': int(time.time()) - 1},
+                         SECRET, algorithm='HS256')
+    for token in (other, expired, 'not.a.jwt'):
+        if isinstance(token, bytes):
+            token = token.decode()
+        assert not authenticator.authorized(bearer(token))
+
+
+class FakeUserRecords():
+    """Users' revocation times, as `auth.UserRecords` keeps them on the
+    user records."""
+
+    def __init__(self, *user_ids):
+        self.times = {user_id: 0 for user_id in user_ids}
+        self.reads = 0
+        self.failing = False
+
+    def valid_after(self, user_id):
+        self.reads += 1
+        if self.failing:
+            raise RuntimeError('user read failed')
+        return self.times.get(user_id)
+
+    def set_valid_after(self, user_id, when):
+        if self.failing:
+            raise RuntimeError('user update failed')
+        if user_id in self.times:
+            self.times[user_id] = when
+        return True
+
+
+@pytest.fixture
+def users():
+    return FakeUserRecords('u1', 'u2')
+
+
+@pytest.fixture
+def revoking(monkeypatch, users):
+    """Two processes' Authenticators, sharing `users`."""
+    monkeypatch.setenv('AUTH_MODE', 'jwt')
+    monkeypatch.setenv('JWT_SECRET', SECRET)
+    monkeypatch.setenv('AUTH_REVOCATION_TTL_SEC', '5')
+    return auth.Authenticator(users), auth.Authenticator(users)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time the Authenticators see, advanced by
+    `clock[0] += seconds`."""
+    now = [time.time()]
+    monkeypatch.setattr(auth.time, 'time', lambda: now[0])
+    return now
+
+
+def test_revoked_token_refused(revoking, clock):
+    mine, other = revoking
+    token = mine.issue('u1')
+    assert mine.verify(token) and other.verify(token)
+    assert mine.revoke(token)
+    assert not mine.verify(token)
+    # The other process refuses it once it reads the user again
+    assert other.verify(token)
+    clock[0] += 5
+    assert not other.verify(token)
+
+
+def test_revocation_covers_the_users_tokens(revoking, users, clock):
+    mine, other = revoking
+    first, second = mine.issue('u1'), mine.issue('u1')
+    others = mine.issue('u2')
+    assert mine.revoke(first)
+    assert not mine.verify(second)
+    assert mine.verify(others)
+    # Logging in again after logging off
+    clock[0] += 0.001
+    assert mine.verify(mine.issue('u1'))
+
+
+def test_revocation_times_cached(revoking, users, clock):
+    mine, _ = revoking
+    for i in range(3):
+        assert mine.verify(mine.issue('u1'))
+    assert users.reads == 1
+    clock[0] += 5
+    assert mine.verify(mine.issue('u1'))
+    assert users.reads == 2
+
+
+def test_unread_users_refused(revoking, users, clock):
+    """A token is refused if its user cannot be read or no longer
+    exists, and the failure is not remembered."""
+    mine, _ = revoking
+    token = mine.issue('u1')
+    users.failing = True
+    assert not mine.verify(token)
+    users.failing = False
+    assert mine.verify(token)
+    assert not mine.verify(mine.issue('deleted'))
+
+
+def test_failed_revocation_reported(revoking, users):
+    mine, _ = revoking
+    token = mine.issue('u1')
+    users.failing = True
+    assert not mine.revoke(token)
+    # A token that does not verify needs no revocation
+    assert mine.revoke('not.a.jwt')
+
+
+# Revocation times kept on the user records
+
+def test_user_records(userapp, dbclient, monkeypatch):
+    """A logoff through one process's Authenticator is seen by another
+    through the database service."""
+    monkeypatch.setenv('AUTH_MODE', 'jwt')
+    monkeypatch.setenv('JWT_SECRET', SECRET)
+    monkeypatch.setenv('AUTH_REVOCATION_TTL_SEC', '0')
+    response = dbclient.post('/api/v1/datastore/write', json={
+        'objtype': 'user', 'fname': 'F', 'lname': 'L',
+        'email': 'e@example.com', 'playlist': []})
+    user_id = json.loads(response.data)['user_id']
+    users = auth.UserRecords(userapp.db)
+    assert users.valid_after(user_id) == 0
+    assert users.valid_after('no such user') is None
+
+    mine, other = auth.Authenticator(users), auth.Authenticator(users)
+    token = mine.issue(user_id)
+    assert other.verify(token)
+    assert mine.revoke(token)
+    assert users.valid_after(user_id) > 0
+    assert not other.verify(token)
+    assert mine.revoke(mine.issue('no such user'))
+
+
+def test_logoff(userapp, dbclient):
+    response = dbclient.post('/api/v1/datastore/write', json={
+        'objtype': 'user', 'fname': 'F', 'lname': 'L',
+        'email': 'e@example.com', 'playlist': []})
+    user_id = json.loads(response.data)['user_id']
+    client = userapp.app.test_client()
+    token = client.put('/api/v1/user/login',
+                       json={'uid': user_id}).get_data(as_text=True)
+    response = client.put('/api/v1/user/logoff', json={'jwt': token})
+    assert response.status_code == 200
+    assert auth.UserRecords(userapp.db).valid_after(user_id) > 0
@@ -0,0 +1,115 @@
+"""
+Test the database service's `/batch_read` route, `db/app-tpl.py`, on
+the memory driver.
+"""
+
+# Standard libraries
+import uuid
+
+# Installed packages
+import pytest
+
+import simplejson as json
+
+PREFIX = '/api/v1/datastore/'
+
+
+def body(response):
+    return json.loads(response.data)
+
+
+@pytest.fixture
+def songs(dbclient):
+    """Three new songs' ids."""
+    ids = []
+    for i in range(3):
+        music_id = str(uuid.uuid4())
+        response = dbclient.put(PREFIX + 'update',
+                                query_string={'objtype': 'music',
+                                              'objkey': music_id},
+                                json={'Artist': 'A',
+                                      'SongTitle': 'S{}'.format(i)})
+        assert response.status_code == 200
+        ids.append(music_id)
+    return ids
+
+
+def batch_read(client, content):
+    response = client.post(PREFIX + 'batch_read', json=content)
+    return response.status_code, body(response)
+
+
+def test_items_in_request_order(dbclient, songs):
+    ids = [songs[2], songs[0], songs[1]]
+    status, result = batch_read(dbclient, {'objtype': 'music',
+                                           'objkeys': ids})
+    assert status == 200
+    assert [item['music_id'] for item in result['Items']] == ids
+    assert result['Count'] == 3
+    assert result['Missing'] == result['Unprocessed'] == []
+
+
+def test_missing_and_repeated_keys(dbclient, songs):
+    missing = str(uuid.uuid4())
+    status, result = batch_read(dbclient, {
+        'objtype': 'music', 'objkeys': [songs[0], missing, songs[0]]})
+    assert [item['music_id'] for item in result['Items']] == \
+        [songs[0], songs[0]]
+    assert result['Missing'] == [{'objtype': 'music', 'objkey': missing}]
+
+
+def test_mixed_objtypes(dbclient, songs):
+    response = dbclient.post(PREFIX + 'write', json={
+        'objtype': 'user', 'fname': 'Ada', 'lname': 'Lovelace',
+        'email': 'ada@example.com', 'playlist': []})
+    user_id = body(response)['user_id']
+    status, result = batch_read(dbclient, {'keys': [
+        {'objtype': 'user', 'objkey': user_id},
+        {'objtype': 'music', 'objkey': songs[1]}]})
+    assert [item.get('user_id', item.get('music_id'))
+            for item in result['Items']] == [user_id, songs[1]]
+
+
+def test_more_keys_than_one_call(dbapp, dbclient, songs, monkeypatch):
+    monkeypatch.setattr(dbapp, 'BATCH_READ_MAX_KEYS', 2)
+    status, result = batch_read(dbclient, {'objtype': 'music',
+                                           'objkeys': songs})
+    assert [item['music_id'] for item in result['Items']] == songs
+
+
+def test_unprocessed_keys(dbapp, dbclient, songs, monkeypatch):
+    """Keys DynamoDB leaves unprocessed are retried, then reported."""
+    batch_get_item = dbapp.dynamodb.batch_get_item
+    calls = []
+
+    def unprocessing(RequestItems):
+        calls.append(RequestItems)
+        name, request = next(iter(RequestItems.items()))
+        response = batch_get_item(RequestItems={
+            name: {'Keys': request['Keys'][:1]}})
+        if len(request['Keys']) > 1:
+            response['UnprocessedKeys'] = {
+                name: {'Keys': request['Keys'][1:]}}
+        return response
+    monkeypatch.setattr(dbapp.dynamodb, 'batch_get_item', unprocessing)
+    monkeypatch.setattr(dbapp, 'BATCH_READ_BACKOFF_SEC', 0)
+    status, result = batch_read(dbclient, {'objtype': 'music',
+                                           'objkeys': songs})
+    assert [item['music_id'] for item in result['Items']] == songs
+    assert len(calls) == 3
+
+    monkeypatch.setattr(dbapp, 'BATCH_READ_MAX_RETRIES', 0)
+    status, result = batch_read(dbclient, {'objtype': 'music',
+                                           'objkeys': songs})
+    assert [item['music_id'] for item in result['Items']] == songs[:1]
+    assert result['Unprocessed'] == [{'objtype': 'music', 'objkey': key}
+                                     for key in songs[1:]]
+    assert result['Missing'] == []
+
+
+@pytest.mark.parametrize('content', [
+    {}, {'objtype': 'music'}, {'keys': [{'objtype': 'music'}]},
+    {'keys': 'music'}])
+def test_bad_requests(dbclient, content):
+    status, result = batch_read(dbclient, content)
+    assert status == 400
@@ -0,0 +1,109 @@
+"""
+Test the database service's `/batch_write` and `/batch_load` routes,
+`db/app-tpl.py`, on the memory driver.
+"""
+
+# Standard libraries
+import base64
+import uuid
+
+# Installed packages
+from botocore.exceptions import ClientError
+
+import pytest
+
+import simplejson as json
+
+# Local modules
+from conftest import LOADER_TOKEN
+
+PREFIX = '/api/v1/datastore/'
+LOADER_AUTH = 'Basic ' + base64.standard_b64encode(
+    'svc-loader:{}'.format(LOADER_TOKEN).encode()).decode()
+
+
+def body(response):
+    return json.loads(response.data)
+
+
+def read(client, objtype, objkey):
+    response = client.get(PREFIX + 'read', query_string={
+        'objtype': objtype, 'objkey': objkey, 'consistent': 'true'})
+    return body(response)['Items']
+
+
+def song(title):
+    return {'objtype': 'music', 'Artist': 'A', 'SongTitle': title}
+
+
+def test_batch_write(dbclient):
+    response = dbclient.post(PREFIX + 'batch_write', json={'objects': [
+        song('S0'),
+        {'objtype': 'user', 'fname': 'Ada', 'lname': 'Lovelace',
+         'email': 'ada@example.com', 'playlist': []},
+        song('S1')]})
+    result = body(response)
+    assert result['Count'] == 3 and result['Errors'] == 0
+    first, user, last = result['Items']
+    assert read(dbclient, 'music', first['music_id'])[0]['SongTitle'] == 'S0'
+    assert read(dbclient, 'user', user['user_id'])[0]['fname'] == 'Ada'
+    assert read(dbclient, 'music', last['music_id'])[0]['SongTitle'] == 'S1'
+
+
+def test_batch_write_reports_each_error(dbclient):
+    response = dbclient.post(PREFIX + 'batch_write', json={'objects': [
+        {'Artist': 'A'}, song('S0'), {'objtype': 'album'}, 'music']})
+    result = body(response)
+    assert result['Count'] == 1 and result['Errors'] == 3
+    assert result['Items'][0] == {'error': 'Missing objtype'}
+    assert 'music_id' in result['Items'][1]
+    assert result['Items'][2] == {'error': 'Unknown objtype'}
+    assert result['Items'][3] == {'error': 'Missing objtype'}
+
+
+def test_batch_write_table_failure(dbapp, dbclient, monkeypatch):
+    """A table refusing the batch fails only the objects bound for
+    it."""
+    def refuse(**kwargs):
+        raise ClientError({'Error': {'Code': 'ValidationException',
+                                     'Message': 'refused'}},
+                          'BatchWriteItem')
+    monkeypatch.setattr(dbapp.tables['user'], 'batch_writer', refuse)
+    response = dbclient.post(PREFIX + 'batch_write', json={'objects': [
+        {'objtype': 'user', 'fname': 'Ada'}, song('S0')]})
+    result = body(response)
+    assert result['Items'][0] == {'error': 'refused'}
+    assert 'music_id' in result['Items'][1]
+
+
+@pytest.mark.parametrize('content', [{}, {'objects': 'music'}, []])
+def test_batch_write_needs_a_list(dbclient, content):
+    response = dbclient.post(PREFIX + 'batch_write', json=content)
+    assert response.status_code == 400
+
+
+def test_batch_load(dbclient):
+    keys = [str(uuid.uuid4()) for _ in range(2)]
+    objects = [dict(song('S{}'.format(i)), uuid=key)
+               for i, key in enumerate(keys)]
+    # A repeated key is written once, the last object winning
+    objects.append(dict(song('S2'), uuid=keys[0]))
+    objects.append(song('no uuid'))
+    response = dbclient.post(PREFIX + 'batch_load',
+                             json={'objects': objects},
+                             headers={'Authorization': LOADER_AUTH})
+    result = body(response)
+    assert result['Items'] == [{'music_id': keys[0]}, {'music_id': keys[1]},
+                               {'music_id': keys[0]},
+                               {'error': 'Missing uuid'}]
+    assert read(dbclient, 'music', keys[0])[0]['SongTitle'] == 'S2'
+    assert read(dbclient, 'music', keys[1])[0]['SongTitle'] == 'S1'
+
+
+def test_batch_load_needs_authorization(dbclient):
+    key = str(uuid.uuid4())
+    response = dbclient.post(
+        PREFIX + 'batch_load',
+        json={'objects': [dict(song('S0'), uuid=key)]})
+    assert response.status_code == 401
+    assert read(dbclient, 'music', key) == []
@@ -0,0 +1,162 @@
+"""
+Test playlists returned with their songs' details: the helpers in
+`s3/expand.py` and the playlist service's `?expand=songs`,
+`s3/app.py`.
+"""
+
+# Standard libraries
+import threading
+import time
+import uuid
+
+# Installed packages
+import pytest
+
+import requests
+
+import simplejson as json
+
+# Local modules
+import expand
+
+PREFIX = '/api/v1/datastore/'
+PLAYLISTS = '/api/v1/playlist/'
+AUTH = {'Authorization': 'Bearer unit-test'}
+
+
+# Helpers
+
+def test_batches(monkeypatch):
+    monkeypatch.setattr(expand, 'EXPAND_BATCH_SIZE', 2)
+    assert expand.batches(['a', 'b', 'a', 'c']) == [
+        [{'objtype': 'music', 'objkey': 'a'},
+         {'objtype': 'music', 'objkey': 'b'}],
+        [{'objtype': 'music', 'objkey': 'c'}]]
+    assert expand.batches([]) == []
+
+
+def test_batch_result():
+    keys = [{'objtype': 'music', 'objkey': k} for k in 'abc']
+    assert expand.batch_result(keys, 503, None) == ([], ['a', 'b', 'c'])
+    assert expand.batch_result(keys, 200, {
+        'Items': [{'music_id': 'a'}],
+        'Unprocessed': [{'objtype': 'music', 'objkey': 'c'}]}) == \
+        ([{'music_id': 'a'}], ['c'])
+
+
+def test_expand():
+    item = expand.expand({'songs': ['a', 'b', 'c', 'a', 'b']},
+                         ['a', 'b', 'c', 'a', 'b'],
+                         {'a': {'music_id': 'a'}}, unread=['c'])
+    assert item == {'songs': [{'music_id': 'a'}, {'music_id': 'a'}],
+                    'missing_songs': ['b'],
+                    'unread_songs': ['c'],
+                    'partial': True}
+
+
+# The service
+
+@pytest.fixture
+def songs(dbclient):
+    """Five new songs' ids."""
+    ids = []
+    for i in range(5):
+        response = dbclient.post(PREFIX + 'write', json={
+            'objtype': 'music', 'Artist': 'A', 'SongTitle': 'S{}'.format(i)})
+        ids.append(json.loads(response.data)['music_id'])
+    return ids
+
+
+def playlist(dbclient, songs):
+    response = dbclient.post(PREFIX + 'write', json={
+        'objtype': 'playlist', 'title': 'T', 'songs': songs})
+    return json.loads(response.data)['playlist_id']
+
+
+def get_expanded(playlistapp, playlist_id):
+    response = playlistapp.app.test_client().get(
+        PLAYLISTS + playlist_id, query_string={'expand': 'songs'},
+        headers=AUTH)
+    assert response.status_code == 200
+    return response.get_json()['Items'][0]
+
+
+@pytest.fixture
+def batch_reads(playlistapp, monkeypatch):
+    """The threads making each batch_read call, and the most calls
+    in flight at once, each taking 0.05 seconds."""
+    batch_read = playlistapp.db.batch_read
+    lock = threading.Lock()
+    calls = {'threads': [], 'in_flight': 0, 'most': 0}
+
+    def slow_batch_read(keys, **kwargs):
+        with lock:
+            calls['threads'].append(threading.current_thread())
+            calls['in_flight'] += 1
+            calls['most'] = max(calls['most'], calls['in_flight'])
+        time.sleep(0.05)
+        try:
+            return batch_read(keys, **kwargs)
+        finally:
+            with lock:
+                calls['in_flight'] -= 1
+    monkeypatch.setattr(playlistapp.db, 'batch_read', slow_batch_read)
+    return calls
+
+
+def test_songs_in_playlist_order(playlistapp, dbclient, songs, batch_reads):
+    missing = str(uuid.uuid4())
+    order = [songs[3], songs[0], missing, songs[3]]
+    item = get_expanded(playlistapp, playlist(dbclient, order))
+    assert [s['music_id'] for s in item['songs']] == \
+        [songs[3], songs[0], songs[3]]
+    assert item['missing_songs'] == [missing]
+    assert item['unread_songs'] == [] and not item['partial']
+
+
+def test_one_batch_read_inline(playlistapp, dbclient, songs, batch_reads):
+    get_expanded(playlistapp, playlist(dbclient, songs))
+    assert batch_reads['threads'] == [threading.current_thread()]
+
+
+def test_batches_limited_per_request(playlistapp, dbclient, songs,
+                                     batch_reads, monkeypatch):
+    monkeypatch.setattr(playlistapp.expand, 'EXPAND_BATCH_SIZE', 1)
+    monkeypatch.setattr(playlistapp.expand, 'EXPAND_CONCURRENCY', 2)
+    item = get_expanded(playlistapp, playlist(dbclient, songs))
+    assert [s['music_id'] for s in item['songs']] == songs
+    assert len(batch_reads['threads']) == 5
+    assert batch_reads['most'] == 2
+
+
+def test_failed_batch_unread(playlistapp, dbclient, songs, monkeypatch):
+    monkeypatch.setattr(playlistapp.expand, 'EXPAND_BATCH_SIZE', 2)
+    batch_read = playlistapp.db.batch_read
+
+    def failing_batch_read(keys, **kwargs):
+        if keys[0]['objkey'] == songs[2]:
+            raise requests.ConnectionError('refused')
+        return batch_read(keys, **kwargs)
+    monkeypatch.setattr(playlistapp.db, 'batch_read', failing_batch_read)
+    item = get_expanded(playlistapp, playlist(dbclient, songs))
+    assert [s['music_id'] for s in item['songs']] == \
+        [songs[0], songs[1], songs[4]]
+    assert item['unread_songs'] == [songs[2], songs[3]]
+    assert item['partial'] and item['missing_songs'] == []
+
+
+def test_map_limited(playlistapp):
+    lock = threading.Lock()
+    counts = {'in_flight': 0, 'most': 0}
+
+    def work(i):
+        with lock:
+            counts['in_flight'] += 1
+            counts['most'] = max(counts['most'], counts['in_flight'])
+        time.sleep(0.02)
+        with lock:
+            counts['in_flight'] -= 1
+        return i * i
+    assert playlistapp.map_limited(work, range(10), 3) == \
+        [i * i for i in range(10)]
+    assert counts['most'] == 3
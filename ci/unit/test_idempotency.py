@@ -0,0 +1,97 @@
+"""
+Test the database service's `Idempotency-Key` handling on writes,
+`db/app-tpl.py`, on the memory driver.
+"""
+
+# Standard libraries
+import time
+import uuid
+
+# Installed packages
+import pytest
+
+import simplejson as json
+
+PREFIX = '/api/v1/datastore/'
+
+
+def body(response):
+    return json.loads(response.data)
+
+
+@pytest.fixture
+def user():
+    return {'objtype': 'user', 'fname': 'Ada', 'lname': 'Lovelace',
+            'email': 'ada@example.com', 'playlist': []}
+
+
+def write(client, obj, key):
+    return client.post(PREFIX + 'write', json=obj,
+                       headers={'Idempotency-Key': key})
+
+
+def test_write_replayed(dbapp, dbclient, user):
+    key = str(uuid.uuid4())
+    first = write(dbclient, user, key)
+    assert first.status_code == 200
+    assert 'Idempotent-Replayed' not in first.headers
+    for clear_cache in (False, True):
+        if clear_cache:
+            # As if served by another process
+            dbapp.idempotency_cache.clear()
+        again = write(dbclient, user, key)
+        assert again.status_code == 200
+        assert again.headers['Idempotent-Replayed'] == 'true'
+        assert body(again) == body(first)
+    user_id = body(first)['user_id']
+    response = dbclient.get(PREFIX + 'scan',
+                            query_string={'objtype': 'user', 'limit': 1000})
+    assert [item['user_id'] for item in body(response)['Items']
+            ].count(user_id) == 1
+
+
+def test_write_key_reused(dbapp, dbclient, user):
+    """A key presented with a different body is refused, whether or
+    not the first response is still cached."""
+    key = str(uuid.uuid4())
+    assert write(dbclient, user, key).status_code == 200
+    changed = dict(user, fname='Augusta')
+    assert write(dbclient, changed, key).status_code == 422
+    dbapp.idempotency_cache.clear()
+    assert write(dbclient, changed, key).status_code == 422
+    assert write(dbclient, user, key).status_code == 200
+
+
+def test_write_without_key(dbclient, user):
+    first = dbclient.post(PREFIX + 'write', json=user)
+    second = dbclient.post(PREFIX + 'write', json=user)
+    assert body(first)['user_id'] != body(second)['user_id']
+
+
+def test_reads_show_no_fingerprint(dbapp, dbclient, user):
+    """The request's fingerprint is kept in the idempotency table, not
+    on the object it created."""
+    key = str(uuid.uuid4())
+    user_id = body(write(dbclient, user, key))['user_id']
+    response = dbclient.get(PREFIX + 'read', query_string={
+        'objtype': 'user', 'objkey': user_id})
+    item = body(response)['Items'][0]
+    assert set(item) == {'user_id', 'fname', 'lname', 'email', 'playlist'}
+    record = dbapp.idempotency_table.get_item(
+        Key={dbapp.IDEMPOTENCY_ID: user_id})['Item']
+    assert record[dbapp.IDEMPOTENCY_EXPIRES] > time.time()
+
+
+def test_claim_lapses(dbapp, dbclient, user, monkeypatch):
+    """Once IDEMPOTENCY_TTL_SEC has passed, a different request may
+    claim the key; the object it derives already exists, so it is
+    replayed."""
+    key = str(uuid.uuid4())
+    first = write(dbclient, user, key)
+    later = time.time() + dbapp.IDEMPOTENCY_TTL_SEC + 1
+    monkeypatch.setattr(dbapp.time, 'time', lambda: later)
+    changed = dict(user, fname='Augusta')
+    again = write(dbclient, changed, key)
+    assert again.status_code == 200
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert body(again) == body(first)
@@ -0,0 +1,53 @@
+"""
+Test the parser for list attributes, `idlist.py`, and that the
+modules each service directory holds a copy of are identical.
+"""
+
+# Standard libraries
+import filecmp
+import os
+
+# Installed packages
+import pytest
+
+# Local modules
+import idlist
+
+from conftest import REPO
+
+COPIES = {
+    'idlist.py': ['s1', 's3', 'loader'],
+    'auth.py': ['s1', 's2/v1', 's3'],
+    'dbclient.py': ['s1', 's2/v1', 's3'],
+}
+
+
+@pytest.mark.parametrize('value, ids', [
+    (None, []),
+    ([], []),
+    ('', []),
+    ('  ', []),
+    ('[]', []),
+    (' [ ] ', []),
+    (['a', 'b'], ['a', 'b']),
+    ('[{"S": "a"}, {"S": "b"}]', ['a', 'b']),
+    ('\n[{"S": "a"}]\n', ['a']),
+    ([{'S': 'a'}], ['a']),
+])
+def test_id_list(value, ids):
+    assert idlist.id_list(value) == ids
+
+
+@pytest.mark.parametrize('value', [
+    'not json', '{"S": "a"}', '"a"', {'a': 1}, 3, [1, 2], [{'N': '1'}]])
+def test_id_list_refuses(value):
+    with pytest.raises(ValueError):
+        idlist.id_list(value)
+
+
+@pytest.mark.parametrize('filename, directories', COPIES.items())
+def test_copies_identical(filename, directories):
+    first = os.path.join(REPO, directories[0], filename)
+    for directory in directories[1:]:
+        assert filecmp.cmp(first, os.path.join(REPO, directory, filename),
+                           shallow=False), directory
@@ -0,0 +1,114 @@
+"""
+Test the user service's `/<user_id>/library`, `s1/app.py`, which
+returns a user with their playlists and songs.
+"""
+
+# Standard libraries
+import uuid
+
+# Installed packages
+import pytest
+
+import requests
+
+import simplejson as json
+
+PREFIX = '/api/v1/datastore/'
+AUTH = {'Authorization': 'Bearer unit-test'}
+
+
+def write(dbclient, content):
+    response = dbclient.post(PREFIX + 'write', json=content)
+    return json.loads(response.data)[content['objtype'] + '_id']
+
+
+@pytest.fixture
+def library(dbclient):
+    """A user with two playlists, the second written as the loader
+    writes them, and one missing playlist.  Returns the user id and
+    the playlists' and songs' ids."""
+    songs = [write(dbclient, {'objtype': 'music', 'Artist': 'A',
+                              'SongTitle': 'S{}'.format(i)})
+             for i in range(3)]
+    playlists = [
+        write(dbclient, {'objtype': 'playlist', 'title': 'T0',
+                         'songs': [songs[0], songs[1]]}),
+        write(dbclient, {'objtype': 'playlist', 'title': 'T1',
+                         'songs': json.dumps([{'S': songs[1]},
+                                              {'S': songs[2]}])}),
+        str(uuid.uuid4()),
+    ]
+    user_id = write(dbclient, {'objtype': 'user', 'fname': 'F',
+                               'lname': 'L', 'email': 'e@example.com',
+                               'playlist': playlists})
+    return user_id, playlists, songs
+
+
+def get_library(userapp, user_id, **query):
+    response = userapp.app.test_client().get(
+        '/api/v1/user/{}/library'.format(user_id), query_string=query,
+        headers=AUTH)
+    return response.status_code, response.get_json()
+
+
+def test_playlists(userapp, library):
+    user_id, playlists, songs = library
+    status, content = get_library(userapp, user_id)
+    assert status == 200
+    assert content['user']['user_id'] == user_id
+    assert [p['playlist_id'] for p in content['playlists']] == playlists[:2]
+    assert not content['truncated'] and not content['partial']
+
+
+def test_songs(userapp, library):
+    """The loader's string of ids is parsed like a list, and a song in
+    two playlists is read once."""
+    user_id, playlists, songs = library
+    reads = []
+    batch_read = userapp.db.batch_read
+
+    def counting_batch_read(keys, **kwargs):
+        reads.append([k['objkey'] for k in keys])
+        return batch_read(keys, **kwargs)
+    userapp.db.batch_read = counting_batch_read
+    try:
+        status, content = get_library(userapp, user_id, depth='songs')
+    finally:
+        userapp.db.batch_read = batch_read
+    assert status == 200
+    assert [[s['music_id'] for s in p['songs']]
+            for p in content['playlists']] == [songs[:2], songs[1:]]
+    assert reads == [playlists, songs]
+
+
+def test_caps_truncate(userapp, library):
+    user_id, playlists, songs = library
+    status, content = get_library(userapp, user_id, depth='songs',
+                                  max_playlists=1, max_songs=1)
+    assert [p['playlist_id'] for p in content['playlists']] == playlists[:1]
+    assert [s['music_id'] for s in content['playlists'][0]['songs']] == \
+        songs[:1]
+    assert content['truncated']
+
+
+def test_unread(userapp, library, monkeypatch):
+    user_id, playlists, songs = library
+    batch_read = userapp.db.batch_read
+
+    def failing_batch_read(keys, **kwargs):
+        if keys[0]['objtype'] == 'music':
+            raise requests.ConnectionError('refused')
+        return batch_read(keys, **kwargs)
+    monkeypatch.setattr(userapp.db, 'batch_read', failing_batch_read)
+    status, content = get_library(userapp, user_id, depth='songs')
+    assert status == 200
+    assert content['partial']
+    assert content['unread_songs'] == songs
+    assert all(p['songs'] == [] for p in content['playlists'])
+
+
+@pytest.mark.parametrize('query', [{'max_playlists': -1},
+                                   {'max_songs': -1}])
+def test_negative_caps_refused(userapp, library, query):
+    status, content = get_library(userapp, library[0], **query)
+    assert status == 400
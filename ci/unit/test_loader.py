@@ -0,0 +1,96 @@
+"""
+Test the loader's batch mode, `loader/app.py`, against a stand-in for
+the database service's `/batch_load`.
+"""
+
+# Standard libraries
+import os
+
+# Installed packages
+import pytest
+
+# Local modules
+from conftest import load_module
+
+
+@pytest.fixture
+def loader(tmp_path, monkeypatch):
+    """The loader's module, checkpointing under `tmp_path`."""
+    module = load_module('loader', 'loader')
+    monkeypatch.setattr(module, 'CHECKPOINT_FILE',
+                        str(tmp_path / 'checkpoint.json'))
+    monkeypatch.setattr(module, 'BATCH_SIZE', 2)
+    monkeypatch.setattr(module, 'WORKERS', 2)
+    return module
+
+
+class FakeResponse():
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self._content = content
+
+    def json(self):
+        return self._content
+
+
+class FakeSession():
+    """Answers `/batch_load`, refusing the objects in `refused`."""
+
+    def __init__(self):
+        self.refused = set()
+        self.loaded = []
+
+    def post(self, url, json):
+        items = []
+        for obj in json['objects']:
+            if obj['uuid'] in self.refused:
+                items.append({'error': 'refused'})
+            else:
+                self.loaded.append(obj['uuid'])
+                items.append({obj['objtype'] + '_id': obj['uuid']})
+        return FakeResponse(200, {'Items': items})
+
+
+@pytest.fixture
+def resources(tmp_path):
+    """A resource directory of five users, songs and playlists."""
+    rows = {
+        'users/users.csv': 'user_id,email,fname,lname,playlist\n' + ''.join(
+            'u{0},u{0}@example.com,F,L,"[{{""S"": ""p{0}""}}]"\n'.format(i)
+            for i in range(5)),
+        'music/music.csv': 'music_id,Artist,SongTitle\n' + ''.join(
+            'm{0},A,S{0}\n'.format(i) for i in range(5)),
+        'playlist/playlist.csv': 'playlist_id,songs,title\n' + ''.join(
+            'p{0},[],T{0}\n'.format(i) for i in range(5)),
+    }
+    for path, text in rows.items():
+        (tmp_path / path).parent.mkdir()
+        (tmp_path / path).write_text(text)
+    return str(tmp_path)
+
+
+def test_load_all(loader, resources, monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(loader, 'build_session', lambda: session)
+    assert loader.batch_load_all(resources) == 0
+    assert sorted(session.loaded) == sorted(
+        '{}{}'.format(t, i) for t in 'ump' for i in range(5))
+    assert not os.path.exists(loader.CHECKPOINT_FILE)
+
+
+def test_failures_counted(loader, resources, monkeypatch):
+    """Every refused row is counted, the checkpoint is kept, and a
+    rerun resumes from it."""
+    session = FakeSession()
+    session.refused = {'u3', 'm1', 'm2'}
+    monkeypatch.setattr(loader, 'build_session', lambda: session)
+    assert loader.batch_load_all(resources) == 3
+    checkpoint = loader.read_checkpoint()
+    assert checkpoint[resources + '/users/users.csv'] == 2
+    assert checkpoint[resources + '/music/music.csv'] == 0
+
+    session.refused = set()
+    session.loaded = []
+    assert loader.batch_load_all(resources) == 0
+    assert 'u0' not in session.loaded and 'u3' in session.loaded
+    assert not os.path.exists(loader.CHECKPOINT_FILE)
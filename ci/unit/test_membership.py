@@ -0,0 +1,266 @@
+"""
+Test the playlist service's membership updates, `s3/membership.py`.
+
+The queue is run against `FakeDatastore`, which keeps user records
+and the ids of the playlists that exist in memory, and answers `read`
+and versioned `update` calls as the database service does.
+"""
+
+# Standard libraries
+import copy
+import os
+import time
+
+# Installed packages
+from prometheus_client import CollectorRegistry
+
+import pytest
+
+import requests
+
+import simplejson as json
+
+# Local modules
+import membership
+
+
+class FakeResponse():
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.text = json.dumps(content)
+        self._content = content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def json(self):
+        return self._content
+
+
+class FakeDatastore():
+    """User records, and the ids of the playlists that exist, in
+    memory, with scripted failures.
+
+    `failures` lists the status codes (or exceptions) of the next
+    updates, which then leave the record unchanged.  `on_update` is
+    called with each user id before its update is applied, to make
+    concurrent changes.
+    """
+
+    def __init__(self, users, playlists):
+        self.users = copy.deepcopy(users)
+        self.playlists = set(playlists)
+        self.failures = []
+        self.on_update = None
+        self.updates = 0
+
+    def read(self, objtype, objkey, fields=None, consistent=False,
+             headers=None):
+        if objtype == 'playlist':
+            items = [{'playlist_id': objkey}] \
+                if objkey in self.playlists else []
+            return FakeResponse(200, {"Count": len(items), "Items": items})
+        item = self.users.get(objkey)
+        items = [copy.deepcopy(item)] if item is not None else []
+        return FakeResponse(200, {"Count": len(items), "Items": items})
+
+    def update(self, objtype, objkey, content, expected_version=None,
+               headers=None):
+        self.updates += 1
+        if self.failures:
+            failure = self.failures.pop(0)
+            if isinstance(failure, Exception):
+                raise failure
+            return FakeResponse(failure, {})
+        if self.on_update:
+            self.on_update(objkey)
+        item = self.users[objkey]
+        if expected_version is not None and \
+                item.get('version', 0) != expected_version:
+            return FakeResponse(409, {"Item": copy.deepcopy(item)})
+        item.update(content)
+        item['version'] = item.get('version', 0) + 1
+        return FakeResponse(200, {})
+
+
+def entry(op, user_id, playlist_id):
+    return {"op": op, "user_id": user_id, "playlist_id": playlist_id,
+            "time": time.time()}
+
+
+@pytest.fixture
+def db():
+    return FakeDatastore({
+        'u1': {'user_id': 'u1', 'playlist': ['p1']},
+        'u2': {'user_id': 'u2', 'playlist': '[{"S": "p1"}]', 'version': 4},
+        'bad': {'user_id': 'bad', 'playlist': {'p1': True}},
+    }, ['p1', 'p2', 'p3', 'p4'])
+
+
+@pytest.fixture
+def queue(db, tmp_path):
+    return membership.MembershipQueue(db, str(tmp_path), fsync=False,
+                                      registry=CollectorRegistry())
+
+
+# Changing the playlist attribute
+
+def test_apply_change():
+    assert membership.apply_change(['a'], 'add', 'b') == ['a', 'b']
+    assert membership.apply_change(['a', 'b'], 'remove', 'a') == ['b']
+    assert membership.apply_change(None, 'add', 'a') == ['a']
+    # Nothing to change
+    assert membership.apply_change(['a'], 'add', 'a') is None
+    assert membership.apply_change(['a'], 'remove', 'b') is None
+    # The loader's strings are never treated as lists of characters,
+    # and are rewritten as lists even if the membership is unchanged
+    assert membership.apply_change('[]', 'add', 'a') == ['a']
+    assert membership.apply_change('[{"S": "a"}]', 'add', 'a') == ['a']
+    assert membership.apply_change('[{"S": "a"}]', 'remove', 'a') == []
+
+
+def test_apply_change_refuses():
+    with pytest.raises(ValueError):
+        membership.apply_change('[', 'add', 'a')
+
+
+# Applying queued changes
+
+def test_changes_coalesce(queue, db):
+    """A user's changes go in one update, the last change to each
+    playlist deciding its membership."""
+    failed = queue._apply([entry('add', 'u1', 'p2'),
+                           entry('add', 'u1', 'p3'),
+                           entry('remove', 'u1', 'p3'),
+                           entry('remove', 'u1', 'p1'),
+                           entry('add', 'u1', 'p4')])
+    assert failed == []
+    assert db.updates == 1
+    assert db.users['u1']['playlist'] == ['p2', 'p4']
+    assert db.users['u1']['version'] == 1
+
+
+def test_loader_string_playlist(queue, db):
+    assert queue._apply([entry('add', 'u2', 'p2')]) == []
+    assert db.users['u2']['playlist'] == ['p1', 'p2']
+    assert db.users['u2']['version'] == 5
+
+
+def test_conflict_is_redone(queue, db):
+    """A change made between the read and the update is kept."""
+    def concurrent_change(user_id):
+        db.on_update = None
+        db.users[user_id]['playlist'] = ['p1', 'p9']
+        db.users[user_id]['version'] = 1
+    db.on_update = concurrent_change
+    assert queue._apply([entry('add', 'u1', 'p2')]) == []
+    assert db.users['u1']['playlist'] == ['p1', 'p9', 'p2']
+    assert db.users['u1']['version'] == 2
+
+
+def test_deleted_playlist_not_added(queue, db):
+    """The add of a playlist deleted since it was queued is applied
+    as a remove."""
+    assert queue._apply([entry('add', 'u1', 'p5')]) == []
+    assert db.users['u1']['playlist'] == ['p1']
+    db.users['u1']['playlist'].append('p5')
+    assert queue._apply([entry('add', 'u1', 'p5')]) == []
+    assert db.users['u1']['playlist'] == ['p1']
+
+
+def test_remove_changes_version(queue, db):
+    """A remove applied before the add it undoes still changes the
+    user's version."""
+    assert queue._apply([entry('remove', 'u1', 'p5')]) == []
+    assert db.users['u1']['playlist'] == ['p1']
+    assert db.users['u1']['version'] == 1
+
+
+def test_add_and_remove_in_two_processes(queue, db, tmp_path):
+    """Another process deletes the playlist and applies its remove
+    between this process's read and update of the user: the update
+    conflicts, and the add is redone as a remove."""
+    other = membership.MembershipQueue(db, str(tmp_path / 'other'),
+                                       fsync=False,
+                                       registry=CollectorRegistry())
+
+    def delete_and_remove(user_id):
+        db.on_update = None
+        db.playlists.discard('p2')
+        assert other._apply([entry('remove', user_id, 'p2')]) == []
+    db.on_update = delete_and_remove
+    assert queue._apply([entry('add', 'u1', 'p2')]) == []
+    assert db.users['u1']['playlist'] == ['p1']
+
+
+def test_unread_playlist_retried(queue, db):
+    batch = [entry('add', 'u1', 'p2')]
+    read = db.read
+
+    def failing_read(objtype, *args, **kwargs):
+        if objtype == 'playlist':
+            return FakeResponse(503, {})
+        return read(objtype, *args, **kwargs)
+    db.read = failing_read
+    assert queue._apply(batch) == batch
+    assert db.updates == 0
+
+
+@pytest.mark.parametrize('failure', [
+    503, requests.ConnectionError('refused')])
+def test_failures_are_retried(queue, db, failure):
+    batch = [entry('add', 'u1', 'p2'), entry('remove', 'u1', 'p1')]
+    db.failures = [failure]
+    assert queue._apply(batch) == batch
+    assert db.users['u1']['playlist'] == ['p1']
+    assert queue._apply(batch) == []
+    assert db.users['u1']['playlist'] == ['p2']
+
+
+def test_retry_is_idempotent(queue, db):
+    """A batch applied again, as after a crash before the journal was
+    rewritten, changes nothing."""
+    batch = [entry('add', 'u1', 'p2'), entry('add', 'u1', 'p3')]
+    assert queue._apply(batch) == []
+    assert queue._apply(batch) == []
+    assert db.users['u1']['playlist'] == ['p1', 'p2', 'p3']
+    assert db.updates == 1
+
+
+def test_refused_changes_are_dropped(queue, db):
+    batch = [entry('add', 'nobody', 'p2'), entry('add', 'bad', 'p2')]
+    assert queue._apply(batch) == []
+    assert db.updates == 0
+    assert db.users['bad']['playlist'] == {'p1': True}
+    db.failures = [400]
+    assert queue._apply([entry('add', 'u1', 'p2')]) == []
+    assert db.users['u1']['playlist'] == ['p1']
+
+
+# The journal
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_queue_applies_in_background(queue, db, tmp_path):
+    queue.start()
+    queue.enqueue('add', 'u1', 'p2')
+    wait_for(lambda: db.users['u1']['playlist'] == ['p1', 'p2'])
+    journal = os.path.join(str(tmp_path),
+                           'membership-{}.log'.format(os.getpid()))
+    wait_for(lambda: os.path.getsize(journal) == 0)
+
+
+def test_orphan_journal_is_replayed(queue, db, tmp_path):
+    """The changes left by a process that has exited are applied."""
+    orphan = tmp_path / 'membership-999999999.log'
+    orphan.write_text(''.join(json.dumps(e) + '\n' for e in [
+        entry('add', 'u1', 'p2'), entry('remove', 'u1', 'p1')]))
+    queue.start()
+    wait_for(lambda: db.users['u1']['playlist'] == ['p2'])
+    assert not orphan.exists()
@@ -0,0 +1,145 @@
+"""
+Test the music service's song cache: `LRUCache`, `s2/v1/cache.py`,
+and the caching of reads, found and missing, in `s2/v1/app.py`.
+"""
+
+# Standard libraries
+import importlib.util
+import os
+import types
+import uuid
+
+# Installed packages
+import pytest
+
+# Local modules
+from conftest import REPO
+
+spec = importlib.util.spec_from_file_location(
+    'musiccache', os.path.join(REPO, 's2', 'v1', 'cache.py'))
+cache = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cache)
+
+AUTH = {'Authorization': 'Bearer unit-test'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time the caches see, advanced by `clock[0] += seconds`."""
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'time',
+                        types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def evictions():
+    return []
+
+
+@pytest.fixture
+def lru(clock, evictions):
+    return cache.LRUCache(2, 10, on_evict=evictions.append)
+
+
+# LRUCache
+
+def test_hit_and_miss(lru):
+    assert lru.get('a') == (False, None)
+    lru.put('a', 1)
+    assert lru.get('a') == (True, 1)
+
+
+def test_least_recently_used_evicted(lru, evictions):
+    lru.put('a', 1)
+    lru.put('b', 2)
+    lru.get('a')
+    lru.put('c', 3)
+    assert lru.get('b') == (False, None)
+    assert lru.get('a') == (True, 1) and lru.get('c') == (True, 3)
+    assert evictions == ['size'] and len(lru) == 2
+
+
+def test_entries_expire(lru, clock, evictions):
+    lru.put('a', 1)
+    lru.put('b', 2, ttl=1)
+    clock[0] += 1
+    assert lru.get('b') == (False, None)
+    assert lru.get('a') == (True, 1)
+    clock[0] += 9
+    assert lru.get('a') == (False, None)
+    assert evictions == ['expired', 'expired']
+
+
+def test_invalidate(lru, evictions):
+    lru.put('a', 1)
+    lru.invalidate('a')
+    lru.invalidate('missing')
+    assert lru.get('a') == (False, None)
+    assert evictions == ['invalidated']
+
+
+def test_size_zero_disables(clock):
+    lru = cache.LRUCache(0, 10)
+    lru.put('a', 1)
+    assert lru.get('a') == (False, None)
+    assert len(lru) == 0
+
+
+# Reads through the cache
+
+@pytest.fixture
+def reads(musicapp, clock, monkeypatch):
+    """The music ids the service reads from the database service,
+    through an empty cache on `clock`."""
+    monkeypatch.setattr(musicapp, 'song_cache', cache.LRUCache(100, 300))
+    read = musicapp.db.read
+    ids = []
+
+    def counting_read(objtype, objkey, *args, **kwargs):
+        ids.append(objkey)
+        return read(objtype, objkey, *args, **kwargs)
+    monkeypatch.setattr(musicapp.db, 'read', counting_read)
+    return ids
+
+
+def get_song(musicapp, music_id):
+    return musicapp.app.test_client().get('/api/v1/music/' + music_id,
+                                          headers=AUTH).get_json()
+
+
+def test_songs_cached(musicapp, reads, clock):
+    response = musicapp.app.test_client().post(
+        '/api/v1/music/', json={'Artist': 'A', 'SongTitle': 'S'},
+        headers=AUTH)
+    music_id = response.get_json()['music_id']
+    for _ in range(3):
+        assert get_song(musicapp, music_id)['Items'][0]['SongTitle'] == 'S'
+    assert reads == [music_id]
+    clock[0] += 300
+    get_song(musicapp, music_id)
+    assert reads == [music_id] * 2
+
+
+def test_missing_songs_cached_briefly(musicapp, reads, clock):
+    """A missing id is cached for MUSIC_CACHE_NEGATIVE_TTL_SEC, so a
+    song created through another replica is soon found."""
+    music_id = str(uuid.uuid4())
+    for _ in range(3):
+        assert get_song(musicapp, music_id)['Count'] == 0
+    assert reads == [music_id]
+    clock[0] += musicapp.NEGATIVE_TTL_SEC
+    get_song(musicapp, music_id)
+    assert reads == [music_id] * 2
+
+
+def test_delete_invalidates(musicapp, reads):
+    client = musicapp.app.test_client()
+    response = client.post('/api/v1/music/',
+                           json={'Artist': 'A', 'SongTitle': 'S'},
+                           headers=AUTH)
+    music_id = response.get_json()['music_id']
+    get_song(musicapp, music_id)
+    client.delete('/api/v1/music/' + music_id, headers=AUTH)
+    assert get_song(musicapp, music_id)['Count'] == 0
+    assert reads == [music_id] * 2
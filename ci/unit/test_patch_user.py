@@ -0,0 +1,79 @@
+"""
+Test the user service's partial updates, `PATCH /api/v1/user/<user_id>`
+in `s1/app.py`, which change only the attributes clients may set.
+"""
+
+# Standard libraries
+import uuid
+
+# Installed packages
+import pytest
+
+import simplejson as json
+
+PREFIX = '/api/v1/datastore/'
+USERS = '/api/v1/user/'
+AUTH = {'Authorization': 'Bearer unit-test'}
+
+
+def read(dbclient, user_id):
+    response = dbclient.get(PREFIX + 'read', query_string={
+        'objtype': 'user', 'objkey': user_id, 'consistent': 'true'})
+    items = json.loads(response.data)['Items']
+    return items[0] if items else None
+
+
+@pytest.fixture
+def user(dbclient):
+    response = dbclient.post(PREFIX + 'write', json={
+        'objtype': 'user', 'fname': 'F', 'lname': 'L',
+        'email': 'e@example.com', 'playlist': ['p1']})
+    return json.loads(response.data)['user_id']
+
+
+def patch(userapp, user_id, content, headers=AUTH):
+    return userapp.app.test_client().patch(USERS + user_id, json=content,
+                                           headers=headers)
+
+
+def test_patch(userapp, dbclient, user):
+    response = patch(userapp, user, {'fname': 'G', 'email': 'g@example.com'})
+    assert response.status_code == 200
+    attributes = response.get_json()['Attributes']
+    assert attributes['fname'] == 'G' and attributes['version'] == 1
+    assert read(dbclient, user) == {
+        'user_id': user, 'fname': 'G', 'lname': 'L',
+        'email': 'g@example.com', 'playlist': ['p1'], 'version': 1}
+
+
+@pytest.mark.parametrize('content', [
+    {'playlist': []},
+    {'fname': 'G', 'playlist': []},
+    {'version': 7},
+    {'user_id': 'other'},
+    {'tokens_valid_after_ms': 0},
+    {},
+    ['fname'],
+    'fname',
+])
+def test_refused_attributes(userapp, dbclient, user, content):
+    """Nothing is changed unless every attribute may be set by
+    clients."""
+    before = read(dbclient, user)
+    response = patch(userapp, user, content)
+    assert json.loads(response.data) == {
+        "message": "error reading arguments"}
+    assert read(dbclient, user) == before
+
+
+def test_missing_user(userapp, dbclient):
+    user_id = str(uuid.uuid4())
+    response = patch(userapp, user_id, {'fname': 'G'})
+    assert response.status_code == 404
+    assert read(dbclient, user_id) is None
+
+
+def test_auth_required(userapp, dbclient, user):
+    response = patch(userapp, user, {'fname': 'G'}, headers={})
+    assert response.status_code == 401
+    assert read(dbclient, user)['fname'] == 'F'
@@ -0,0 +1,133 @@
+"""
+Test adding songs to and removing them from playlists: the database
+service's `/list_append` and `/list_remove`, `db/app-tpl.py`, and the
+playlist service's routes that call them, `s3/app.py`.
+"""
+
+# Standard libraries
+import uuid
+
+# Installed packages
+import pytest
+
+import simplejson as json
+
+PREFIX = '/api/v1/datastore/'
+PLAYLISTS = '/api/v1/playlist/'
+AUTH = {'Authorization': 'Bearer unit-test'}
+
+
+def body(response):
+    return json.loads(response.data)
+
+
+def read(dbclient, playlist_id):
+    items = body(dbclient.get(PREFIX + 'read', query_string={
+        'objtype': 'playlist', 'objkey': playlist_id,
+        'consistent': 'true'}))['Items']
+    return items[0] if items else None
+
+
+@pytest.fixture
+def playlist(dbclient):
+    """A playlist holding songs m1, m2 and m1 again."""
+    response = dbclient.post(PREFIX + 'write', json={
+        'objtype': 'playlist', 'title': 'T', 'songs': ['m1', 'm2', 'm1']})
+    return body(response)['playlist_id']
+
+
+def list_call(dbclient, route, playlist_id, content):
+    return dbclient.put(PREFIX + route, json=content, query_string={
+        'objtype': 'playlist', 'objkey': playlist_id})
+
+
+# The database service
+
+def test_list_append(dbclient, playlist):
+    response = list_call(dbclient, 'list_append', playlist,
+                         {'attr': 'songs', 'values': ['m3', 'm4']})
+    assert response.status_code == 200
+    assert read(dbclient, playlist)['songs'] == ['m1', 'm2', 'm1', 'm3', 'm4']
+
+
+@pytest.mark.parametrize('values', ['m3', {'m3': 1}, 3, None])
+def test_list_append_needs_a_list(dbclient, playlist, values):
+    """A string is not appended as a list of its characters."""
+    response = list_call(dbclient, 'list_append', playlist,
+                         {'attr': 'songs', 'values': values})
+    assert response.status_code == 400
+    assert read(dbclient, playlist)['songs'] == ['m1', 'm2', 'm1']
+
+
+def test_list_remove(dbclient, playlist):
+    response = list_call(dbclient, 'list_remove', playlist,
+                         {'attr': 'songs', 'value': 'm1', 'index': 2})
+    assert response.status_code == 200
+    response = list_call(dbclient, 'list_remove', playlist,
+                         {'attr': 'songs', 'value': 'm2', 'index': 0})
+    assert response.status_code == 409
+    response = list_call(dbclient, 'list_remove', playlist,
+                         {'attr': 'songs', 'value': 'm2'})
+    assert response.status_code == 200
+    assert read(dbclient, playlist)['songs'] == ['m1']
+
+
+@pytest.mark.parametrize('index', [-1, '1', 1.5, True, [1]])
+def test_list_remove_bad_index(dbclient, playlist, index):
+    response = list_call(dbclient, 'list_remove', playlist,
+                         {'attr': 'songs', 'value': 'm2', 'index': index})
+    assert response.status_code == 400
+    assert read(dbclient, playlist)['songs'] == ['m1', 'm2', 'm1']
+
+
+# The playlist service
+
+def test_add_song(playlistapp, dbclient, playlist):
+    client = playlistapp.app.test_client()
+    response = client.put(PLAYLISTS + playlist, json={'music_id': 'm3'},
+                          headers=AUTH)
+    assert response.status_code == 200
+    item = read(dbclient, playlist)
+    assert item['songs'] == ['m1', 'm2', 'm1', 'm3']
+    assert item['title'] == 'T'
+
+
+def test_add_song_sets_title(playlistapp, dbclient, playlist):
+    client = playlistapp.app.test_client()
+    response = client.put(PLAYLISTS + playlist,
+                          json={'music_id': 'm3', 'title': 'U'},
+                          headers=AUTH)
+    assert response.status_code == 200
+    item = read(dbclient, playlist)
+    assert item['songs'] == ['m1', 'm2', 'm1', 'm3']
+    assert item['title'] == 'U'
+
+
+def test_add_song_to_missing_playlist(playlistapp, dbclient):
+    """Neither the song nor the title creates a playlist."""
+    playlist_id = str(uuid.uuid4())
+    client = playlistapp.app.test_client()
+    response = client.put(PLAYLISTS + playlist_id,
+                          json={'music_id': 'm3', 'title': 'U'},
+                          headers=AUTH)
+    assert response.status_code == 404
+    assert read(dbclient, playlist_id) is None
+
+
+def test_remove_song(playlistapp, dbclient, playlist):
+    client = playlistapp.app.test_client()
+    response = client.put(PLAYLISTS + playlist + '/m1', json={'index': 2},
+                          headers=AUTH)
+    assert response.status_code == 200
+    response = client.put(PLAYLISTS + playlist + '/m2', headers=AUTH)
+    assert response.status_code == 200
+    assert read(dbclient, playlist)['songs'] == ['m1']
+
+
+@pytest.mark.parametrize('index', [-1, '1', 1.5, True])
+def test_remove_song_bad_index(playlistapp, dbclient, playlist, index):
+    client = playlistapp.app.test_client()
+    response = client.put(PLAYLISTS + playlist + '/m2',
+                          json={'index': index}, headers=AUTH)
+    assert response.status_code == 400
+    assert read(dbclient, playlist)['songs'] == ['m1', 'm2', 'm1']
@@ -0,0 +1,107 @@
+"""
+Test the database service's single-flight reads, `db/app-tpl.py`, on
+the memory driver: identical concurrent reads share one `GetItem`.
+"""
+
+# Standard libraries
+import threading
+import time
+import uuid
+
+# Installed packages
+import pytest
+
+import simplejson as json
+
+PREFIX = '/api/v1/datastore/'
+
+
+def body(response):
+    return json.loads(response.data)
+
+
+@pytest.fixture
+def song(dbapp, dbclient):
+    """A song, and a list recording the GetItem calls made on it,
+    which each take 0.1 seconds."""
+    music_id = str(uuid.uuid4())
+    response = dbclient.put(PREFIX + 'update',
+                            query_string={'objtype': 'music',
+                                          'objkey': music_id},
+                            json={'Artist': 'A', 'SongTitle': 'S'})
+    assert response.status_code == 200
+    table = dbapp.tables['music']
+    get_item = table.get_item
+    calls = []
+
+    def slow_get_item(**kwargs):
+        if kwargs['Key']['music_id'] == music_id:
+            calls.append(kwargs)
+            time.sleep(0.1)
+        return get_item(**kwargs)
+    table.get_item = slow_get_item
+    yield music_id, calls
+    table.get_item = get_item
+
+
+def read_together(dbapp, query, count):
+    """Make `count` reads with `query` at once, returning their
+    responses."""
+    responses = [None] * count
+
+    def read(i):
+        responses[i] = dbapp.app.test_client().get(PREFIX + 'read',
+                                                   query_string=query)
+    threads = [threading.Thread(target=read, args=(i,))
+               for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return responses
+
+
+def test_reads_share_a_call(dbapp, song):
+    music_id, calls = song
+    responses = read_together(dbapp, {'objtype': 'music',
+                                      'objkey': music_id}, 10)
+    assert len(calls) == 1
+    assert all(body(r)['Items'][0]['SongTitle'] == 'S' for r in responses)
+
+
+def test_consistent_reads_do_not_share(dbapp, song):
+    music_id, calls = song
+    read_together(dbapp, {'objtype': 'music', 'objkey': music_id,
+                          'consistent': 'true'}, 3)
+    assert len(calls) == 3
+
+
+def test_reads_after_update_see_it(dbapp, dbclient, song):
+    music_id, calls = song
+    read_together(dbapp, {'objtype': 'music', 'objkey': music_id}, 2)
+    dbclient.put(PREFIX + 'update',
+                 query_string={'objtype': 'music', 'objkey': music_id},
+                 json={'SongTitle': 'T'})
+    response = dbclient.get(PREFIX + 'read', query_string={
+        'objtype': 'music', 'objkey': music_id})
+    assert body(response)['Items'][0]['SongTitle'] == 'T'
+
+
+def test_shared_read_failure(dbapp, song):
+    """Every read sharing a failed call fails with it."""
+    music_id, calls = song
+    table = dbapp.tables['music']
+    slow_get_item = table.get_item
+
+    def failing_get_item(**kwargs):
+        slow_get_item(**kwargs)
+        raise RuntimeError('GetItem failed')
+    table.get_item = failing_get_item
+    try:
+        responses = read_together(dbapp, {'objtype': 'music',
+                                          'objkey': music_id}, 5)
+    finally:
+        table.get_item = slow_get_item
+    assert len(calls) == 1
+    assert [r.status_code for r in responses] == [500] * 5
+    assert not dbapp.read_flights
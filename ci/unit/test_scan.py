@@ -0,0 +1,79 @@
+"""
+Test the database service's paged `/scan` and `/query` routes,
+`db/app-tpl.py`, on the memory driver.
+"""
+
+# Standard libraries
+import base64
+import uuid
+
+# Installed packages
+import pytest
+
+import simplejson as json
+
+PREFIX = '/api/v1/datastore/'
+
+
+def cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+@pytest.fixture
+def artist(dbclient):
+    """An artist with five songs, whose ids are returned."""
+    name = str(uuid.uuid4())
+    ids = []
+    for i in range(5):
+        response = dbclient.post(PREFIX + 'write', json={
+            'objtype': 'music', 'Artist': name,
+            'SongTitle': 'S{}'.format(i)})
+        ids.append(json.loads(response.data)['music_id'])
+    return name, ids
+
+
+def pages(client, route, query):
+    """Follow the cursors of `route` from the first page to the last,
+    returning the ids of the items on each."""
+    result = []
+    query = dict(query)
+    while True:
+        response = client.get(PREFIX + route, query_string=query)
+        assert response.status_code == 200
+        content = response.get_json()
+        result.append([item['music_id'] for item in content['Items']])
+        if content['Cursor'] is None:
+            return result
+        query['cursor'] = content['Cursor']
+
+
+def test_scan_pages(dbclient, artist):
+    found = pages(dbclient, 'scan', {'objtype': 'music', 'limit': 2})
+    assert all(len(page) <= 2 for page in found)
+    ids = [i for page in found for i in page]
+    assert len(ids) == len(set(ids))
+    assert set(artist[1]) <= set(ids)
+
+
+def test_query_pages(dbclient, artist):
+    name, ids = artist
+    found = pages(dbclient, 'query', {'objtype': 'music', 'index': 'Artist',
+                                      'value': name, 'limit': 2})
+    assert [len(page) for page in found] == [2, 2, 1]
+    assert sorted(i for page in found for i in page) == sorted(ids)
+
+
+@pytest.mark.parametrize('bad', [
+    'not base64!', cursor([1, 2]), cursor(3), cursor('music_id'),
+    cursor({'song': 'x'}), cursor({'music_id': 1}),
+    cursor({'music_id': 'x', 'extra': 'y'})])
+def test_bad_cursors(dbclient, artist, bad):
+    """A cursor that is not a key of the table is refused with a 400,
+    not passed on for DynamoDB to refuse."""
+    for route, query in [
+            ('scan', {'objtype': 'music'}),
+            ('query', {'objtype': 'music', 'index': 'Artist',
+                       'value': artist[0]})]:
+        response = dbclient.get(PREFIX + route,
+                                query_string=dict(query, cursor=bad))
+        assert response.status_code == 400
@@ -0,0 +1,152 @@
+"""
+Test the database service's shared cache, `db/sharedcache.py`, on
+`FakeRedis`.
+"""
+
+# Standard libraries
+import decimal
+import time
+import types
+
+# Installed packages
+from prometheus_client import CollectorRegistry
+
+import pytest
+
+import simplejson as json
+
+# Local modules
+import sharedcache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The time the server sees, advanced by `clock[0] += seconds`."""
+    now = [1000.0]
+    monkeypatch.setattr(sharedcache, 'time', types.SimpleNamespace(
+        monotonic=lambda: now[0], perf_counter=time.perf_counter))
+    return now
+
+
+@pytest.fixture
+def registry():
+    return CollectorRegistry()
+
+
+@pytest.fixture
+def cache(clock, registry):
+    return sharedcache.SharedCache(sharedcache.FakeRedis(), 'test', 60,
+                                   ttls={'music': 600}, tombstone_ttl=2,
+                                   registry=registry)
+
+
+def requests(registry, objtype, result):
+    return registry.get_sample_value('db_cache_requests_total',
+                                     {'objtype': objtype, 'result': result})
+
+
+def test_put_and_get(cache, registry):
+    item = {'user_id': 'u1', 'version': decimal.Decimal(3)}
+    assert cache.get('user', 'u1') is None
+    cache.put('user', 'u1', item)
+    assert cache.get('user', 'u1') == item
+    assert requests(registry, 'user', 'miss') == 1
+    assert requests(registry, 'user', 'hit') == 1
+
+
+def test_put_does_not_replace(cache):
+    """Puts are SET NX: a read never overwrites the entry another
+    read put."""
+    cache.put('user', 'u1', {'user_id': 'u1', 'fname': 'A'})
+    cache.put('user', 'u1', {'user_id': 'u1', 'fname': 'B'})
+    assert cache.get('user', 'u1')['fname'] == 'A'
+
+
+def test_tombstone_blocks_stale_put(cache, clock):
+    """A read that began before a change, and holds the old object,
+    cannot put it back while the change's tombstone lives."""
+    cache.put('user', 'u1', {'user_id': 'u1', 'fname': 'A'})
+    cache.invalidate('user', 'u1')
+    assert cache.get('user', 'u1') is None
+    # The slow read's put of the object it read before the change
+    cache.put('user', 'u1', {'user_id': 'u1', 'fname': 'A'})
+    assert cache.get('user', 'u1') is None
+    clock[0] += 2
+    cache.put('user', 'u1', {'user_id': 'u1', 'fname': 'B'})
+    assert cache.get('user', 'u1')['fname'] == 'B'
+
+
+def test_entries_expire_by_objtype(cache, clock):
+    cache.put('user', 'u1', {'user_id': 'u1'})
+    cache.put('music', 'm1', {'music_id': 'm1'})
+    clock[0] += 60
+    assert cache.get('user', 'u1') is None
+    assert cache.get('music', 'm1') == {'music_id': 'm1'}
+    clock[0] += 540
+    assert cache.get('music', 'm1') is None
+
+
+def test_many(cache, registry):
+    assert cache.get_many([]) == {}
+    cache.put_many({})
+    cache.put_many({('user', 'u1'): {'user_id': 'u1'},
+                    ('music', 'm1'): {'music_id': 'm1'}})
+    cache.invalidate('music', 'm1')
+    cache.put_many({('music', 'm1'): {'music_id': 'stale'},
+                    ('user', 'u1'): {'user_id': 'replaced'}})
+    keys = [('user', 'u1'), ('music', 'm1'), ('user', 'u2')]
+    assert cache.get_many(keys) == {('user', 'u1'): {'user_id': 'u1'}}
+    assert requests(registry, 'user', 'hit') == 1
+    assert requests(registry, 'user', 'miss') == 1
+    assert requests(registry, 'music', 'miss') == 1
+
+
+class FailingRedis():
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError('refused')
+        return fail
+
+
+def test_failures_are_misses(clock, registry):
+    cache = sharedcache.SharedCache(FailingRedis(), 'test', 60,
+                                    registry=registry)
+    cache.put('user', 'u1', {'user_id': 'u1'})
+    cache.put_many({('user', 'u1'): {'user_id': 'u1'}})
+    cache.invalidate('user', 'u1')
+    assert cache.get('user', 'u1') is None
+    assert cache.get_many([('user', 'u1'), ('user', 'u2')]) == {}
+    assert requests(registry, 'user', 'error') == 3
+    assert registry.get_sample_value(
+        'db_cache_call_duration_seconds_count',
+        {'operation': 'invalidate', 'outcome': 'error'}) == 1
+
+
+def test_objtype_ttls():
+    assert sharedcache.objtype_ttls('') == {}
+    assert sharedcache.objtype_ttls(' music = 600, user=0.5,') == \
+        {'music': 600.0, 'user': 0.5}
+
+
+# The database service's reads through the cache
+
+def test_db_reads_through_cache(dbapp, dbclient, registry, monkeypatch):
+    """Reads put what they find, and an update leaves a tombstone, so
+    the next read goes to the table and sees the change."""
+    cache = sharedcache.SharedCache(sharedcache.FakeRedis(), 'test', 60,
+                                    registry=registry)
+    monkeypatch.setattr(dbapp, 'shared_cache', cache)
+    response = dbclient.post('/api/v1/datastore/write', json={
+        'objtype': 'music', 'Artist': 'A', 'SongTitle': 'S'})
+    music_id = json.loads(response.data)['music_id']
+
+    def read():
+        response = dbclient.get('/api/v1/datastore/read', query_string={
+            'objtype': 'music', 'objkey': music_id})
+        return json.loads(response.data)['Items'][0]['SongTitle']
+    assert read() == 'S' and read() == 'S'
+    assert requests(registry, 'music', 'hit') == 1
+    dbclient.put('/api/v1/datastore/update', json={'SongTitle': 'T'},
+                 query_string={'objtype': 'music', 'objkey': music_id})
+    assert read() == 'T'
+    assert cache.get('music', music_id) is None
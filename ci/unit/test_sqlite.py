@@ -0,0 +1,59 @@
+"""
+Test what the SQLite storage driver, `db/storage.py`, adds to the
+table tests in `test_storage.py`: persistence, transactions and its
+connection pool.
+"""
+
+# Standard libraries
+import threading
+
+# Installed packages
+import pytest
+
+# Local modules
+import storage
+
+NAME = 'Music-test'
+KEY = 'music_id'
+
+
+def test_sqlite_persists(tmp_path):
+    path = str(tmp_path / 'test.sqlite')
+    first = storage.SQLiteResource(path, {NAME: KEY})
+    first.Table(NAME).put_item(Item={KEY: 'x', 'n': 1})
+    first.close()
+    second = storage.SQLiteResource(path, {NAME: KEY})
+    assert second.Table(NAME).get_item(Key={KEY: 'x'})['Item']['n'] == 1
+    second.close()
+
+
+def test_sqlite_batch_writer_rolls_back(tmp_path):
+    """A batch is one transaction, which an exception rolls back."""
+    resource = storage.SQLiteResource(str(tmp_path / 'test.sqlite'),
+                                      {NAME: KEY})
+    table = resource.Table(NAME)
+    with pytest.raises(RuntimeError):
+        with table.batch_writer() as batch:
+            batch.put_item(Item={KEY: 'x'})
+            raise RuntimeError()
+    assert 'Item' not in table.get_item(Key={KEY: 'x'})
+    resource.close()
+
+
+def test_sqlite_pools_connections(tmp_path):
+    """A thread per call, as the development server starts per
+    request, reuses the pooled connections."""
+    resource = storage.SQLiteResource(str(tmp_path / 'test.sqlite'),
+                                      {NAME: KEY})
+    table = resource.Table(NAME)
+    table.put_item(Item={KEY: 'x'})
+    opened = []
+    open_connection = resource._open
+    resource._open = lambda: opened.append(1) or open_connection()
+    for _ in range(20):
+        thread = threading.Thread(
+            target=lambda: table.get_item(Key={KEY: 'x'}))
+        thread.start()
+        thread.join()
+    assert not opened
+    resource.close()
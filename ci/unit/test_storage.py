@@ -0,0 +1,277 @@
+"""
+Test the database service's storage drivers, `db/storage.py`.
+
+Every test of the `Table` interface runs against both the memory and
+the SQLite driver, which must behave as DynamoDB does for the calls
+the routes make.
+"""
+
+# Standard libraries
+import threading
+
+# Installed packages
+from boto3.dynamodb.conditions import Key
+
+from botocore.exceptions import ClientError
+
+import pytest
+
+# Local modules
+import storage
+
+NAME = 'Music-test'
+KEY = 'music_id'
+INDEX = 'Artist'
+BUMP_VERSION = '#v = if_not_exists(#v, :zero) + :one'
+
+
+def error_code(e):
+    return e.value.response['Error']['Code']
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def resource(request, tmp_path):
+    if request.param == 'memory':
+        yield storage.MemoryResource({NAME: KEY})
+        return
+    resource = storage.SQLiteResource(str(tmp_path / 'test.sqlite'),
+                                      {NAME: KEY}, indexes={NAME: [INDEX]})
+    yield resource
+    resource.close()
+
+
+@pytest.fixture
+def table(resource):
+    return resource.Table(NAME)
+
+
+@pytest.fixture
+def songs(table):
+    """Load ten songs, s0 to s9, by two artists."""
+    with table.batch_writer() as batch:
+        for i in range(10):
+            batch.put_item(Item={KEY: 's{}'.format(i),
+                                 INDEX: 'A' if i % 2 else 'B',
+                                 'SongTitle': 'Song {}'.format(i)})
+    return ['s{}'.format(i) for i in range(10)]
+
+
+# Expressions
+
+def test_expression_updates():
+    expression = storage.Expression(
+        'SET #a = :a, n = n + :one REMOVE l[1], old',
+        {'#a': 'title'}, {':a': 'x', ':one': 1})
+    actions = expression.updates()
+    expression.done()
+    assert [(a[0], a[1]) for a in actions] == [
+        ('SET', ['title']), ('SET', ['n']), ('REMOVE', ['l', 1]),
+        ('REMOVE', ['old'])]
+    assert actions[1][2]({'n': 2}) == 3
+
+
+@pytest.mark.parametrize('text, item, expected', [
+    ('attribute_exists(a)', {'a': 1}, True),
+    ('attribute_not_exists(a)', {'a': 1}, False),
+    ('a = :one AND b <> :one', {'a': 1, 'b': 2}, True),
+    ('a = :one AND b <> :one', {'a': 1, 'b': 1}, False),
+    ('a > :one OR NOT (b >= :one)', {'a': 1, 'b': 0}, True),
+    ('NOT attribute_exists(a) OR a < :one', {'a': 0}, True),
+    ('a <= :one', {}, False),
+    ('a <> :one', {}, True),
+])
+def test_expression_conditions(text, item, expected):
+    expression = storage.Expression(text, values={':one': 1})
+    condition = expression.condition()
+    expression.done()
+    assert condition(item) == expected
+
+
+@pytest.mark.parametrize('text', [
+    'SET #missing = :a',
+    'SET a = :missing',
+    'SET a = :a,',
+    'ADD a :a',
+    'SET a = :a $',
+])
+def test_expression_errors(text):
+    with pytest.raises(ClientError) as e:
+        expression = storage.Expression(text, values={':a': 1})
+        expression.updates()
+        expression.done()
+    assert error_code(e) == 'ValidationException'
+
+
+def test_projection():
+    item = {'a': 1, 'b': 2, 'c': 3}
+    assert storage.projection(item, '#a, c, d', {'#a': 'a'}) == \
+        {'a': 1, 'c': 3}
+
+
+# Tables
+
+def test_put_get_delete(table):
+    assert 'Item' not in table.get_item(Key={KEY: 'x'})
+    table.put_item(Item={KEY: 'x', 'SongTitle': 'T', 'n': 1})
+    assert table.get_item(Key={KEY: 'x'})['Item'] == \
+        {KEY: 'x', 'SongTitle': 'T', 'n': 1}
+    assert table.get_item(Key={KEY: 'x'},
+                          ProjectionExpression='#t',
+                          ExpressionAttributeNames={'#t': 'SongTitle'}
+                          )['Item'] == {'SongTitle': 'T'}
+    table.delete_item(Key={KEY: 'x'})
+    assert 'Item' not in table.get_item(Key={KEY: 'x'})
+
+
+def test_wrong_key(table):
+    with pytest.raises(ClientError) as e:
+        table.get_item(Key={'user_id': 'x'})
+    assert error_code(e) == 'ValidationException'
+
+
+def test_update_versions(table):
+    for version in (1, 2):
+        response = table.update_item(
+            Key={KEY: 'x'},
+            UpdateExpression='SET SongTitle = :t, ' + BUMP_VERSION,
+            ExpressionAttributeNames={'#v': 'version'},
+            ExpressionAttributeValues={':t': 'T', ':zero': 0, ':one': 1},
+            ReturnValues='UPDATED_NEW')
+        assert response['Attributes'] == {'SongTitle': 'T',
+                                          'version': version}
+
+
+def test_conditional_update(table):
+    table.put_item(Item={KEY: 'x', 'version': 3})
+    kwargs = dict(UpdateExpression='SET SongTitle = :t',
+                  ConditionExpression='attribute_exists(#k) AND '
+                                      '#v = :expected',
+                  ExpressionAttributeNames={'#k': KEY, '#v': 'version'})
+    table.update_item(Key={KEY: 'x'},
+                      ExpressionAttributeValues={':t': 'T', ':expected': 3},
+                      **kwargs)
+    with pytest.raises(ClientError) as e:
+        table.update_item(Key={KEY: 'x'},
+                          ExpressionAttributeValues={':t': 'U',
+                                                     ':expected': 2},
+                          **kwargs)
+    assert error_code(e) == 'ConditionalCheckFailedException'
+    assert table.get_item(Key={KEY: 'x'})['Item']['SongTitle'] == 'T'
+    with pytest.raises(ClientError) as e:
+        table.update_item(Key={KEY: 'missing'},
+                          ExpressionAttributeValues={':t': 'T',
+                                                     ':expected': 0},
+                          **kwargs)
+    assert error_code(e) == 'ConditionalCheckFailedException'
+    assert 'Item' not in table.get_item(Key={KEY: 'missing'})
+
+
+def test_conditional_put(table):
+    kwargs = dict(ConditionExpression='attribute_not_exists(#k)',
+                  ExpressionAttributeNames={'#k': KEY})
+    table.put_item(Item={KEY: 'x', 'n': 1}, **kwargs)
+    with pytest.raises(ClientError) as e:
+        table.put_item(Item={KEY: 'x', 'n': 2}, **kwargs)
+    assert error_code(e) == 'ConditionalCheckFailedException'
+    assert table.get_item(Key={KEY: 'x'})['Item']['n'] == 1
+
+
+def test_list_append_and_remove(table):
+    append = dict(
+        UpdateExpression='SET #a = list_append(if_not_exists(#a, :empty), '
+                         ':vals)',
+        ExpressionAttributeNames={'#a': 'plays'})
+    for values in (['a', 'b'], ['c']):
+        table.update_item(Key={KEY: 'x'},
+                          ExpressionAttributeValues={':empty': [],
+                                                     ':vals': values},
+                          **append)
+    assert table.get_item(Key={KEY: 'x'})['Item']['plays'] == ['a', 'b', 'c']
+    table.update_item(Key={KEY: 'x'},
+                      UpdateExpression='REMOVE #a[1]',
+                      ConditionExpression='#a[1] = :val',
+                      ExpressionAttributeNames={'#a': 'plays'},
+                      ExpressionAttributeValues={':val': 'b'})
+    assert table.get_item(Key={KEY: 'x'})['Item']['plays'] == ['a', 'c']
+
+
+def test_list_append_to_string(table):
+    """A list stored as a string, as the loader once wrote them, is
+    refused as DynamoDB refuses it."""
+    table.put_item(Item={KEY: 'x', 'plays': '[]'})
+    with pytest.raises(ClientError) as e:
+        table.update_item(Key={KEY: 'x'},
+                          UpdateExpression='SET #a = list_append(#a, :vals)',
+                          ExpressionAttributeNames={'#a': 'plays'},
+                          ExpressionAttributeValues={':vals': ['a']})
+    assert error_code(e) == 'ValidationException'
+    assert table.get_item(Key={KEY: 'x'})['Item']['plays'] == '[]'
+
+
+def test_arithmetic_on_missing(table):
+    with pytest.raises(ClientError) as e:
+        table.update_item(Key={KEY: 'x'},
+                          UpdateExpression='SET n = n + :one',
+                          ExpressionAttributeValues={':one': 1})
+    assert error_code(e) == 'ValidationException'
+
+
+def test_scan_pages(table, songs):
+    seen = []
+    kwargs = {'Limit': 3}
+    while True:
+        response = table.scan(**kwargs)
+        assert response['Count'] <= 3
+        seen.extend(item[KEY] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    assert seen == sorted(songs)
+
+
+def test_query_pages(table, songs):
+    seen = []
+    kwargs = {'Limit': 2}
+    while True:
+        response = table.query(IndexName=INDEX + '-index',
+                               KeyConditionExpression=Key(INDEX).eq('A'),
+                               **kwargs)
+        seen.extend(item[KEY] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    assert seen == [s for i, s in enumerate(songs) if i % 2]
+
+
+def test_query_sees_updates(table, songs):
+    table.update_item(Key={KEY: 's1'},
+                      UpdateExpression='SET #a = :b',
+                      ExpressionAttributeNames={'#a': INDEX},
+                      ExpressionAttributeValues={':b': 'B'})
+    response = table.query(KeyConditionExpression=Key(INDEX).eq('A'))
+    assert 's1' not in [item[KEY] for item in response['Items']]
+
+
+def test_batch_get_item(resource, songs):
+    response = resource.batch_get_item(RequestItems={
+        NAME: {'Keys': [{KEY: 's0'}, {KEY: 'missing'}, {KEY: 's3'}]}})
+    assert sorted(item[KEY] for item in response['Responses'][NAME]) == \
+        ['s0', 's3']
+    assert response['UnprocessedKeys'] == {}
+
+
+def test_concurrent_updates(table):
+    """Read-modify-write updates from many threads lose nothing."""
+    def work():
+        for _ in range(25):
+            table.update_item(
+                Key={KEY: 'x'},
+                UpdateExpression='SET ' + BUMP_VERSION,
+                ExpressionAttributeNames={'#v': 'version'},
+                ExpressionAttributeValues={':zero': 0, ':one': 1})
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert table.get_item(Key={KEY: 'x'})['Item']['version'] == 200
@@ -1,5 +1,5 @@
 """
-Create the Music and User tables
+Create the Music, User and Idempotency tables
 
 This is intended to be used within a continuous integration test.
 As such, it presumes that it is creating the tables in a local
@@ -18,8 +18,24 @@ import boto3
 
 
 # Function definitions
-def create_tables(url, region, access_key_id, secret_access_key, music, user):
-    """ Create the music and user tables in DynamoDB.
+def index(attr):
+    """ Return the definition of a global secondary index on `attr`.
+
+    The index is named '<attr>-index', the name the database service's
+    `/query` route uses, and projects every attribute.
+    """
+    return {
+        "IndexName": attr + "-index",
+        "KeySchema": [{"AttributeName": attr, "KeyType": "HASH"}],
+        "Projection": {"ProjectionType": "ALL"},
+        "ProvisionedThroughput": {
+            "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+    }
+
+
+def create_tables(url, region, access_key_id, secret_access_key, music, user,
+                  idempotency):
+    """ Create the music, user and idempotency tables in DynamoDB.
 
     Parameters
     ----------
@@ -43,6 +59,8 @@ def create_tables(url, region, access_key_id, secret_access_key, music, user):
         Name of the music table.
     user: string
         Name of the user table.
+    idempotency: string
+        Name of the database service's idempotency table.
     """
     dynamodb = boto3.resource(
         'dynamodb',
@@ -58,23 +76,38 @@ def create_tables(url, region, access_key_id, secret_access_key, music, user):
     """
     mt = dynamodb.create_table(
         TableName=music,
-        AttributeDefinitions=[{
-            "AttributeName": "music_id", "AttributeType": "S"}],
+        AttributeDefinitions=[
+            {"AttributeName": "music_id", "AttributeType": "S"},
+            {"AttributeName": "Artist", "AttributeType": "S"}],
         KeySchema=[{"AttributeName": "music_id", "KeyType": "HASH"}],
+        GlobalSecondaryIndexes=[index("Artist")],
         ProvisionedThroughput={
             "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
     )
     ut = dynamodb.create_table(
         TableName=user,
-        AttributeDefinitions=[{
-            "AttributeName": "user_id", "AttributeType": "S"}],
+        AttributeDefinitions=[
+            {"AttributeName": "user_id", "AttributeType": "S"},
+            {"AttributeName": "email", "AttributeType": "S"}],
         KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        GlobalSecondaryIndexes=[index("email")],
+        ProvisionedThroughput={
+            "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+    )
+    # The database service's records of writes made with an
+    # Idempotency-Key
+    it = dynamodb.create_table(
+        TableName=idempotency,
+        AttributeDefinitions=[{
+            "AttributeName": "idempotency_id", "AttributeType": "S"}],
+        KeySchema=[{"AttributeName": "idempotency_id", "KeyType": "HASH"}],
         ProvisionedThroughput={
             "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
     )
     """
     The order in which we wait for the tables is irrelevant.  We can only
-    proceed after both exist.
+    proceed after all exist.
     """
     mt.wait_until_exists()
     ut.wait_until_exists()
+    it.wait_until_exists()
@@ -143,7 +143,8 @@ def setup(args):
         args.secret_access_key,
         'Music-' + args.table_suffix,
         'User-' + args.table_suffix,
-        'Playlist-' + args.table_suffix
+        'Playlist-' + args.table_suffix,
+        'Idempotency-' + args.table_suffix
     )
 
 
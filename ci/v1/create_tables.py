@@ -1,5 +1,5 @@
 """
-Create the Music, User and PlayList tables
+Create the Music, User, PlayList and Idempotency tables
 
 This is intended to be used within a continuous integration test.
 As such, it presumes that it is creating the tables in a local
@@ -18,8 +18,23 @@ import boto3
 
 
 # Function definitions
+def index(attr):
+    """ Return the definition of a global secondary index on `attr`.
+
+    The index is named '<attr>-index', the name the database service's
+    `/query` route uses, and projects every attribute.
+    """
+    return {
+        "IndexName": attr + "-index",
+        "KeySchema": [{"AttributeName": attr, "KeyType": "HASH"}],
+        "Projection": {"ProjectionType": "ALL"},
+        "ProvisionedThroughput": {
+            "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+    }
+
+
 def create_tables(url, region, access_key_id,
-                  secret_access_key, music, user, playlist):
+                  secret_access_key, music, user, playlist, idempotency):
     """ Create the music and user tables in DynamoDB.
 
     Parameters
@@ -44,6 +59,10 @@ def create_tables(url, region, access_key_id,
         Name of the music table.
     user: string
         Name of the user table.
+    playlist: string
+        Name of the playlist table.
+    idempotency: string
+        Name of the database service's idempotency table.
     """
     dynamodb = boto3.resource(
         'dynamodb',
@@ -59,17 +78,21 @@ def create_tables(url, region, access_key_id,
     """
     mt = dynamodb.create_table(
         TableName=music,
-        AttributeDefinitions=[{
-            "AttributeName": "music_id", "AttributeType": "S"}],
+        AttributeDefinitions=[
+            {"AttributeName": "music_id", "AttributeType": "S"},
+            {"AttributeName": "Artist", "AttributeType": "S"}],
         KeySchema=[{"AttributeName": "music_id", "KeyType": "HASH"}],
+        GlobalSecondaryIndexes=[index("Artist")],
         ProvisionedThroughput={
             "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
     )
     ut = dynamodb.create_table(
         TableName=user,
-        AttributeDefinitions=[{
-            "AttributeName": "user_id", "AttributeType": "S"}],
+        AttributeDefinitions=[
+            {"AttributeName": "user_id", "AttributeType": "S"},
+            {"AttributeName": "email", "AttributeType": "S"}],
         KeySchema=[{"AttributeName": "user_id", "KeyType": "HASH"}],
+        GlobalSecondaryIndexes=[index("email")],
         ProvisionedThroughput={
             "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
     )
@@ -81,6 +104,16 @@ def create_tables(url, region, access_key_id,
         ProvisionedThroughput={
             "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
     )
+    # The database service's records of writes made with an
+    # Idempotency-Key
+    it = dynamodb.create_table(
+        TableName=idempotency,
+        AttributeDefinitions=[{
+            "AttributeName": "idempotency_id", "AttributeType": "S"}],
+        KeySchema=[{"AttributeName": "idempotency_id", "KeyType": "HASH"}],
+        ProvisionedThroughput={
+            "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+    )
     """
     The order in which we wait for the tables is irrelevant.  We can only
     proceed after both exist.
@@ -88,3 +121,4 @@ def create_tables(url, region, access_key_id,
     mt.wait_until_exists()
     ut.wait_until_exists()
     pt.wait_until_exists()
+    it.wait_until_exists()
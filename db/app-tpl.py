@@ -5,9 +5,15 @@ Sample application---database service.
 
 # Standard library modules
 import base64
+import collections
+import contextlib
+import hashlib
+import inspect
 import logging
 import os
 import sys
+import threading
+import time
 import urllib.parse
 import uuid
 
@@ -15,21 +21,39 @@ import uuid
 
 import boto3
 from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 from flask import Blueprint
 from flask import Flask
+from flask import has_request_context
 from flask import request
 from flask import Response
 
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import \
+    GunicornInternalPrometheusMetrics
 
 import simplejson as json
 
+# Local modules
+import sharedcache
+import storage
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+# Under gunicorn (see gunicorn.conf.py) the worker processes
+# share one set of metrics
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
 metrics.info('app_info', 'Database process')
 
 bp = Blueprint('app', __name__)
@@ -48,12 +72,68 @@ loader_token = os.getenv('SVC_LOADER_TOKEN')
 # In some testing contexts, we pass in the DynamoDB URL
 dynamodb_url = os.getenv('DYNAMODB_URL', '')
 
-if dynamodb_url == '':
+# Connections botocore keeps open to DynamoDB.  Calls beyond this
+# many at once open throwaway connections, so set it to at least
+# the number of threads serving requests.
+max_pool_connections = int(os.getenv('DYNAMODB_MAX_POOL_CONNECTIONS', '50'))
+boto_config = Config(max_pool_connections=max_pool_connections)
+
+# The object types stored by the service, one table each
+OBJTYPES = ('music', 'user', 'playlist')
+
+
+def table_name(objtype):
+    return objtype.capitalize()+"-ZZ-REG-ID"
+
+
+# The records of the writes made with an Idempotency-Key (see
+# write()) are kept in a table of their own, so that no read
+# returns them
+IDEMPOTENCY_TABLE = table_name('idempotency')
+IDEMPOTENCY_ID = 'idempotency_id'
+
+
+# The global secondary indexes `/query` may use, by objtype and
+# attribute.  They are created with the tables (see
+# ci/v1.1/create_tables.py and cluster/cloudformationdynamodb-tpl.json);
+# the sqlite driver creates an index on each attribute.
+INDEXES = {
+    ('user', 'email'): 'email-index',
+    ('music', 'Artist'): 'Artist-index',
+}
+
+
+# Where the objects are kept: 'dynamodb', 'memory' or 'sqlite'
+# (see storage.py).  The memory driver keeps every table in this
+# process and loses it on exit; it is for local runs and tests.
+# The sqlite driver keeps them in the SQLite database SQLITE_PATH.
+storage_driver = os.getenv('STORAGE_DRIVER', 'dynamodb').lower()
+sqlite_path = os.getenv('SQLITE_PATH', '/tmp/cmpt756db.sqlite')
+sqlite_synchronous = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+sqlite_pool_size = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+
+table_keys = {table_name(objtype): objtype + "_id" for objtype in OBJTYPES}
+table_keys[IDEMPOTENCY_TABLE] = IDEMPOTENCY_ID
+if storage_driver == 'memory':
+    dynamodb = storage.MemoryResource(table_keys)
+elif storage_driver == 'sqlite':
+    table_indexes = {}
+    for objtype, attr in INDEXES:
+        table_indexes.setdefault(table_name(objtype), []).append(attr)
+    dynamodb = storage.SQLiteResource(sqlite_path, table_keys,
+                                      indexes=table_indexes,
+                                      synchronous=sqlite_synchronous,
+                                      pool_size=sqlite_pool_size)
+elif storage_driver != 'dynamodb':
+    logging.error("unknown STORAGE_DRIVER {}".format(storage_driver))
+    sys.exit(-1)
+elif dynamodb_url == '':
     dynamodb = boto3.resource(
         'dynamodb',
         region_name=region,
         aws_access_key_id=access_key,
-        aws_secret_access_key=secret_access_key)
+        aws_secret_access_key=secret_access_key,
+        config=boto_config)
 else:
     # See
     # https://stackoverflow.com/questions/31948742/localhost-endpoint-to-dynamodb-local-with-boto3
@@ -62,68 +142,850 @@ else:
         endpoint_url=dynamodb_url,
         region_name=region,
         aws_access_key_id=access_key,
-        aws_secret_access_key=secret_access_key)
+        aws_secret_access_key=secret_access_key,
+        config=boto_config)
+
+# Table objects are built once.  Their methods only call the
+# resource's low-level client, which is safe to share between threads.
+tables = {objtype: dynamodb.Table(table_name(objtype))
+          for objtype in OBJTYPES}
+idempotency_table = dynamodb.Table(IDEMPOTENCY_TABLE)
+
+
+class UnknownObjtype(Exception):
+    pass
+
+
+def get_table(objtype):
+    '''Return the (Table, key attribute name) pair for `objtype`'''
+    if objtype not in tables:
+        raise UnknownObjtype(objtype)
+    return tables[objtype], objtype + "_id"
+
+
+# DynamoDB calls in progress, to show when the botocore pool is
+# too small for the load
+in_flight_lock = threading.Lock()
+in_flight = 0
+# 'livesum' adds up the processes' values when running under gunicorn
+Gauge('dynamodb_pool_size', 'Connections in the botocore pool',
+      registry=metrics.registry,
+      multiprocess_mode='livesum').set(max_pool_connections)
+in_flight_gauge = Gauge('dynamodb_calls_in_flight',
+                        'DynamoDB calls in progress',
+                        registry=metrics.registry,
+                        multiprocess_mode='livesum')
+pool_saturated = Counter(
+    'dynamodb_pool_saturated',
+    'DynamoDB calls started while every pooled connection was busy',
+    registry=metrics.registry)
+
+
+# Finer than the default buckets at the low end, where most calls are
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+dynamodb_duration = Histogram(
+    'dynamodb_call_duration_seconds',
+    'Duration of DynamoDB calls',
+    ['table', 'operation', 'outcome'],
+    buckets=LATENCY_BUCKETS,
+    registry=metrics.registry)
+# Older prometheus_client releases cannot attach exemplars
+EXEMPLARS = 'exemplar' in inspect.signature(Histogram.observe).parameters
+
+
+@contextlib.contextmanager
+def dynamodb_call(table, operation):
+    '''
+    Wrap every call to DynamoDB, to track use of the connection pool
+    and time the call
+
+    `table` is the name of the table, or the names of the tables
+    joined by ',', and `operation` is the DynamoDB operation.  The
+    `outcome` label is 'ok' or DynamoDB's error code.  The trace id
+    of the request being served, if any, is attached as an exemplar.
+    '''
+    global in_flight
+    with in_flight_lock:
+        if in_flight >= max_pool_connections:
+            pool_saturated.inc()
+        in_flight += 1
+    in_flight_gauge.inc()
+    outcome = 'error'
+    start = time.perf_counter()
+    try:
+        yield
+        outcome = 'ok'
+    except ClientError as e:
+        outcome = e.response['Error']['Code']
+        raise
+    finally:
+        histogram = dynamodb_duration.labels(table, operation, outcome)
+        trace_id = request.headers.get('x-b3-traceid') \
+            if has_request_context() else None
+        if trace_id and EXEMPLARS:
+            histogram.observe(time.perf_counter() - start,
+                              {'trace_id': trace_id})
+        else:
+            histogram.observe(time.perf_counter() - start)
+        in_flight_gauge.dec()
+        with in_flight_lock:
+            in_flight -= 1
+
+
+def error_response(status, reason):
+    '''Return a JSON error response in the style of `/load`'''
+    return Response(
+        json.dumps({"http_status_code": status, "reason": reason}),
+        status=status,
+        mimetype='application/json')
+
+
+def is_conditional_failure(e):
+    return e.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+@bp.errorhandler(UnknownObjtype)
+def unknown_objtype(e):
+    return error_response(400, "Unknown objtype {}".format(e))
+
+
+# Every update adds one to this attribute of the object.  Objects
+# never updated have no version attribute, which counts as version 0.
+VERSION_ATTR = 'version'
+BUMP_VERSION = '#v = if_not_exists(#v, :zero) + :one'
+BUMP_VALUES = {':zero': 0, ':one': 1}
+
+
+def version_conflict(table, table_id, objkey):
+    '''Return the 409 (or, if the object is gone, 404) response
+    for a failed expected_version condition'''
+    with dynamodb_call(table.name, 'GetItem'):
+        item = table.get_item(Key={table_id: objkey},
+                              ConsistentRead=True).get('Item')
+    if item is None:
+        return error_response(404, "No such object")
+    return Response(
+        json.dumps({"http_status_code": 409,
+                    "reason": "Version conflict",
+                    "Item": item}),
+        status=409,
+        mimetype='application/json')
 
 
-# Change the implementation of this: you should probably have a separate
-# driver class for interfacing with a db like dynamodb in a different file.
 @bp.route('/update', methods=['PUT'])
 def update():
+    '''
+    Set attributes of an object
+
+    Query parameters are `objtype`, `objkey` and, optionally,
+    `expected_version`, `exists` and `return_values`.  The body maps
+    attribute names to values.  The object's version attribute is
+    increased by one.
+
+    With `expected_version`, the update only succeeds if the object
+    exists and is still at that version.  Otherwise the response is
+    409 with the current object in `Item`, from which the caller can
+    redo its change and try again.
+
+    With `exists=true`, the update is refused with a 404 rather than
+    creating a missing object.  `return_values` is passed to DynamoDB
+    as `ReturnValues`; with UPDATED_NEW, for example, the response's
+    `Attributes` hold the new values of the updated attributes.
+    '''
     headers = request.headers  # noqa: F841
     # check header here
     content = request.get_json()
     objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
     objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
-    table_name = objtype.capitalize()+"-ZZ-REG-ID"
-    table_id = objtype + "_id"
-    table = dynamodb.Table(table_name)
+    expected = request.args.get('expected_version')
+    must_exist = request.args.get('exists', '').lower() in ('1', 'true')
+    return_values = request.args.get('return_values')
+    table, table_id = get_table(objtype)
     expression = 'SET '
     x = 1
-    attrvals = {}
+    attrvals = dict(BUMP_VALUES)
     for k in content.keys():
+        if k == VERSION_ATTR:
+            continue
         expression += k + ' = :val' + str(x) + ', '
         attrvals[':val' + str(x)] = content[k]
         x += 1
-    expression = expression[:-2]
-    response = table.update_item(Key={table_id: objkey},
-                                 UpdateExpression=expression,
-                                 ExpressionAttributeValues=attrvals)
+    expression += BUMP_VERSION
+    kwargs = {'Key': {table_id: objkey},
+              'UpdateExpression': expression,
+              'ExpressionAttributeNames': {'#v': VERSION_ATTR},
+              'ExpressionAttributeValues': attrvals}
+    if expected is not None:
+        try:
+            attrvals[':expected'] = int(expected)
+        except ValueError:
+            return error_response(400, "Bad expected_version")
+        kwargs['ExpressionAttributeNames']['#k'] = table_id
+        kwargs['ConditionExpression'] = (
+            'attribute_exists(#k) AND (#v = :expected' +
+            (' OR attribute_not_exists(#v))' if attrvals[':expected'] == 0
+             else ')'))
+    elif must_exist:
+        kwargs['ExpressionAttributeNames']['#k'] = table_id
+        kwargs['ConditionExpression'] = 'attribute_exists(#k)'
+    if return_values:
+        kwargs['ReturnValues'] = return_values
+    try:
+        with dynamodb_call(table.name, 'UpdateItem'):
+            response = table.update_item(**kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ValidationException':
+            return error_response(400, e.response['Error'].get('Message', ''))
+        if not is_conditional_failure(e):
+            raise
+        if expected is None:
+            return error_response(404, "No such object")
+        return version_conflict(table, table_id, objkey)
+    forget_reads(objtype, objkey)
     return response
 
 
+@bp.route('/list_append', methods=['PUT'])
+def list_append():
+    '''
+    Append values to a list attribute in a single UpdateItem
+
+    Query parameters are `objtype` and `objkey`; the body is
+    {"attr": <list attribute>, "values": [<value>, ...]}.
+    A missing attribute is treated as an empty list.  Returns
+    400 if `values` is not a list and 404 if the object does not
+    exist.  Like `/update`, this adds one to the object's version.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    content = request.get_json()
+    objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
+    objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
+    try:
+        attr = content['attr']
+        values = content['values']
+    except (KeyError, TypeError):
+        return error_response(400, "Missing attr/values")
+    if not isinstance(values, list):
+        return error_response(400, "values must be a list")
+    table, table_id = get_table(objtype)
+    try:
+        with dynamodb_call(table.name, 'UpdateItem'):
+            response = table.update_item(
+                Key={table_id: objkey},
+                UpdateExpression='SET #a = list_append('
+                                 'if_not_exists(#a, :empty), :vals), ' +
+                                 BUMP_VERSION,
+                ConditionExpression='attribute_exists(#k)',
+                ExpressionAttributeNames={'#a': attr, '#k': table_id,
+                                          '#v': VERSION_ATTR},
+                ExpressionAttributeValues=dict(BUMP_VALUES, **{
+                    ':empty': [], ':vals': values}))
+    except ClientError as e:
+        if is_conditional_failure(e):
+            return error_response(404, "No such object")
+        return error_response(400, e.response['Error'].get('Message', ''))
+    forget_reads(objtype, objkey)
+    return response
+
+
+# Attempts to remove a list element before giving up because
+# other writers keep moving it
+LIST_REMOVE_ATTEMPTS = 5
+
+
+def is_list_index(index):
+    '''Return True if `index`, from a JSON body, can index a list'''
+    # bool is a subclass of int, but true is not an index
+    return isinstance(index, int) and not isinstance(index, bool) and \
+        index >= 0
+
+
+@bp.route('/list_remove', methods=['PUT'])
+def list_remove():
+    '''
+    Remove one element from a list attribute
+
+    Query parameters are `objtype` and `objkey`; the body is
+    {"attr": <list attribute>, "value": <value>, "index": <int>}.
+    The element at `index` is removed by a single UpdateItem that is
+    conditional on that element still equalling `value`, so a
+    concurrent change can never cause the wrong element to be removed.
+
+    `index` is optional, and if given must be a non-negative integer
+    or the response is 400.  Without it, the first element equal to
+    `value` is located with a projected GetItem, and the removal is
+    retried if the list changes in between.  Returns 404 if the
+    object does not exist or `value` is not in the list and 409 if
+    the element at `index` is not `value`.  A removal adds one to
+    the object's version.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    content = request.get_json()
+    objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
+    objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
+    try:
+        attr = content['attr']
+        value = content['value']
+        index = content.get('index')
+    except (KeyError, TypeError):
+        return error_response(400, "Missing attr/value")
+    if index is not None and not is_list_index(index):
+        return error_response(400, "index must be a non-negative integer")
+    table, table_id = get_table(objtype)
+    for _ in range(LIST_REMOVE_ATTEMPTS):
+        i = index
+        if i is None:
+            with dynamodb_call(table.name, 'GetItem'):
+                item = table.get_item(Key={table_id: objkey},
+                                      ProjectionExpression='#a',
+                                      ExpressionAttributeNames={'#a': attr},
+                                      ConsistentRead=True).get('Item')
+            values = item.get(attr) if item is not None else None
+            if not isinstance(values, list) or value not in values:
+                return error_response(404, "No such element")
+            i = values.index(value)
+        try:
+            with dynamodb_call(table.name, 'UpdateItem'):
+                response = table.update_item(
+                    Key={table_id: objkey},
+                    UpdateExpression='REMOVE #a[{}] SET {}'.format(
+                        i, BUMP_VERSION),
+                    ConditionExpression='#a[{}] = :val'.format(i),
+                    ExpressionAttributeNames={'#a': attr,
+                                              '#v': VERSION_ATTR},
+                    ExpressionAttributeValues=dict(BUMP_VALUES,
+                                                   **{':val': value}))
+            forget_reads(objtype, objkey)
+            return response
+        except ClientError as e:
+            if not is_conditional_failure(e):
+                return error_response(400,
+                                      e.response['Error'].get('Message', ''))
+            if index is not None:
+                return error_response(409, "Element has changed")
+    return error_response(409, "List kept changing")
+
+
+# Objects are also kept in a Redis-protocol server shared by every
+# replica of the service (see sharedcache.py) if DB_CACHE_URL is set:
+# redis://host:port/db, or fake:// for an in-process stand-in.
+DB_CACHE_URL = os.getenv('DB_CACHE_URL', '')
+shared_cache = None
+if DB_CACHE_URL:
+    shared_cache = sharedcache.SharedCache(
+        sharedcache.connect(DB_CACHE_URL,
+                            float(os.getenv('DB_CACHE_TIMEOUT_SEC', '0.05'))),
+        os.getenv('DB_CACHE_PREFIX', 'cmpt756db-ZZ-REG-ID'),
+        float(os.getenv('DB_CACHE_TTL_SEC', '60')),
+        ttls=sharedcache.objtype_ttls(os.getenv('DB_CACHE_TTLS', '')),
+        tombstone_ttl=float(os.getenv('DB_CACHE_TOMBSTONE_SEC', '2')),
+        registry=metrics.registry)
+
+
+def get_item(objtype, objkey, fields, table, kwargs):
+    '''
+    Return the GetItem response for `kwargs`, by way of the shared
+    cache if there is one
+
+    An eventually consistent read is answered from the cache if it
+    holds the object, keeping only `fields`, if given.  A whole object
+    read from the table is put in the cache.
+    '''
+    if shared_cache is not None and not kwargs.get('ConsistentRead'):
+        item = shared_cache.get(objtype, objkey)
+        if item is not None:
+            if fields:
+                item = {k: v for k, v in item.items() if k in fields}
+            return {'Item': item, 'ResponseMetadata': {'HTTPStatusCode': 200}}
+    with dynamodb_call(table.name, 'GetItem'):
+        response = table.get_item(**kwargs)
+    if shared_cache is not None and not fields and 'Item' in response:
+        shared_cache.put(objtype, objkey, response['Item'])
+    return response
+
+
+# Concurrent `/read`s of the same object share one GetItem: the
+# first makes the call and the others wait for its result.  With
+# READ_CACHE_TTL_SEC above 0, each result is also kept that long and
+# reads within it make no call at all.  Both are per process and
+# only for eventually consistent reads; a change made through this
+# process drops what it holds for the object.
+READ_COALESCING = os.getenv('READ_COALESCING', 'true').lower() in (
+    '1', 'true')
+READ_CACHE_TTL_SEC = float(os.getenv('READ_CACHE_TTL_SEC', '0'))
+READ_CACHE_SIZE = int(os.getenv('READ_CACHE_SIZE', '10000'))
+read_lock = threading.Lock()
+# (objtype, objkey) -> {fields: ReadFlight}
+read_flights = {}
+# (objtype, objkey) -> {fields: (expiry time, GetItem response)}
+read_cache = collections.OrderedDict()
+reads_coalesced = Counter(
+    'read_coalesced',
+    'Reads answered without a DynamoDB call of their own',
+    ['source'],
+    registry=metrics.registry)
+
+
+class ReadFlight():
+    '''A GetItem in progress, whose result every read of the same
+    object and fields waits for'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def shared_get_item(objtype, objkey, fields, table, kwargs):
+    '''
+    Return the GetItem response for `kwargs`, joining a call already
+    in progress for the same object and `fields`, or using a cached
+    response, if there is one
+    '''
+    key = (objtype, objkey)
+    with read_lock:
+        cached = read_cache.get(key, {}).get(fields)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                read_cache.move_to_end(key)
+                reads_coalesced.labels('cache').inc()
+                return cached[1]
+            del read_cache[key][fields]
+        flight = read_flights.get(key, {}).get(fields)
+        leader = flight is None
+        if leader:
+            flight = read_flights.setdefault(key, {})[fields] = ReadFlight()
+    if not leader:
+        reads_coalesced.labels('flight').inc()
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.response
+    try:
+        flight.response = get_item(objtype, objkey, fields, table, kwargs)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with read_lock:
+            flights = read_flights.get(key, {})
+            # Unless forget_reads() has dropped the flight since
+            if flights.get(fields) is flight:
+                del flights[fields]
+                if not flights:
+                    del read_flights[key]
+                if flight.error is None and READ_CACHE_TTL_SEC > 0:
+                    read_cache.setdefault(key, {})[fields] = (
+                        time.monotonic() + READ_CACHE_TTL_SEC,
+                        flight.response)
+                    read_cache.move_to_end(key)
+                    while len(read_cache) > READ_CACHE_SIZE:
+                        read_cache.popitem(last=False)
+        flight.done.set()
+    return flight.response
+
+
+def forget_reads(objtype, *objkeys):
+    '''
+    Drop the cached responses and the calls in progress for objects
+    that have just changed, and invalidate them in the shared cache,
+    so later reads see the change
+    '''
+    with read_lock:
+        for objkey in objkeys:
+            read_cache.pop((objtype, objkey), None)
+            read_flights.pop((objtype, objkey), None)
+    if shared_cache is not None:
+        shared_cache.invalidate(objtype, *objkeys)
+
+
 @bp.route('/read', methods=['GET'])
 def read():
+    '''
+    Read a single object by key
+
+    Optional query parameters:
+    fields: comma-separated list of attributes to return.  The key
+        attribute is always included.  Default is all attributes.
+    consistent: 'true' for a strongly consistent read.
+
+    Eventually consistent reads of the same object and fields made at
+    the same time share one GetItem (see shared_get_item()).
+
+    The response keeps the {Count, Items} shape of a query, with
+    Count 0 and an empty Items list if the key does not exist.
+    '''
     headers = request.headers  # noqa: F841
     # check header here
     objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
     objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
-    table_name = objtype.capitalize()+"-ZZ-REG-ID"
-    table_id = objtype + "_id"
-    table = dynamodb.Table(table_name)
-    response = table.query(Select='ALL_ATTRIBUTES',
-                           KeyConditionExpression=Key(table_id).eq(objkey))
-    return response
+    table, table_id = get_table(objtype)
+    consistent = request.args.get('consistent', '').lower() in ('1', 'true')
+    kwargs = {'Key': {table_id: objkey}, 'ConsistentRead': consistent}
+    fields = request.args.get('fields')
+    names = None
+    if fields:
+        names = [table_id] + [f for f in fields.split(',')
+                              if f and f != table_id]
+        placeholders = ['#f' + str(i) for i in range(len(names))]
+        kwargs['ProjectionExpression'] = ', '.join(placeholders)
+        kwargs['ExpressionAttributeNames'] = dict(zip(placeholders, names))
+    names = tuple(names) if names else None
+    if READ_COALESCING and not consistent:
+        response = shared_get_item(objtype, objkey, names, table, kwargs)
+    else:
+        response = get_item(objtype, objkey, names, table, kwargs)
+    items = [response['Item']] if 'Item' in response else []
+    return {"Count": len(items),
+            "Items": items,
+            "ScannedCount": len(items),
+            "ResponseMetadata": response['ResponseMetadata']}
+
+
+# Page size limits for `/scan`
+SCAN_DEFAULT_LIMIT = 100
+SCAN_MAX_LIMIT = 1000
+
+
+def encode_cursor(last_key):
+    '''Turn a LastEvaluatedKey into an opaque, URL-safe cursor'''
+    return base64.urlsafe_b64encode(json.dumps(last_key).encode()).decode()
+
+
+def decode_cursor(cursor, attrs):
+    '''
+    Turn a cursor from encode_cursor() back into an ExclusiveStartKey
+
+    Raises ValueError unless `cursor` decodes to a key, an object
+    holding a string for each of the attributes `attrs` and nothing
+    else.  DynamoDB would refuse any other ExclusiveStartKey.
+    '''
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    if not isinstance(key, dict) or set(key) != set(attrs) or \
+            not all(isinstance(v, str) for v in key.values()):
+        raise ValueError("Not a key: {}".format(cursor))
+    return key
+
+
+@bp.route('/scan', methods=['GET'])
+def scan():
+    '''
+    List one page of the objects of type `objtype`
+
+    Query parameters are `objtype`, `limit` (default 100, at most 1000)
+    and `cursor`, the `Cursor` value of the previous page.  The response
+    is {Count, Items, Cursor}; `Cursor` is null on the last page.
+    Following the cursors visits every object exactly once.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
+    table, table_id = get_table(objtype)
+    try:
+        limit = int(request.args.get('limit', SCAN_DEFAULT_LIMIT))
+        kwargs = {'Limit': max(1, min(limit, SCAN_MAX_LIMIT))}
+        cursor = request.args.get('cursor')
+        if cursor:
+            kwargs['ExclusiveStartKey'] = decode_cursor(cursor, [table_id])
+    except ValueError:
+        return error_response(400, "Invalid limit or cursor")
+    with dynamodb_call(table.name, 'Scan'):
+        response = table.scan(**kwargs)
+    last_key = response.get('LastEvaluatedKey')
+    return {"Count": response['Count'],
+            "Items": response['Items'],
+            "Cursor": encode_cursor(last_key) if last_key else None}
+
+
+@bp.route('/query', methods=['GET'])
+def query():
+    '''
+    List one page of the objects of type `objtype` whose attribute
+    `index` equals `value`
+
+    The lookup uses the global secondary index on `index`, so it
+    reads only the matching objects.  `limit` and `cursor` page
+    through the results as in `/scan`, and the response has the
+    same {Count, Items, Cursor} shape.  Returns 400 if there is no
+    index on `index`.  Index reads are eventually consistent.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    objtype = request.args.get('objtype')
+    attr = request.args.get('index')
+    value = request.args.get('value')
+    table, table_id = get_table(objtype)
+    if (objtype, attr) not in INDEXES:
+        return error_response(400, "No index on {}".format(attr))
+    if value is None:
+        return error_response(400, "Missing value")
+    try:
+        limit = int(request.args.get('limit', SCAN_DEFAULT_LIMIT))
+        kwargs = {'IndexName': INDEXES[(objtype, attr)],
+                  'KeyConditionExpression': Key(attr).eq(value),
+                  'Limit': max(1, min(limit, SCAN_MAX_LIMIT))}
+        cursor = request.args.get('cursor')
+        if cursor:
+            kwargs['ExclusiveStartKey'] = decode_cursor(cursor,
+                                                        [table_id, attr])
+    except ValueError:
+        return error_response(400, "Invalid limit or cursor")
+    with dynamodb_call(table.name, 'Query'):
+        response = table.query(**kwargs)
+    last_key = response.get('LastEvaluatedKey')
+    return {"Count": response['Count'],
+            "Items": response['Items'],
+            "Cursor": encode_cursor(last_key) if last_key else None}
+
+
+# DynamoDB rejects a BatchGetItem call with more than 100 keys
+BATCH_READ_MAX_KEYS = 100
+# Retry schedule for keys DynamoDB returns as unprocessed
+BATCH_READ_MAX_RETRIES = int(os.getenv('BATCH_READ_MAX_RETRIES', '5'))
+BATCH_READ_BACKOFF_SEC = float(os.getenv('BATCH_READ_BACKOFF_SEC', '0.05'))
+
+
+def batch_get(keys):
+    '''
+    Fetch a list of (objtype, objkey) pairs using BatchGetItem
+
+    Duplicate keys are requested only once.  Keys held by the shared
+    cache, if there is one, are read from it in one pipelined call and
+    the items read from the table are put in it.  The other keys are
+    sent in chunks of BATCH_READ_MAX_KEYS and any UnprocessedKeys are
+    retried with exponential backoff.
+
+    Returns a pair (found, unprocessed). `found` is a dict mapping
+    (objtype, objkey) to the item and `unprocessed` is the list of
+    pairs that could not be read after all the retries.
+    '''
+    unique = list(dict.fromkeys(keys))
+    found = shared_cache.get_many(unique) if shared_cache else {}
+    unique = [key for key in unique if key not in found]
+    unprocessed = []
+    for start in range(0, len(unique), BATCH_READ_MAX_KEYS):
+        request_items = {}
+        objtypes = {}
+        for objtype, objkey in unique[start:start + BATCH_READ_MAX_KEYS]:
+            table, table_id = get_table(objtype)
+            objtypes[table.name] = objtype
+            request_items.setdefault(
+                table.name, {'Keys': []})['Keys'].append({table_id: objkey})
+        attempt = 0
+        while request_items:
+            with dynamodb_call(','.join(sorted(request_items)),
+                               'BatchGetItem'):
+                response = dynamodb.batch_get_item(
+                    RequestItems=request_items)
+            for name, items in response['Responses'].items():
+                objtype = objtypes[name]
+                table_id = objtype + "_id"
+                for item in items:
+                    found[(objtype, item[table_id])] = item
+            request_items = response.get('UnprocessedKeys', {})
+            if not request_items:
+                break
+            if attempt >= BATCH_READ_MAX_RETRIES:
+                for name, req in request_items.items():
+                    objtype = objtypes[name]
+                    table_id = objtype + "_id"
+                    unprocessed.extend(
+                        (objtype, k[table_id]) for k in req['Keys'])
+                break
+            time.sleep(BATCH_READ_BACKOFF_SEC * (2 ** attempt))
+            attempt += 1
+    if shared_cache is not None:
+        shared_cache.put_many({key: found[key] for key in unique
+                               if key in found})
+    return found, unprocessed
+
+
+@bp.route('/batch_read', methods=['POST'])
+def batch_read():
+    '''
+    Read many objects in as few DynamoDB calls as possible
+
+    The body is either
+        {"objtype": "music", "objkeys": ["id1", "id2", ...]}
+    or a mixed list of pairs
+        {"keys": [{"objtype": "music", "objkey": "id1"}, ...]}
+
+    The response keeps the {Count, Items} shape of `/read`, with
+    Items in request order.  Keys that do not exist are listed
+    in `Missing` and keys DynamoDB would not process in `Unprocessed`.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    content = request.get_json()
+    try:
+        if 'keys' in content:
+            keys = [(k['objtype'], k['objkey']) for k in content['keys']]
+        else:
+            keys = [(content['objtype'], k) for k in content['objkeys']]
+    except (KeyError, TypeError):
+        return error_response(400, "Missing objtype/objkeys")
+    found, unprocessed = batch_get(keys)
+    skipped = set(unprocessed)
+    items = []
+    missing = []
+    for key in keys:
+        if key in found:
+            items.append(found[key])
+        elif key not in skipped:
+            missing.append({"objtype": key[0], "objkey": key[1]})
+    return {"Count": len(items),
+            "Items": items,
+            "Missing": missing,
+            "Unprocessed": [{"objtype": t, "objkey": k}
+                            for t, k in unprocessed]}
+
+
+# Responses to `/write` calls carrying an Idempotency-Key, replayed
+# when the same key is presented again
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_TTL_SEC = float(os.getenv('IDEMPOTENCY_TTL_SEC', '86400'))
+# Object keys derived from an Idempotency-Key are in this namespace
+IDEMPOTENCY_NAMESPACE = uuid.UUID('6f1d3c52-8f0e-4c1b-9a57-2d8e4b7c9a10')
+# Attributes of an IDEMPOTENCY_TABLE record: the fingerprint of the
+# request that claimed the key, and when the claim lapses, in seconds
+# since the epoch (the table's DynamoDB TTL attribute)
+IDEMPOTENCY_FINGERPRINT = 'fingerprint'
+IDEMPOTENCY_EXPIRES = 'expires_at'
+idempotency_lock = threading.Lock()
+# (objtype, key) -> (request fingerprint, expiry time, response body)
+idempotency_cache = collections.OrderedDict()
+write_replays = Counter(
+    'write_idempotent_replays',
+    'Writes answered with the key created by an earlier call',
+    ['source'],
+    registry=metrics.registry)
+
+
+def remembered_write(cache_key):
+    with idempotency_lock:
+        entry = idempotency_cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del idempotency_cache[cache_key]
+            return None
+        idempotency_cache.move_to_end(cache_key)
+        return entry
+
+
+def remember_write(cache_key, fingerprint, body):
+    with idempotency_lock:
+        idempotency_cache[cache_key] = (
+            fingerprint, time.time() + IDEMPOTENCY_TTL_SEC, body)
+        idempotency_cache.move_to_end(cache_key)
+        while len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+            idempotency_cache.popitem(last=False)
+
+
+def claim_idempotency_key(objkey, fingerprint):
+    """
+    Record in IDEMPOTENCY_TABLE that the request with `fingerprint`
+    creates `objkey`, the key derived from its Idempotency-Key.
+    Return False if a different request has claimed it in the last
+    IDEMPOTENCY_TTL_SEC.  The same request may claim it again.
+    """
+    now = int(time.time())
+    try:
+        with dynamodb_call(IDEMPOTENCY_TABLE, 'PutItem'):
+            idempotency_table.put_item(
+                Item={IDEMPOTENCY_ID: objkey,
+                      IDEMPOTENCY_FINGERPRINT: fingerprint,
+                      IDEMPOTENCY_EXPIRES: now + int(IDEMPOTENCY_TTL_SEC)},
+                ConditionExpression='attribute_not_exists(#k) OR '
+                                    '#f = :f OR #e <= :now',
+                ExpressionAttributeNames={'#k': IDEMPOTENCY_ID,
+                                          '#f': IDEMPOTENCY_FINGERPRINT,
+                                          '#e': IDEMPOTENCY_EXPIRES},
+                ExpressionAttributeValues={':f': fingerprint, ':now': now})
+    except ClientError as e:
+        if not is_conditional_failure(e):
+            raise
+        return False
+    return True
+
+
+def replayed_write(body):
+    return Response(body,
+                    status=200,
+                    mimetype='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
 
 
 @bp.route('/write', methods=['POST'])
 def write():
-    headers = request.headers  # noqa: F841
+    """
+    Create an object, returning its new key.
+
+    If the call carries an Idempotency-Key header, the object's key
+    is derived from it and the put is conditional on the key being
+    new, so repeating the call cannot create a second object.  A
+    repeat is answered from a cache of recent responses or, failing
+    that, from the conditional put finding the object, with the
+    header 'Idempotent-Replayed: true'.  Before the put, the key is
+    claimed in IDEMPOTENCY_TABLE with a fingerprint of the request
+    (see claim_idempotency_key()), so presenting the Idempotency-Key
+    with a different body is refused with a 422, whether or not the
+    first response is still cached.
+    """
+    headers = request.headers
     # check header here
     content = request.get_json()
-    table_name = content['objtype'].capitalize()+"-ZZ-REG-ID"
     objtype = content['objtype']
-    table_id = objtype + "_id"
-    payload = {table_id: str(uuid.uuid4())}
+    table, table_id = get_table(objtype)
+    idempotency_key = headers.get('Idempotency-Key')
+    if idempotency_key:
+        cache_key = (objtype, idempotency_key)
+        fingerprint = hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode()).hexdigest()
+        remembered = remembered_write(cache_key)
+        if remembered is not None:
+            if remembered[0] != fingerprint:
+                return error_response(
+                    422, "Idempotency-Key reused with a different request")
+            write_replays.labels('cache').inc()
+            return replayed_write(remembered[2])
+        objkey = str(uuid.uuid5(IDEMPOTENCY_NAMESPACE,
+                                objtype + ':' + idempotency_key))
+    else:
+        objkey = str(uuid.uuid4())
+    payload = {table_id: objkey}
     del content['objtype']
     for k in content.keys():
         payload[k] = content[k]
-    table = dynamodb.Table(table_name)
-    response = table.put_item(Item=payload)
-    returnval = ''
-    if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        returnval = {"message": "fail"}
-    return json.dumps(
-        ({table_id: payload[table_id]}, returnval)['returnval' in globals()])
+    body = json.dumps({table_id: objkey})
+    if not idempotency_key:
+        with dynamodb_call(table.name, 'PutItem'):
+            table.put_item(Item=payload)
+        return body
+    if not claim_idempotency_key(objkey, fingerprint):
+        return error_response(
+            422, "Idempotency-Key reused with a different request")
+    try:
+        with dynamodb_call(table.name, 'PutItem'):
+            table.put_item(
+                Item=payload,
+                ConditionExpression='attribute_not_exists(#k)',
+                ExpressionAttributeNames={'#k': table_id})
+    except ClientError as e:
+        if not is_conditional_failure(e):
+            raise
+        # An earlier call with this key and body, perhaps served by
+        # another process, created the object
+        remember_write(cache_key, fingerprint, body)
+        write_replays.labels('table').inc()
+        return replayed_write(body)
+    # A read may have found the derived key missing
+    forget_reads(objtype, objkey)
+    remember_write(cache_key, fingerprint, body)
+    return body
 
 
 def decode_auth_token(token):
@@ -172,32 +1034,131 @@ def load():
     content = request.get_json()
     if 'uuid' not in content:
         return json.dumps({"http_status_code": 400, "reason": 'Missing uuid'})
-    table_name = content['objtype'].capitalize()+"-ZZ-REG-ID"
     objtype = content['objtype']
-    table_id = objtype + "_id"
+    table, table_id = get_table(objtype)
     payload = {table_id: content['uuid']}
     del content['objtype']
     del content['uuid']
     for k in content.keys():
         payload[k] = content[k]
-    table = dynamodb.Table(table_name)
-    response = table.put_item(Item=payload)
+    with dynamodb_call(table.name, 'PutItem'):
+        response = table.put_item(Item=payload)
+    forget_reads(objtype, payload[table_id])
     status = response['ResponseMetadata']['HTTPStatusCode']
     if status != 200:
         return json.dumps({"http_status_code": status})
     return json.dumps({table_id: payload[table_id]})
 
 
+def batch_put(objects, use_uuid):
+    '''
+    Write a list of objects, possibly of mixed objtypes
+
+    Each object is written to the table for its `objtype`.  If
+    `use_uuid` is True the object must carry its key in `uuid`
+    (as for `/load`), otherwise a new UUID is generated (as for
+    `/write`).  The writes for each table go through
+    `Table.batch_writer()`, which sends chunks of 25 items and
+    resends any unprocessed items.
+
+    Returns a list, in request order, holding either
+    {<objtype>_id: key} or {"error": reason} for each object.
+    '''
+    results = [None] * len(objects)
+    by_objtype = {}
+    for i, obj in enumerate(objects):
+        if not isinstance(obj, dict) or 'objtype' not in obj:
+            results[i] = {"error": "Missing objtype"}
+            continue
+        if obj['objtype'] not in tables:
+            results[i] = {"error": "Unknown objtype"}
+            continue
+        if use_uuid and 'uuid' not in obj:
+            results[i] = {"error": "Missing uuid"}
+            continue
+        objtype = obj['objtype']
+        table_id = objtype + "_id"
+        objkey = obj['uuid'] if use_uuid else str(uuid.uuid4())
+        payload = {table_id: objkey}
+        for k in obj.keys():
+            if k not in ('objtype', 'uuid'):
+                payload[k] = obj[k]
+        by_objtype.setdefault(objtype, []).append((i, payload))
+
+    for objtype, entries in by_objtype.items():
+        table, table_id = get_table(objtype)
+        try:
+            # overwrite_by_pkeys drops duplicate keys within one chunk,
+            # which DynamoDB would otherwise reject
+            with dynamodb_call(table.name, 'BatchWriteItem'), \
+                    table.batch_writer(overwrite_by_pkeys=[table_id]) as batch:
+                for _, payload in entries:
+                    batch.put_item(Item=payload)
+        except ClientError as e:
+            reason = e.response['Error'].get('Message', str(e))
+            for i, _ in entries:
+                results[i] = {"error": reason}
+            continue
+        forget_reads(objtype, *[payload[table_id] for _, payload in entries])
+        for i, payload in entries:
+            results[i] = {table_id: payload[table_id]}
+    return results
+
+
+def batch_response(content, use_uuid):
+    '''Common body of `/batch_write` and `/batch_load`'''
+    objects = content.get('objects') if isinstance(content, dict) else None
+    if not isinstance(objects, list):
+        return error_response(400, "Missing objects list")
+    results = batch_put(objects, use_uuid)
+    errors = sum(1 for r in results if 'error' in r)
+    return {"Count": len(results) - errors,
+            "Errors": errors,
+            "Items": results}
+
+
+@bp.route('/batch_write', methods=['POST'])
+def batch_write():
+    '''
+    Write many new objects in one call
+
+    The body is {"objects": [{"objtype": ..., <attributes>}, ...]}.
+    Every object gets a new UUID, as with `/write`.
+    '''
+    headers = request.headers  # noqa: F841
+    # check header here
+    return batch_response(request.get_json(), False)
+
+
+@bp.route('/batch_load', methods=['POST'])
+def batch_load():
+    '''
+    Load many objects in one call
+
+    The body is {"objects": [{"objtype": ..., "uuid": ..., ...}, ...]}.
+    As with `/load`, every object must carry its `uuid` and the
+    caller must pass the loader authorization.
+    '''
+    headers = request.headers
+    if not load_auth(headers):
+        return Response(
+            json.dumps({"http_status_code": 401,
+                        "reason": "Invalid authorization for /batch_load"}),
+            status=401,
+            mimetype='application/json')
+    return batch_response(request.get_json(), True)
+
+
 @bp.route('/delete', methods=['DELETE'])
 def delete():
     headers = request.headers  # noqa: F841
     # check header here
     objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
     objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
-    table_name = objtype.capitalize()+"-ZZ-REG-ID"
-    table_id = objtype + "_id"
-    table = dynamodb.Table(table_name)
-    response = table.delete_item(Key={table_id: objkey})
+    table, table_id = get_table(objtype)
+    with dynamodb_call(table.name, 'DeleteItem'):
+        response = table.delete_item(Key={table_id: objkey})
+    forget_reads(objtype, objkey)
     return response
 
 
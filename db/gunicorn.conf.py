@@ -0,0 +1,61 @@
+"""
+SFU CMPT 756
+Gunicorn settings for running a service in production mode.
+
+Each service directory holds an identical copy of this file.
+Run with
+
+    gunicorn --config gunicorn.conf.py app:app
+
+Environment variables
+---------------------
+PORT: int
+    Port to listen on.
+GUNICORN_WORKERS: int
+    Worker processes (default 2).
+GUNICORN_THREADS: int
+    Threads per worker (default 8).  Keep the services' DB_POOL_SIZE
+    and the db service's DYNAMODB_MAX_POOL_CONNECTIONS at least this
+    large.
+GUNICORN_WORKER_CLASS: string
+    'gthread' (default) or 'gevent', if gevent is installed.
+GUNICORN_KEEPALIVE: int
+    Seconds to hold an idle keep-alive connection (default 75,
+    longer than the Envoy sidecar's idle timeout so the proxy,
+    not the server, closes idle connections).
+GUNICORN_TIMEOUT: int
+    Seconds before a silent worker is restarted (default 30).
+PROMETHEUS_MULTIPROC_DIR: string
+    Directory where the workers share their Prometheus metrics
+    (default /tmp/prometheus-multiproc).
+"""
+
+# Standard library modules
+import glob
+import os
+
+# Every worker must see this before it imports prometheus_client,
+# so it is set here, in the master, before any worker is forked.
+multiproc_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                      '/tmp/prometheus-multiproc')
+
+bind = '0.0.0.0:' + os.getenv('PORT', '8000')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '75'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+
+
+def on_starting(server):
+    # Metrics files left by an earlier run would be counted again
+    os.makedirs(multiproc_dir, exist_ok=True)
+    for f in glob.glob(os.path.join(multiproc_dir, '*.db')):
+        os.remove(f)
+
+
+def child_exit(server, worker):
+    from prometheus_flask_exporter.multiprocess import \
+        GunicornInternalPrometheusMetrics
+    GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(
+        worker.pid)
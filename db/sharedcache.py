@@ -0,0 +1,259 @@
+"""
+SFU CMPT 756
+Shared cache of objects for the database service.
+
+Objects read from the tables are kept in a Redis-protocol server
+that every replica of the service shares, so a hit in one replica
+serves the others and the cache stays warm across restarts.  The
+service uses it cache-aside: reads look in the cache first and put
+what they read from the table; changes invalidate.
+
+The server is given by a URL: `redis://host:port/db` for a Redis
+server (this needs the `redis` package) or `fake://` for
+`FakeRedis`, an in-process stand-in for tests and local runs.
+"""
+
+# Standard library modules
+import logging
+import threading
+import time
+
+# Installed packages
+from prometheus_client import Counter
+from prometheus_client import Histogram
+
+import simplejson as json
+
+# Stored in place of an object that has just changed (see invalidate())
+TOMBSTONE = b'-'
+# Returned by SharedCache._call() when the server fails
+FAILED = object()
+
+# Cache calls take well under a millisecond on a nearby server
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class FakeRedis():
+    """In-process stand-in for `redis.Redis`, offering the calls
+    `SharedCache` makes: get, set (with px and nx), delete and
+    non-transactional pipelines.  Values are kept as bytes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (expiry time or None, value)
+        self._data = {}
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] is not None and \
+                entry[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, name):
+        with self._lock:
+            entry = self._live(name)
+            return entry[1] if entry else None
+
+    def set(self, name, value, px=None, nx=False):
+        if isinstance(value, str):
+            value = value.encode()
+        with self._lock:
+            if nx and self._live(name) is not None:
+                return None
+            expiry = time.monotonic() + px / 1000 if px else None
+            self._data[name] = (expiry, value)
+            return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(1 for name in names
+                       if self._data.pop(name, None) is not None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline():
+    """Queues calls to a `FakeRedis` until `execute`."""
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def queue(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+def connect(url, timeout):
+    """Return a client for the server at `url`.  `timeout` is the
+    socket timeout, in seconds, of a real server."""
+    if url.startswith('fake:'):
+        return FakeRedis()
+    # Only needed when a real server is configured
+    import redis
+    return redis.Redis.from_url(url, socket_timeout=timeout,
+                                socket_connect_timeout=timeout)
+
+
+class SharedCache():
+    """Cache-aside store of objects, by objtype and key.
+
+    Each object is stored as JSON under `<prefix>:<objtype>:<objkey>`
+    and expires after its objtype's TTL.  A change to an object
+    replaces its entry with a tombstone that lives `tombstone_ttl`
+    seconds, and a read puts its object only if there is no entry
+    (SET NX).  A read that began before the change, and so may hold
+    the old object, therefore cannot put it back, unless it takes
+    longer than `tombstone_ttl`.
+
+    The cache never fails a request.  Any error from the server is
+    counted and logged, and the call acts as a miss.  A change whose
+    invalidation fails may be served stale until its entry expires.
+
+    Parameters
+    ----------
+    client: redis.Redis or FakeRedis
+        Client for the server.
+    prefix: string
+        Namespace of this service's keys in the server.
+    ttl: float
+        Lifetime, in seconds, of a cached object.
+    ttls: dict
+        Lifetimes of the objtypes whose lifetime is not `ttl`.
+    tombstone_ttl: float
+        Lifetime, in seconds, of a tombstone.
+    registry: prometheus_client.CollectorRegistry
+        Where to register the cache's metrics.
+    """
+
+    def __init__(self, client, prefix, ttl, ttls=None, tombstone_ttl=2.0,
+                 registry=None):
+        self._client = client
+        self._prefix = prefix
+        self._ttl = ttl
+        self._ttls = ttls or {}
+        self._tombstone_ms = max(1, int(tombstone_ttl * 1000))
+        self._requests = Counter('db_cache_requests',
+                                 'Objects looked up in the shared cache',
+                                 ['objtype', 'result'],
+                                 registry=registry)
+        self._duration = Histogram('db_cache_call_duration_seconds',
+                                   'Duration of calls to the shared cache',
+                                   ['operation', 'outcome'],
+                                   buckets=LATENCY_BUCKETS,
+                                   registry=registry)
+
+    def key(self, objtype, objkey):
+        return '{}:{}:{}'.format(self._prefix, objtype, objkey)
+
+    def _ttl_ms(self, objtype):
+        return max(1, int(1000 * self._ttls.get(objtype, self._ttl)))
+
+    def _call(self, operation, function):
+        """Return function(), or FAILED if the server fails."""
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return function()
+        except Exception as e:
+            outcome = 'error'
+            logging.warning('shared cache %s failed: %s', operation, e)
+            return FAILED
+        finally:
+            self._duration.labels(operation, outcome).observe(
+                time.perf_counter() - start)
+
+    def _pipelined(self, operation, queue):
+        """Send the calls `queue` makes on a pipeline in one round trip."""
+        def send():
+            pipe = self._client.pipeline(transaction=False)
+            queue(pipe)
+            return pipe.execute()
+        return self._call(operation, send)
+
+    def _decode(self, objtype, value):
+        if value is None or value == TOMBSTONE:
+            self._requests.labels(objtype, 'miss').inc()
+            return None
+        self._requests.labels(objtype, 'hit').inc()
+        return json.loads(value, use_decimal=True)
+
+    def get(self, objtype, objkey):
+        """Return the cached object, or None."""
+        value = self._call('get',
+                           lambda: self._client.get(self.key(objtype, objkey)))
+        if value is FAILED:
+            self._requests.labels(objtype, 'error').inc()
+            return None
+        return self._decode(objtype, value)
+
+    def get_many(self, keys):
+        """Return a dict mapping those of the (objtype, objkey) pairs
+        `keys` that are cached to their objects."""
+        if not keys:
+            return {}
+        values = self._pipelined(
+            'get_many',
+            lambda pipe: [pipe.get(self.key(*k)) for k in keys])
+        if values is FAILED:
+            for objtype, _ in keys:
+                self._requests.labels(objtype, 'error').inc()
+            return {}
+        found = {}
+        for k, value in zip(keys, values):
+            item = self._decode(k[0], value)
+            if item is not None:
+                found[k] = item
+        return found
+
+    def put(self, objtype, objkey, item):
+        """Cache `item` unless the object has an entry already."""
+        self._call('put', lambda: self._client.set(
+            self.key(objtype, objkey), json.dumps(item),
+            px=self._ttl_ms(objtype), nx=True))
+
+    def put_many(self, items):
+        """Cache each item of the dict mapping (objtype, objkey) pairs
+        to items, as `put`."""
+        if items:
+            self._pipelined('put_many', lambda pipe: [
+                pipe.set(self.key(*k), json.dumps(item),
+                         px=self._ttl_ms(k[0]), nx=True)
+                for k, item in items.items()])
+
+    def invalidate(self, objtype, *objkeys):
+        """Replace the entries of objects that have changed with
+        tombstones."""
+        if objkeys:
+            self._pipelined('invalidate', lambda pipe: [
+                pipe.set(self.key(objtype, objkey), TOMBSTONE,
+                         px=self._tombstone_ms)
+                for objkey in objkeys])
+
+
+def objtype_ttls(spec):
+    """Parse TTL overrides written 'objtype=seconds,...'."""
+    ttls = {}
+    for part in spec.split(','):
+        if part.strip():
+            objtype, _, seconds = part.partition('=')
+            ttls[objtype.strip()] = float(seconds)
+    return ttls
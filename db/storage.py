@@ -0,0 +1,771 @@
+"""
+SFU CMPT 756
+Storage drivers for the database service.
+
+The routes in `app.py` work on boto3 DynamoDB `Table` objects.  A
+storage driver supplies objects with the same methods, covering
+the parts of the DynamoDB API that the routes use, so the routes
+run unchanged whichever driver is selected:
+
+* `get_item`, `put_item`, `update_item`, `delete_item`, `scan`,
+  `query` and `batch_writer` on each table, and
+* `Table(name)` and `batch_get_item` on the resource.
+
+`MemoryResource` keeps the tables in memory and `SQLiteResource`
+in an SQLite database.  Both share the `Table` class, which builds
+the DynamoDB calls on a few storage primitives.
+
+Update, condition and projection expressions are evaluated by the
+`Expression` parser below.  It understands the expressions the
+routes build: SET with `if_not_exists`, `list_append`, `+` and `-`;
+REMOVE of attributes and list elements; and conditions made of
+comparisons, `attribute_exists`, `attribute_not_exists`, AND, OR,
+NOT and parentheses.  Failures raise botocore's `ClientError` with
+DynamoDB's error codes, as boto3 does.
+"""
+
+# Standard library modules
+import contextlib
+import copy
+import heapq
+import numbers
+import os
+import queue
+import re
+import sqlite3
+import threading
+
+# Installed packages
+from botocore.exceptions import ClientError
+
+import simplejson as json
+
+OK = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+
+def client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message},
+                        'ResponseMetadata': {'HTTPStatusCode': 400}},
+                       operation)
+
+
+def validation_error(message, operation='UpdateItem'):
+    return client_error('ValidationException', message, operation)
+
+
+# Expressions
+
+TOKEN = re.compile(r'\s*(<>|<=|>=|[=<>(),\[\]+-]|[#:]?\w+)')
+KEYWORDS = ('SET', 'REMOVE', 'AND', 'OR', 'NOT')
+# Marks an attribute missing from an item
+MISSING = object()
+
+
+class Expression():
+    """Parse and evaluate one DynamoDB expression.
+
+    `names` and `values` are the request's ExpressionAttributeNames
+    and ExpressionAttributeValues.
+    """
+
+    def __init__(self, text, names=None, values=None):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = TOKEN.match(text, pos)
+            if not m:
+                raise validation_error(
+                    "Invalid expression: {}".format(text[pos:]))
+            self.tokens.append(m.group(1))
+            pos = m.end()
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and
+                             token.upper() != expected):
+            raise validation_error(
+                "Invalid expression: expected {}, found {}".format(
+                    expected, token))
+        self.pos += 1
+        return token
+
+    def done(self):
+        if self.peek() is not None:
+            raise validation_error(
+                "Invalid expression: unexpected {}".format(self.peek()))
+
+    # Paths and operands
+
+    def path(self):
+        """Return a path: [attribute name, list index, ...]."""
+        token = self.take()
+        name = self.names.get(token, token) if token.startswith('#') \
+            else token
+        if token.startswith('#') and token not in self.names:
+            raise validation_error("Undefined name {}".format(token))
+        path = [name]
+        while self.peek() == '[':
+            self.take()
+            path.append(int(self.take()))
+            self.take(']')
+        return path
+
+    def operand(self):
+        """Return a function of the item giving the operand's value."""
+        token = self.peek()
+        if token is None:
+            raise validation_error("Invalid expression: missing operand")
+        if token.startswith(':'):
+            self.take()
+            if token not in self.values:
+                raise validation_error("Undefined value {}".format(token))
+            value = self.values[token]
+            return lambda item: value
+        if token in ('if_not_exists', 'list_append'):
+            self.take()
+            self.take('(')
+            first = self.path() if token == 'if_not_exists' \
+                else self.operand()
+            self.take(',')
+            second = self.operand()
+            self.take(')')
+            if token == 'if_not_exists':
+                return lambda item: (get_path(item, first)
+                                     if get_path(item, first) is not MISSING
+                                     else second(item))
+            return lambda item: list_append(first(item), second(item))
+        path = self.path()
+        return lambda item: get_path(item, path)
+
+    def value(self):
+        """An operand, optionally plus or minus another."""
+        left = self.operand()
+        if self.peek() in ('+', '-'):
+            op = self.take()
+            right = self.operand()
+            return lambda item: arithmetic(left(item), op, right(item))
+        return left
+
+    # Update expressions
+
+    def updates(self):
+        """Return the list of ('SET', path, value) and ('REMOVE', path)
+        actions of an update expression."""
+        actions = []
+        while self.peek() is not None:
+            clause = self.take().upper()
+            if clause not in ('SET', 'REMOVE'):
+                raise validation_error(
+                    "Unsupported update clause {}".format(clause))
+            while True:
+                path = self.path()
+                if clause == 'SET':
+                    self.take('=')
+                    actions.append(('SET', path, self.value()))
+                else:
+                    actions.append(('REMOVE', path))
+                if self.peek() != ',':
+                    break
+                self.take(',')
+        return actions
+
+    # Conditions
+
+    def condition(self):
+        left = self.conjunction()
+        while self.peek() and self.peek().upper() == 'OR':
+            self.take()
+            right = self.conjunction()
+            left = (lambda a, b: lambda item: a(item) or b(item))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.peek() and self.peek().upper() == 'AND':
+            self.take()
+            right = self.negation()
+            left = (lambda a, b: lambda item: a(item) and b(item))(left, right)
+        return left
+
+    def negation(self):
+        token = self.peek()
+        if token and token.upper() == 'NOT':
+            self.take()
+            inner = self.negation()
+            return lambda item: not inner(item)
+        if token == '(':
+            self.take()
+            inner = self.condition()
+            self.take(')')
+            return inner
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self.take()
+            self.take('(')
+            path = self.path()
+            self.take(')')
+            exists = token == 'attribute_exists'
+            return lambda item: (get_path(item, path) is not MISSING) == exists
+        left = self.value()
+        op = self.take()
+        right = self.value()
+        if op not in COMPARISONS:
+            raise validation_error("Unsupported comparison {}".format(op))
+        return lambda item: compare(left(item), op, right(item))
+
+
+def get_path(item, path):
+    value = item
+    for step in path:
+        if isinstance(step, int):
+            if not isinstance(value, list) or step >= len(value):
+                return MISSING
+            value = value[step]
+        else:
+            if not isinstance(value, dict) or step not in value:
+                return MISSING
+            value = value[step]
+    return value
+
+
+def set_path(item, path, value):
+    target = get_path(item, path[:-1])
+    last = path[-1]
+    if isinstance(last, int):
+        if not isinstance(target, list):
+            raise validation_error("The document path is invalid")
+        if last < len(target):
+            target[last] = value
+        else:
+            target.append(value)
+    elif isinstance(target, dict):
+        target[last] = value
+    else:
+        raise validation_error("The document path is invalid")
+
+
+def remove_path(item, path):
+    target = get_path(item, path[:-1])
+    last = path[-1]
+    if isinstance(last, int):
+        if isinstance(target, list) and last < len(target):
+            del target[last]
+    elif isinstance(target, dict):
+        target.pop(last, None)
+
+
+def list_append(first, second):
+    if not isinstance(first, list) or not isinstance(second, list):
+        raise validation_error(
+            "Incorrect operand type for operator or function; "
+            "operator or function: list_append")
+    return first + second
+
+
+def arithmetic(left, op, right):
+    for value in (left, right):
+        if isinstance(value, bool) or not isinstance(value, numbers.Number):
+            raise validation_error(
+                "Incorrect operand type for operator or function; "
+                "operator: {}".format(op))
+    return left + right if op == '+' else left - right
+
+
+COMPARISONS = ('=', '<>', '<', '<=', '>', '>=')
+
+
+def compare(left, op, right):
+    if left is MISSING or right is MISSING:
+        return op == '<>' and (left is MISSING) != (right is MISSING)
+    if op == '=':
+        return left == right
+    if op == '<>':
+        return left != right
+    try:
+        return {'<': left < right, '<=': left <= right,
+                '>': left > right, '>=': left >= right}[op]
+    except TypeError:
+        return False
+
+
+def projection(item, text, names):
+    """Return the attributes of `item` named in ProjectionExpression
+    `text`."""
+    expression = Expression(text, names)
+    result = {}
+    while True:
+        path = expression.path()
+        if path[0] in item:
+            result[path[0]] = item[path[0]]
+        if expression.peek() != ',':
+            break
+        expression.take(',')
+    expression.done()
+    return result
+
+
+def key_condition(condition):
+    """Return the (attribute, value) pair of a boto3 Key(...).eq(...)
+    KeyConditionExpression."""
+    expression = condition.get_expression()
+    if expression['operator'] != '=':
+        raise validation_error("Only equality key conditions are supported",
+                               'Query')
+    key, value = expression['values']
+    return key.name, value
+
+
+# Tables
+
+class Table():
+    """The DynamoDB `Table` methods, over the storage primitives a
+    driver supplies:
+
+    `_get(objkey)`
+        The item, or None.  The caller may change the item.
+    `_put(objkey, item)` and `_delete(objkey)`
+    `_range(start, limit, attr=None, value=None)`
+        Up to `limit` (None for no limit) items, in key order, with
+        keys after `start` (None to start at the beginning) and, if
+        `attr` is given, `attr` equal to `value`.
+    `_transaction()`
+        A context manager within which the primitives' changes are
+        atomic and isolated.  It may be entered again while held.
+    """
+
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+
+    def _objkey(self, key, operation):
+        if set(key) != {self.key}:
+            raise validation_error(
+                "The provided key element does not match the schema",
+                operation)
+        return key[self.key]
+
+    def _check(self, kwargs, item, operation):
+        text = kwargs.get('ConditionExpression')
+        if text is None:
+            return
+        expression = Expression(text,
+                                kwargs.get('ExpressionAttributeNames'),
+                                kwargs.get('ExpressionAttributeValues'))
+        condition = expression.condition()
+        expression.done()
+        if not condition(item if item is not None else {}):
+            raise client_error('ConditionalCheckFailedException',
+                               'The conditional request failed', operation)
+
+    def get_item(self, Key, ProjectionExpression=None,
+                 ExpressionAttributeNames=None, ConsistentRead=False):
+        item = self._get(self._objkey(Key, 'GetItem'))
+        response = dict(OK)
+        if item is not None:
+            if ProjectionExpression:
+                item = projection(item, ProjectionExpression,
+                                  ExpressionAttributeNames)
+            response['Item'] = item
+        return response
+
+    def put_item(self, Item, **kwargs):
+        if self.key not in Item:
+            raise validation_error("Missing the key {} in the item".format(
+                self.key), 'PutItem')
+        item = copy.deepcopy(Item)
+        with self._transaction():
+            if 'ConditionExpression' in kwargs:
+                self._check(kwargs, self._get(item[self.key]), 'PutItem')
+            self._put(item[self.key], item)
+        return dict(OK)
+
+    def update_item(self, Key, UpdateExpression, ReturnValues='NONE',
+                    **kwargs):
+        objkey = self._objkey(Key, 'UpdateItem')
+        expression = Expression(UpdateExpression,
+                                kwargs.get('ExpressionAttributeNames'),
+                                kwargs.get('ExpressionAttributeValues'))
+        actions = expression.updates()
+        expression.done()
+        if ReturnValues not in ('NONE', 'ALL_OLD', 'UPDATED_OLD',
+                                'ALL_NEW', 'UPDATED_NEW'):
+            raise validation_error(
+                "Invalid ReturnValues: {}".format(ReturnValues))
+        with self._transaction():
+            old = self._get(objkey)
+            self._check(kwargs, old, 'UpdateItem')
+            # Every value is computed from the item before the update
+            before = old if old is not None else {self.key: objkey}
+            item = copy.deepcopy(before)
+            for action in actions:
+                if action[0] == 'SET':
+                    value = action[2](before)
+                    if value is MISSING:
+                        raise validation_error(
+                            "The provided expression refers to an "
+                            "attribute that does not exist in the item")
+                    set_path(item, action[1], copy.deepcopy(value))
+                else:
+                    remove_path(item, action[1])
+            self._put(objkey, item)
+        response = dict(OK)
+        updated = {action[1][0] for action in actions}
+        if ReturnValues in ('ALL_OLD', 'UPDATED_OLD') and old is not None:
+            source = old
+        elif ReturnValues in ('ALL_NEW', 'UPDATED_NEW'):
+            source = item
+        else:
+            return response
+        if ReturnValues.startswith('UPDATED'):
+            source = {k: v for k, v in source.items() if k in updated}
+        response['Attributes'] = copy.deepcopy(source)
+        return response
+
+    def delete_item(self, Key, **kwargs):
+        objkey = self._objkey(Key, 'DeleteItem')
+        with self._transaction():
+            if 'ConditionExpression' in kwargs:
+                self._check(kwargs, self._get(objkey), 'DeleteItem')
+            self._delete(objkey)
+        return dict(OK)
+
+    def _page(self, limit, start, attr=None, value=None):
+        """Return a scan or query response for one page."""
+        start_key = start[self.key] if start else None
+        items = self._range(start_key, limit + 1 if limit else None,
+                            attr, value)
+        response = dict(OK)
+        if limit and len(items) > limit:
+            items = items[:limit]
+            last = {self.key: items[-1][self.key]}
+            if attr is not None:
+                last[attr] = value
+            response['LastEvaluatedKey'] = last
+        response.update(Items=items, Count=len(items),
+                        ScannedCount=len(items))
+        return response
+
+    def scan(self, Limit=None, ExclusiveStartKey=None):
+        return self._page(Limit, ExclusiveStartKey)
+
+    def query(self, KeyConditionExpression, IndexName=None, Limit=None,
+              ExclusiveStartKey=None):
+        attr, value = key_condition(KeyConditionExpression)
+        if attr == self.key:
+            item = self._get(value)
+            items = [item] if item is not None else []
+            return dict(OK, Items=items, Count=len(items),
+                        ScannedCount=len(items))
+        return self._page(Limit, ExclusiveStartKey, attr, value)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return BatchWriter(self)
+
+
+class BatchWriter():
+    """Stands in for boto3's batch writer.  The writes are made in
+    one transaction, which commits when the block exits normally."""
+
+    def __init__(self, table):
+        self._table = table
+        self._transaction = None
+
+    def __enter__(self):
+        self._transaction = self._table._transaction()
+        self._transaction.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._transaction.__exit__(*exc)
+
+    def put_item(self, Item):
+        self._table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self._table.delete_item(Key=Key)
+
+
+class Resource():
+    """Stands in for the boto3 DynamoDB resource.  `tables` maps each
+    table name to its `Table`."""
+
+    def __init__(self, tables):
+        self._tables = tables
+
+    def Table(self, name):
+        return self._tables[name]
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self._tables[name]
+            found = responses.setdefault(name, [])
+            for key in request['Keys']:
+                item = table.get_item(Key=key).get('Item')
+                if item is not None:
+                    found.append(item)
+        return dict(OK, Responses=responses, UnprocessedKeys={})
+
+
+# The in-memory driver
+
+class MemoryTable(Table):
+    """A table held in a dictionary.
+
+    Items are copied in and out, so callers never share an item with
+    the table.  The indexes that `query` uses are built on their
+    first use and kept up to date.
+    """
+
+    def __init__(self, name, key):
+        super().__init__(name, key)
+        self._lock = threading.RLock()
+        self._items = {}
+        # attribute -> value -> set of keys
+        self._indexes = {}
+
+    def _transaction(self):
+        return self._lock
+
+    def _get(self, objkey):
+        with self._lock:
+            return copy.deepcopy(self._items.get(objkey))
+
+    def _store(self, objkey, item):
+        with self._lock:
+            old = self._items.get(objkey)
+            for attr, index in self._indexes.items():
+                if old is not None and attr in old:
+                    index.get(old[attr], set()).discard(objkey)
+                if item is not None and attr in item:
+                    index.setdefault(item[attr], set()).add(objkey)
+            if item is None:
+                self._items.pop(objkey, None)
+            else:
+                self._items[objkey] = copy.deepcopy(item)
+
+    def _put(self, objkey, item):
+        self._store(objkey, item)
+
+    def _delete(self, objkey):
+        self._store(objkey, None)
+
+    def _range(self, start, limit, attr=None, value=None):
+        with self._lock:
+            if attr is None:
+                keys = self._items
+            else:
+                if attr not in self._indexes:
+                    index = self._indexes[attr] = {}
+                    for k, item in self._items.items():
+                        if attr in item:
+                            index.setdefault(item[attr], set()).add(k)
+                keys = self._indexes[attr].get(value, ())
+            keys = (k for k in keys if start is None or k > start)
+            keys = sorted(keys) if limit is None \
+                else heapq.nsmallest(limit, keys)
+            return [copy.deepcopy(self._items[k]) for k in keys]
+
+
+class MemoryResource(Resource):
+    """Every table in memory.  `keys` maps each table name to its key
+    attribute.
+
+    The tables live in the process: under gunicorn, run a single
+    worker (GUNICORN_WORKERS=1) so every request sees the same data.
+    """
+
+    def __init__(self, keys):
+        super().__init__({name: MemoryTable(name, key)
+                          for name, key in keys.items()})
+
+
+# The SQLite driver
+
+class SQLiteTable(Table):
+    """A table stored as an SQLite table of (key, item) rows.
+
+    The key column is the primary key and each item is stored as
+    JSON.  Every attribute in `indexes` gets an index on its JSON
+    value, which `query` uses.  A read-modify-write, such as an
+    update, runs in one IMMEDIATE transaction, so it is atomic across
+    threads and processes sharing the database file.
+    """
+
+    def __init__(self, name, key, connection, indexes=()):
+        super().__init__(name, key)
+        self._connection = connection
+        self._table = '"{}"'.format(name.replace('"', '""'))
+        with connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS {} '
+                         '(key TEXT PRIMARY KEY, item TEXT NOT NULL)'
+                         .format(self._table))
+            for attr in indexes:
+                # With the key, so a page of a query is read in key order
+                conn.execute(
+                    'CREATE INDEX IF NOT EXISTS "{}" ON {} ({}, key)'.format(
+                        '{}-{}'.format(name, attr).replace('"', '""'),
+                        self._table, self._extract(attr)))
+
+    @staticmethod
+    def _extract(attr):
+        """The SQL expression for `attr`, written the same way in the
+        index and in queries so that SQLite uses the index."""
+        return "json_extract(item, '$.\"{}\"')".format(
+            attr.replace("'", "''").replace('"', '\\"'))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            if conn.in_transaction:
+                yield
+                return
+            # IMMEDIATE takes the write lock at once, so two transactions
+            # cannot both read an item and then both write it
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _get(self, objkey):
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT item FROM {} WHERE key = ?'.format(self._table),
+                (objkey,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, objkey, item):
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO {} (key, item) VALUES (?, ?)'.format(
+                    self._table),
+                (objkey, json.dumps(item)))
+
+    def _delete(self, objkey):
+        with self._connection() as conn:
+            conn.execute(
+                'DELETE FROM {} WHERE key = ?'.format(self._table),
+                (objkey,))
+
+    def _range(self, start, limit, attr=None, value=None):
+        where = []
+        params = []
+        if attr is not None:
+            where.append(self._extract(attr) + ' = ?')
+            params.append(value)
+        if start is not None:
+            where.append('key > ?')
+            params.append(start)
+        sql = 'SELECT item FROM {}{} ORDER BY key'.format(
+            self._table, ' WHERE ' + ' AND '.join(where) if where else '')
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class SQLiteResource(Resource):
+    """Every table in one SQLite database file, `path`, in WAL mode.
+
+    `keys` maps each table name to its key attribute and `indexes`
+    maps table names to the attributes `query` may look up.  Each
+    call takes a connection from a pool of this process's connections
+    and returns it when it is done, so a server starting a thread per
+    request reuses connections rather than opening one per thread.
+    The pool keeps up to `pool_size` idle connections and opens more
+    when all are busy.  WAL mode lets readers proceed while another
+    connection writes.  `synchronous` is SQLite's synchronous setting:
+    NORMAL loses no data on a process crash, only perhaps the last
+    commits on a power failure.  `busy_timeout` is how long, in
+    seconds, to wait for another connection's write lock.
+    """
+
+    def __init__(self, path, keys, indexes=None, synchronous='NORMAL',
+                 busy_timeout=5.0, pool_size=8):
+        self._path = path
+        self._synchronous = synchronous
+        self._busy_timeout = busy_timeout
+        self._pool_size = pool_size
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # The connection a thread holds, so that the calls within a
+        # transaction use the transaction's connection
+        self._local = threading.local()
+        indexes = indexes or {}
+        super().__init__({
+            name: SQLiteTable(name, key, self.connection,
+                              indexes.get(name, ()))
+            for name, key in keys.items()})
+
+    def _open(self):
+        # Autocommit, except within BEGIN ... COMMIT
+        conn = sqlite3.connect(self._path, timeout=self._busy_timeout,
+                               isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous={}'.format(self._synchronous))
+        return conn
+
+    def _idle(self):
+        """Return this process's pool of idle connections.
+
+        A forked worker must not share its parent's connections, so a
+        new, empty pool is made whenever the process id changes.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._pool = queue.LifoQueue(self._pool_size)
+                    self._local = threading.local()
+                    self._pid = pid
+        return self._pool
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Lend the calling thread a connection for the duration of
+        the `with` block.  A thread that already holds one, within a
+        transaction, gets the same connection."""
+        pool = self._idle()
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        try:
+            conn = pool.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        local.conn = conn
+        try:
+            yield conn
+        finally:
+            local.conn = None
+            if conn.in_transaction:
+                # Only if COMMIT itself failed
+                conn.execute('ROLLBACK')
+            try:
+                pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """Close the idle connections."""
+        pool = self._idle()
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                return
@@ -4,13 +4,22 @@ Loader for sample database
 """
 
 # Standard library modules
+import concurrent.futures
 import csv
+import itertools
+import json
 from json.encoder import py_encode_basestring
 import os
+import sys
 import time
 
 # Installed packages
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Local modules
+import idlist
 
 # The application
 
@@ -26,6 +35,15 @@ db = {
     "name": "http://cmpt756db:30002/api/v1/datastore",
 }
 
+# 'serial' sends one `/load` per row; 'batch' streams the files
+# through `/batch_load` with a pool of workers
+LOADER_MODE = os.getenv('LOADER_MODE', 'serial')
+BATCH_SIZE = int(os.getenv('LOADER_BATCH_SIZE', '100'))
+WORKERS = int(os.getenv('LOADER_WORKERS', '8'))
+# Records how many rows of each file are known to be loaded
+CHECKPOINT_FILE = os.getenv('LOADER_CHECKPOINT', 'loader-checkpoint.json')
+PROGRESS_INTERVAL_SEC = 5
+
 
 def build_auth():
     """Return a loader Authorization header in Basic format"""
@@ -48,7 +66,7 @@ def create_user(user_id, email, fname, lname, playlist):
               "email": email,
               "fname": fname,
               "uuid": user_id,
-              "playlist": playlist})
+              "playlist": idlist.id_list(playlist)})
     print(response)
     return (response.json())
 
@@ -82,7 +100,7 @@ def create_playlist(playlist_id, songs, title):
         auth=build_auth(),
         json={"objtype": "playlist",
               "uuid": playlist_id,
-              "songs": songs,
+              "songs": idlist.id_list(songs),
               "title": title})
     return (response.json())
 
@@ -94,12 +112,202 @@ def check_resp(resp, key):
         return resp[key]
 
 
+def build_session():
+    """
+    Return a Session sized for WORKERS concurrent keep-alive connections
+
+    `/batch_load` writes caller-supplied UUIDs, so resending a batch
+    is harmless and POST is retried along with the other verbs.
+    """
+    session = requests.Session()
+    session.auth = build_auth()
+    retry = Retry(total=3,
+                  backoff_factor=0.5,
+                  status_forcelist=[502, 503, 504],
+                  method_whitelist=False)
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=WORKERS,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def user_object(row):
+    user_id, email, fname, lname, playlist = [f.strip() for f in row]
+    return {"objtype": "user",
+            "uuid": user_id,
+            "email": email,
+            "fname": fname,
+            "lname": lname,
+            "playlist": idlist.id_list(playlist)}
+
+
+def song_object(row):
+    uuid, artist, title = [f.strip() for f in row]
+    return {"objtype": "music",
+            "uuid": uuid,
+            "Artist": artist,
+            "SongTitle": title}
+
+
+def playlist_object(row):
+    uuid, songs, title = [f.strip() for f in row]
+    return {"objtype": "playlist",
+            "uuid": uuid,
+            "songs": idlist.id_list(songs),
+            "title": title}
+
+
+def read_checkpoint():
+    """Return the {file: rows loaded} dict saved by an earlier run"""
+    try:
+        with open(CHECKPOINT_FILE, 'r') as inp:
+            return json.load(inp)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_checkpoint(checkpoint):
+    """Save the checkpoint so that a crash never leaves it half-written"""
+    tmp = CHECKPOINT_FILE + '.tmp'
+    with open(tmp, 'w') as out:
+        json.dump(checkpoint, out)
+    os.replace(tmp, CHECKPOINT_FILE)
+
+
+def read_batches(path, skip):
+    """
+    Yield (rows in batch, list of rows) for the csv file `path`
+
+    The file is streamed rather than read into memory.  The header
+    and the first `skip` rows, which an earlier run loaded, are
+    passed over.
+    """
+    with open(path, 'r') as inp:
+        rdr = csv.reader(inp)
+        next(rdr)  # Skip header
+        rows = itertools.islice(rdr, skip, None)
+        while True:
+            batch = list(itertools.islice(rows, BATCH_SIZE))
+            if not batch:
+                return
+            yield batch
+
+
+def send_batch(session, objects):
+    """Send one batch to `/batch_load`, returning the list of errors"""
+    response = session.post(db['name'] + '/batch_load',
+                            json={"objects": objects})
+    if response.status_code != 200:
+        return ['Status {} for batch starting at {}'.format(
+            response.status_code, objects[0]['uuid'])]
+    errors = []
+    for obj, res in zip(objects, response.json()['Items']):
+        if 'error' in res:
+            errors.append('Error loading {} {}: {}'.format(
+                obj['objtype'], obj['uuid'], res['error']))
+    return errors
+
+
+def load_file(session, path, to_object, checkpoint):
+    """
+    Load the csv file `path` in batches over a pool of WORKERS threads
+
+    At most 2*WORKERS batches are in flight at once, so memory stays
+    bounded however large the file.  Batches can finish out of order,
+    so the checkpoint only advances past a batch once every batch
+    before it has finished without error.  A rerun after a crash
+    resumes from there; rows past that point are simply reloaded.
+
+    Returns the number of errors, each a failed batch or row.
+    """
+    done = checkpoint.get(path, 0)
+    if done:
+        print('Resuming {} after {} rows'.format(path, done))
+    start = time.time()
+    last_report = start
+    sent = 0
+    # Batches in submission order: [future, rows in batch]
+    pending = []
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        batches = read_batches(path, done)
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < 2 * WORKERS:
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    exhausted = True
+                    break
+                objects = [to_object(row) for row in batch]
+                pending.append(
+                    [pool.submit(send_batch, session, objects), len(batch)])
+            concurrent.futures.wait(
+                [f for f, _ in pending],
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            while pending and pending[0][0].done():
+                future, count = pending.pop(0)
+                try:
+                    errors = future.result()
+                except requests.RequestException as e:
+                    errors = ['Batch failed: {}'.format(e)]
+                for err in errors:
+                    print(err)
+                sent += count
+                failures += len(errors)
+                if not failures:
+                    done += count
+            if checkpoint.get(path) != done:
+                checkpoint[path] = done
+                write_checkpoint(checkpoint)
+            now = time.time()
+            if now - last_report >= PROGRESS_INTERVAL_SEC:
+                print('{}: {} rows, {:.0f} rows/sec'.format(
+                    path, sent, sent / (now - start)))
+                last_report = now
+    elapsed = max(time.time() - start, 1e-6)
+    print('{}: loaded {} rows in {:.1f} sec, {:.0f} rows/sec'.format(
+        path, sent, elapsed, sent / elapsed))
+    return failures
+
+
+def batch_load_all(resource_dir):
+    """
+    Load all three files in batch mode, resuming from any checkpoint
+
+    Returns the number of errors in all three files.
+    """
+    checkpoint = read_checkpoint()
+    session = build_session()
+    failures = 0
+    for path, to_object in [
+            ('{}/users/users.csv'.format(resource_dir), user_object),
+            ('{}/music/music.csv'.format(resource_dir), song_object),
+            ('{}/playlist/playlist.csv'.format(resource_dir),
+             playlist_object)]:
+        failures += load_file(session, path, to_object, checkpoint)
+    if not failures and os.path.exists(CHECKPOINT_FILE):
+        # Everything is loaded, so the next run starts from scratch
+        os.remove(CHECKPOINT_FILE)
+    return failures
+
+
 if __name__ == '__main__':
     # Give Istio proxy time to initialize
     time.sleep(INITIAL_WAIT_SEC)
 
     resource_dir = '/data'
 
+    if LOADER_MODE == 'batch':
+        failures = batch_load_all(resource_dir)
+        if failures:
+            print('{} errors; rerun to resume from the checkpoint'.format(
+                failures))
+            sys.exit(-1)
+        sys.exit(0)
+
     with open('{}/users/users.csv'.format(resource_dir), 'r') as inp:
         rdr = csv.reader(inp)
         next(rdr)  # Skip header
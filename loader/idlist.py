@@ -0,0 +1,36 @@
+"""
+SFU CMPT 756
+Parser for the list attributes of records, such as a user's
+`playlist` and a playlist's `songs`, shared by the user and playlist
+services and the loader.
+
+Each of those directories holds an identical copy of this file
+because each is built from its own directory.  Change all the
+copies together.
+"""
+
+# Standard library modules
+import json
+
+
+def id_list(value):
+    """
+    Return the list of ids in a list attribute.
+
+    Records created through the services hold a list of ids.  The
+    loader's csv files, and the records older loaders wrote from them,
+    hold the DynamoDB JSON of the list as a string, such as
+    '[{"S": "<id>"}]', which is unpacked here.  A missing attribute
+    and an empty or blank string are an empty list.  Raises ValueError
+    for anything else, so that no caller mistakes it for a list.
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = json.loads(value) if value.strip() else []
+    if not isinstance(value, list):
+        raise ValueError("Not a list: {!r}".format(value))
+    ids = [v.get('S') if isinstance(v, dict) else v for v in value]
+    if not all(isinstance(i, str) for i in ids):
+        raise ValueError("Not a list of ids: {!r}".format(value))
+    return ids
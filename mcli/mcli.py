@@ -14,6 +14,9 @@ import requests
 # not whether it's valid
 DEFAULT_AUTH = 'Bearer A'
 
+# Songs fetched per request when listing all songs
+PAGE_SIZE = 50
+
 
 def parse_args():
     argp = argparse.ArgumentParser(
@@ -48,6 +51,35 @@ def parse_quoted_strings(arg):
     return [''.join(a) for a in args]
 
 
+def list_songs(url):
+    """
+    Yield every song, one page at a time.
+
+    Each page is requested only once the songs of the previous page
+    have been consumed, so a long listing starts printing at once and
+    the caller can stop at any point without fetching the rest.
+    """
+    cursor = None
+    while True:
+        params = {'limit': PAGE_SIZE}
+        if cursor:
+            params['cursor'] = cursor
+        r = requests.get(
+            url,
+            params=params,
+            headers={'Authorization': DEFAULT_AUTH}
+            )
+        if r.status_code != 200:
+            print("Non-successful status code:", r.status_code)
+            return
+        page = r.json()
+        for i in page.get('Items', []):
+            yield i
+        cursor = page.get('Cursor')
+        if not cursor:
+            return
+
+
 class Mcli(cmd.Cmd):
     def __init__(self, args):
         self.name = args.name
@@ -82,8 +114,20 @@ Enter 'help' for command list.
         Some versions of the server do not support listing
         all songs and will instead return an empty list if
         no parameter is provided.
+
+        The full list is read in pages of PAGE_SIZE songs.
         """
         url = get_url(self.name, self.port)
+        if arg.strip() == '':
+            count = 0
+            for i in list_songs(url):
+                print("{}  {:20.20s} {}".format(
+                    i['music_id'],
+                    i['Artist'],
+                    i['SongTitle']))
+                count += 1
+            print("{} items returned".format(count))
+            return
         r = requests.get(
             url+arg.strip(),
             headers={'Authorization': DEFAULT_AUTH}
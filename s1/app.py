@@ -5,8 +5,8 @@ Sample application---user service.
 
 # Standard library modules
 import logging
+import os
 import sys
-import time
 
 # Installed packages
 from flask import Blueprint
@@ -14,32 +14,41 @@ from flask import Flask
 from flask import request
 from flask import Response
 
-import jwt
-
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import \
+    GunicornInternalPrometheusMetrics
 
 import requests
 
 import simplejson as json
 
+# Local modules
+import auth
+import dbclient
+import idlist
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+# Under gunicorn (see gunicorn.conf.py) the worker processes
+# share one set of metrics
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
 metrics.info('app_info', 'User process')
 
 bp = Blueprint('app', __name__)
 
-db = {
-    "name": "http://cmpt756db:30002/api/v1/datastore",
-    "endpoint": [
-        "read",
-        "write",
-        "delete",
-        "update"
-    ]
-}
+db = dbclient.Datastore(service='user',
+                        registry=metrics.registry,
+                        incoming_headers=dbclient.flask_request_headers)
+authenticator = auth.Authenticator(auth.UserRecords(db))
+
+# Tries of a conditional update before giving up on a user
+# that other requests keep changing
+UPDATE_ATTEMPTS = int(os.getenv('UPDATE_ATTEMPTS', '5'))
 
 
 @bp.route('/', methods=['GET'])
@@ -66,38 +75,79 @@ def readiness():
 def update_user(user_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}), status=401,
                         mimetype='application/json')
 
-    payload = {"objtype": "user", "objkey": user_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response_get = requests.get(url, params=payload)
+    response_get = db.read("user", user_id, consistent=True)
     response_get = response_get.json()
 
     if(response_get['Count'] == 0):
         return json.dumps({"message": "No such user. Check the user id"})
 
-    else:
-        try:
-            content = request.get_json()
-            playlist = content['playlist'] if 'playlist' in content \
-                else response_get['Items'][0]['playlist']
-            email = content['email']
-            fname = content['fname']
-            lname = content['lname']
-        except Exception:
-            return json.dumps({"message": "error reading arguments"})
-
-        url = db['name'] + '/' + db['endpoint'][3]
-        response = requests.put(
-            url,
-            params={"objtype": "user", "objkey": user_id},
-            json={"email": email,
-                  "fname": fname,
-                  "lname": lname,
-                  "playlist": playlist})
-        return (response.json())
+    try:
+        content = request.get_json()
+        email = content['email']
+        fname = content['fname']
+        lname = content['lname']
+    except Exception:
+        return json.dumps({"message": "error reading arguments"})
+
+    # The update is conditional on the version read, so a concurrent
+    # change to the user (such as a playlist being added) is never
+    # overwritten: on a conflict the change is merged into the
+    # current record and tried again
+    item = response_get['Items'][0]
+    for _ in range(UPDATE_ATTEMPTS):
+        playlist = content['playlist'] if 'playlist' in content \
+            else item['playlist']
+        response = db.update(
+            "user",
+            user_id,
+            {"email": email,
+             "fname": fname,
+             "lname": lname,
+             "playlist": playlist},
+            expected_version=item.get('version', 0))
+        if response.status_code != 409:
+            return (response.json())
+        item = response.json()['Item']
+    return Response(json.dumps({"message": "user kept changing, try again"}),
+                    status=409,
+                    mimetype='application/json')
+
+
+# The user attributes a client may change; `playlist` is kept by
+# the playlist service as playlists are created and deleted
+USER_ATTRIBUTES = frozenset(['fname', 'lname', 'email'])
+
+
+@bp.route('/<user_id>', methods=['PATCH'])
+def patch_user(user_id):
+    """
+    Change some of a user's attributes.
+
+    Only the attributes in the body are sent, in a single update
+    that is refused if the user does not exist.  Returns the db
+    service's response, whose `Attributes` hold the new values.
+    """
+    headers = request.headers
+    # check header here
+    if not authenticator.authorized(headers):
+        return Response(json.dumps({"error": "missing auth"}), status=401,
+                        mimetype='application/json')
+    content = request.get_json(silent=True)
+    if not isinstance(content, dict) or not content or \
+            not USER_ATTRIBUTES.issuperset(content):
+        return json.dumps({"message": "error reading arguments"})
+    response = db.update("user",
+                         user_id,
+                         content,
+                         exists=True,
+                         return_values='UPDATED_NEW')
+    return Response(response.content,
+                    status=response.status_code,
+                    mimetype='application/json')
 
 
 @bp.route('/', methods=['POST'])
@@ -105,7 +155,8 @@ def create_user():
     """
     Create a user.
     If a record already exists with the same fname, lname, and email,
-    the old UUID is replaced with a new one.
+    the old UUID is replaced with a new one.  Repeating a request with
+    the same Idempotency-Key header returns the user it created.
     """
     try:
         content = request.get_json()
@@ -116,14 +167,13 @@ def create_user():
 
     except Exception:
         return json.dumps({"message": "error reading arguments"})
-    url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
-        url,
-        json={"objtype": "user",
-              "lname": lname,
-              "email": email,
-              "fname": fname,
-              "playlist": playlist})
+    response = db.write(
+        {"objtype": "user",
+         "lname": lname,
+         "email": email,
+         "fname": fname,
+         "playlist": playlist},
+        idempotency_key=request.headers.get('Idempotency-Key'))
     return (response.json())
 
 
@@ -131,32 +181,172 @@ def create_user():
 def delete_user(user_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    url = db['name'] + '/' + db['endpoint'][2]
-
-    response = requests.delete(url,
-                               params={"objtype": "user", "objkey": user_id})
+    response = db.delete("user", user_id)
     return (response.json())
 
 
+@bp.route('/by_email/<email>', methods=['GET'])
+def find_by_email(email):
+    """
+    List the users with this email address, read through the index
+    on email.  `limit` and `cursor` page through them as in the
+    database service's `/query`.
+    """
+    headers = request.headers
+    # check header here
+    if not authenticator.authorized(headers):
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    response = db.query("user",
+                        "email",
+                        email,
+                        request.args.get('limit'),
+                        request.args.get('cursor'),
+                        headers={'Authorization': headers['Authorization']})
+    return Response(response.content,
+                    status=response.status_code,
+                    mimetype='application/json')
+
+
 @bp.route('/<user_id>', methods=['GET'])
 def get_user(user_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(
             json.dumps({"error": "missing auth"}),
             status=401,
             mimetype='application/json')
-    payload = {"objtype": "user", "objkey": user_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(url, params=payload)
+    response = db.read("user", user_id)
     return (response.json())
 
 
+# Upper bounds on the size of a `/library` response
+LIBRARY_MAX_PLAYLISTS = int(os.getenv('LIBRARY_MAX_PLAYLISTS', '50'))
+LIBRARY_MAX_SONGS = int(os.getenv('LIBRARY_MAX_SONGS', '500'))
+
+
+def id_list(value):
+    """
+    Return the list of ids in a list attribute such as `playlist`
+    (see `idlist.id_list`), or an empty list if it holds anything
+    else, which is logged.
+    """
+    try:
+        return idlist.id_list(value)
+    except ValueError as e:
+        logging.warning("list attribute ignored: %s", e)
+        return []
+
+
+def read_many(objtype, ids, headers):
+    """
+    Return (found, unread) for the records of `ids`.
+
+    `found` maps each id read to its record.  `unread` lists the ids
+    whose records could not be read, because the call failed or the
+    database service left them unprocessed; they may or may not exist.
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}, []
+    try:
+        response = db.batch_read(
+            [{"objtype": objtype, "objkey": i} for i in ids],
+            headers=headers)
+    except requests.RequestException:
+        return {}, ids
+    if response.status_code != 200:
+        return {}, ids
+    content = response.json()
+    key = objtype + "_id"
+    unread = [k['objkey'] for k in content.get('Unprocessed', [])]
+    return {item[key]: item for item in content['Items']}, unread
+
+
+@bp.route('/<user_id>/library', methods=['GET'])
+def get_library(user_id):
+    """
+    Return a user with their playlists and, optionally, their songs.
+
+    Query parameters
+    ----------------
+    depth: 'playlists' (default) or 'songs'
+        With 'songs', each playlist's song ids are replaced by the
+        songs' music records.
+    max_playlists, max_songs: int
+        Caps on the playlists and distinct songs read, at most
+        LIBRARY_MAX_PLAYLISTS and LIBRARY_MAX_SONGS.  `truncated`
+        is true in the response if either cap was reached.
+
+    The user is read with one call, all the playlists with one
+    batched call and all the songs with another.  Playlists and songs
+    that could not be read, because a call failed, are listed in
+    `unread_playlists` and `unread_songs`, and `partial` is true if
+    there are any.
+    """
+    headers = request.headers
+    # check header here
+    if not authenticator.authorized(headers):
+        return Response(
+            json.dumps({"error": "missing auth"}),
+            status=401,
+            mimetype='application/json')
+    try:
+        depth = request.args.get('depth', 'playlists')
+        max_playlists = min(int(request.args.get(
+            'max_playlists', LIBRARY_MAX_PLAYLISTS)), LIBRARY_MAX_PLAYLISTS)
+        max_songs = min(int(request.args.get(
+            'max_songs', LIBRARY_MAX_SONGS)), LIBRARY_MAX_SONGS)
+        if depth not in ('playlists', 'songs'):
+            raise ValueError(depth)
+    except ValueError:
+        return json.dumps({"message": "error reading arguments"})
+    if max_playlists < 0 or max_songs < 0:
+        return Response(
+            json.dumps({"message": "max_playlists and max_songs must "
+                                   "not be negative"}),
+            status=400,
+            mimetype='application/json')
+
+    auth = {'Authorization': headers['Authorization']}
+    response = db.read("user", user_id, headers=auth)
+    content = response.json()
+    if response.status_code != 200 or content['Count'] == 0:
+        return json.dumps({"message": "No such user. Check the user id"})
+    user = content['Items'][0]
+
+    playlist_ids = id_list(user.get('playlist'))
+    truncated = len(playlist_ids) > max_playlists
+    playlist_ids = playlist_ids[:max_playlists]
+    found, unread_playlists = read_many("playlist", playlist_ids, auth)
+    playlists = [found[i] for i in playlist_ids if i in found]
+    unread_songs = []
+
+    if depth == 'songs':
+        song_ids = []
+        for p in playlists:
+            p['songs'] = id_list(p.get('songs'))
+            song_ids.extend(p['songs'])
+        song_ids = list(dict.fromkeys(song_ids))
+        truncated = truncated or len(song_ids) > max_songs
+        songs, unread_songs = read_many("music", song_ids[:max_songs], auth)
+        for p in playlists:
+            p['songs'] = [songs[i] for i in p['songs'] if i in songs]
+
+    return {"user": user,
+            "playlists": playlists,
+            "truncated": truncated,
+            "partial": bool(unread_playlists or unread_songs),
+            "unread_playlists": unread_playlists,
+            "unread_songs": unread_songs}
+
+
 @bp.route('/login', methods=['PUT'])
 def login():
     try:
@@ -164,23 +354,24 @@ def login():
         uid = content['uid']
     except Exception:
         return json.dumps({"message": "error reading parameters"})
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(url, params={"objtype": "user", "objkey": uid})
+    response = db.read("user", uid)
     data = response.json()
-    if len(data['Items']) > 0:
-        encoded = jwt.encode({'user_id': uid, 'time': time.time()},
-                             'secret',
-                             algorithm='HS256')
-    return encoded
+    if len(data['Items']) == 0:
+        return json.dumps({"message": "No such user. Check the user id"})
+    return authenticator.issue(uid)
 
 
 @bp.route('/logoff', methods=['PUT'])
 def logoff():
     try:
         content = request.get_json()
-        _ = content['jwt']
+        token = content['jwt']
     except Exception:
         return json.dumps({"message": "error reading parameters"})
+    if not authenticator.revoke(token):
+        return Response(json.dumps({"message": "logoff failed, try again"}),
+                        status=503,
+                        mimetype='application/json')
     return {}
 
 
@@ -5,7 +5,7 @@ Sample application---music service.
 
 # Standard library modules
 import logging
-# import os
+import os
 import sys
 
 # Installed packages
@@ -13,30 +13,60 @@ from flask import Blueprint
 from flask import Flask
 from flask import request
 from flask import Response
+from flask import stream_with_context
 
-from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import Counter
+from prometheus_client import Gauge
 
-import requests
+from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import \
+    GunicornInternalPrometheusMetrics
 
 import simplejson as json
 
+# Local modules
+import auth
+import cache
+import dbclient
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+# Under gunicorn (see gunicorn.conf.py) the worker processes
+# share one set of metrics
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
 metrics.info('app_info', 'Music process')
 
-db = {
-    "name": "http://cmpt756db:30002/api/v1/datastore",
-    "endpoint": [
-        "read",
-        "write",
-        "delete"
-    ]
-}
+db = dbclient.Datastore(service='music',
+                        registry=metrics.registry,
+                        incoming_headers=dbclient.flask_request_headers)
+authenticator = auth.Authenticator(auth.UserRecords(db))
 bp = Blueprint('app', __name__)
 
+# Music records are effectively immutable once created, so reads go
+# through a per-process cache.  A delete here invalidates the entry
+# at once; other replicas see it when their entry expires.
+cache_hits = Counter('music_cache_hits', 'Song reads served from cache',
+                     ['kind'], registry=metrics.registry)
+cache_misses = Counter('music_cache_misses', 'Song reads sent to the db',
+                       registry=metrics.registry)
+cache_evictions = Counter('music_cache_evictions', 'Song cache evictions',
+                          ['reason'], registry=metrics.registry)
+song_cache = cache.LRUCache(
+    int(os.getenv('MUSIC_CACHE_SIZE', '10000')),
+    float(os.getenv('MUSIC_CACHE_TTL_SEC', '300')),
+    on_evict=lambda reason: cache_evictions.labels(reason).inc())
+# Missing ids are cached for a shorter time, so a song created
+# through another replica becomes visible quickly
+NEGATIVE_TTL_SEC = float(os.getenv('MUSIC_CACHE_NEGATIVE_TTL_SEC', '5'))
+cache_entries = Gauge('music_cache_entries', 'Songs held in the cache',
+                      registry=metrics.registry,
+                      multiprocess_mode='livesum')
+
 
 @bp.route('/health')
 @metrics.do_not_track()
@@ -54,36 +84,80 @@ def readiness():
 def list_all():
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    # list all songs here
-    return {}
+    auth = {'Authorization': headers['Authorization']}
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    # ?Artist=<name> lists only that artist's songs, read through
+    # the index on Artist rather than by scanning every song
+    artist = request.args.get('Artist')
+
+    def page(cursor):
+        if artist is not None:
+            return db.query("music", "Artist", artist, limit, cursor,
+                            headers=auth)
+        return db.scan("music", limit, cursor, headers=auth)
+
+    if request.args.get('stream', '').lower() not in ('1', 'true'):
+        response = page(cursor)
+        return Response(response.content,
+                        status=response.status_code,
+                        mimetype='application/json')
+
+    def generate(cursor):
+        # One page at a time, so only a page is ever held in memory
+        while True:
+            response = page(cursor)
+            if response.status_code != 200:
+                yield json.dumps({"error": "listing failed",
+                                  "status": response.status_code}) + '\n'
+                return
+            content = response.json()
+            for item in content['Items']:
+                yield json.dumps(item) + '\n'
+            cursor = content['Cursor']
+            if cursor is None:
+                return
+
+    return Response(stream_with_context(generate(cursor)),
+                    mimetype='application/x-ndjson')
 
 
 @bp.route('/<music_id>', methods=['GET'])
 def get_song(music_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    payload = {"objtype": "music", "objkey": music_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url,
-        params=payload,
+    hit, content = song_cache.get(music_id)
+    if hit:
+        cache_hits.labels('negative' if content['Count'] == 0
+                          else 'positive').inc()
+        return content
+    cache_misses.inc()
+    response = db.read(
+        "music",
+        music_id,
         headers={'Authorization': headers['Authorization']})
-    return (response.json())
+    content = response.json()
+    if response.status_code == 200:
+        song_cache.put(music_id,
+                       content,
+                       NEGATIVE_TTL_SEC if content['Count'] == 0 else None)
+        cache_entries.set(len(song_cache))
+    return content
 
 
 @bp.route('/', methods=['POST'])
 def create_song():
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
@@ -93,10 +167,9 @@ def create_song():
         SongTitle = content['SongTitle']
     except Exception:
         return json.dumps({"message": "error reading arguments"})
-    url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
-        url,
-        json={"objtype": "music", "Artist": Artist, "SongTitle": SongTitle},
+    response = db.write(
+        {"objtype": "music", "Artist": Artist, "SongTitle": SongTitle},
+        idempotency_key=headers.get('Idempotency-Key'),
         headers={'Authorization': headers['Authorization']})
     return (response.json())
 
@@ -105,15 +178,16 @@ def create_song():
 def delete_song(music_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    url = db['name'] + '/' + db['endpoint'][2]
-    response = requests.delete(
-        url,
-        params={"objtype": "music", "objkey": music_id},
+    response = db.delete(
+        "music",
+        music_id,
         headers={'Authorization': headers['Authorization']})
+    song_cache.invalidate(music_id)
+    cache_entries.set(len(song_cache))
     return (response.json())
 
 
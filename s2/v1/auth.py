@@ -0,0 +1,216 @@
+"""
+SFU CMPT 756
+Authorization checks shared by the user, music and playlist
+services.
+
+Each service directory holds an identical copy of this file
+because each service is built from its own directory.  Change
+all the copies together.
+"""
+
+# Standard library modules
+import collections
+import logging
+import os
+import threading
+import time
+
+# Installed packages
+import jwt
+
+# The attribute of a user record holding the time, in milliseconds
+# since the epoch, before which the user's tokens are refused
+VALID_AFTER = 'tokens_valid_after_ms'
+
+
+class UserRecords():
+    """Keeps each user's `VALID_AFTER` time on their user record,
+    through a `dbclient.Datastore`, where every process of every
+    service reads it."""
+
+    def __init__(self, datastore):
+        self._datastore = datastore
+
+    def _call(self, method, *args, **kwargs):
+        """Return (status code, decoded body) of a datastore call."""
+        response = getattr(self._datastore, method)(*args, **kwargs)
+        return response.status_code, response.json()
+
+    def valid_after(self, user_id):
+        """Return the user's `VALID_AFTER` time, 0 if they have never
+        logged off, or None if there is no such user.  Raises an
+        exception if the user could not be read."""
+        status, content = self._call('read', 'user', user_id,
+                                     fields=[VALID_AFTER], consistent=True)
+        if status != 200:
+            raise RuntimeError('user read failed: {}'.format(status))
+        if not content['Items']:
+            return None
+        return content['Items'][0].get(VALID_AFTER, 0)
+
+    def set_valid_after(self, user_id, when):
+        """Set the user's `VALID_AFTER` time; return True if it was set
+        or there is no such user."""
+        status, _ = self._call('update', 'user', user_id,
+                               {VALID_AFTER: when}, exists=True)
+        return status in (200, 404)
+
+
+class Authenticator():
+    """Issue and verify HS256 JWTs.
+
+    A token is verified locally against the shared key.  Tokens that
+    verify are remembered in a bounded LRU until they expire, so a
+    client presenting the same token again costs one dictionary
+    lookup.
+
+    Logging off revokes all of the user's tokens issued until then:
+    `revoke` sets the user's `VALID_AFTER` time in `users` (a
+    `UserRecords`), and `verify` refuses the tokens issued before it.
+    Each process looks up a user's time at most once every
+    AUTH_REVOCATION_TTL_SEC, so a revocation takes that long to reach
+    the other processes of every service.  The process that revoked
+    the tokens refuses them at once.  A token is refused if its user's
+    time cannot be read, or the user no longer exists.  Without
+    `users`, as in AUTH_MODE 'presence', nothing is revoked.  Tokens
+    carry the time they were issued, so the clocks of the user
+    service's processes are assumed to agree.
+
+    Environment variables
+    ---------------------
+    AUTH_MODE: string
+        'presence' (default) accepts any request carrying an
+        Authorization header, as the services always have.
+        'jwt' requires a valid, unrevoked 'Bearer <token>'.
+    JWT_SECRET: string
+        The HS256 key shared by all the services.
+    JWT_TTL_SEC: int
+        Lifetime of issued tokens (default 3600).
+    AUTH_CACHE_SIZE: int
+        Verified tokens, and users' `VALID_AFTER` times, remembered
+        (default 10000 each).
+    AUTH_REVOCATION_TTL_SEC: float
+        How long a user's `VALID_AFTER` time is remembered (default 5).
+    """
+
+    def __init__(self, users=None):
+        self._mode = os.getenv('AUTH_MODE', 'presence')
+        self._key = os.getenv('JWT_SECRET', 'secret')
+        self._ttl = int(os.getenv('JWT_TTL_SEC', '3600'))
+        self._size = int(os.getenv('AUTH_CACHE_SIZE', '10000'))
+        self._revocation_ttl = float(
+            os.getenv('AUTH_REVOCATION_TTL_SEC', '5'))
+        self._users = users
+        self._lock = threading.Lock()
+        # token -> (expiry time, user id, time issued in ms), oldest
+        # use first
+        self._verified = collections.OrderedDict()
+        # user id -> (time looked up, VALID_AFTER time), oldest
+        # lookup first
+        self._valid_after = collections.OrderedDict()
+
+    def issue(self, user_id):
+        now = time.time()
+        token = jwt.encode({'user_id': user_id,
+                            'time': now,
+                            'exp': int(now) + self._ttl},
+                           self._key,
+                           algorithm='HS256')
+        # PyJWT 1.x returns bytes, 2.x returns str
+        return token.decode() if isinstance(token, bytes) else token
+
+    @staticmethod
+    def _remember(table, key, value, size):
+        table[key] = value
+        table.move_to_end(key)
+        while len(table) > size:
+            table.popitem(last=False)
+
+    def _decode(self, token, now):
+        """Return (expiry time, user id, time issued in ms) of `token`,
+        or None if it does not verify."""
+        try:
+            claims = jwt.decode(token, self._key, algorithms=['HS256'])
+        except jwt.InvalidTokenError:
+            return None
+        # Tokens issued before 'exp' was added are re-verified
+        # every JWT_TTL_SEC
+        return (claims.get('exp', now + self._ttl),
+                claims.get('user_id'),
+                claims.get('time', 0) * 1000)
+
+    def _user_valid_after(self, user_id, now):
+        """Return the user's `VALID_AFTER` time, looked up at most once
+        every AUTH_REVOCATION_TTL_SEC, or None if the user does not
+        exist or could not be read."""
+        with self._lock:
+            entry = self._valid_after.get(user_id)
+            if entry is not None and entry[0] + self._revocation_ttl > now:
+                return entry[1]
+        try:
+            valid_after = self._users.valid_after(user_id)
+        except Exception as e:
+            # The cached time, even if stale, would let a revoked
+            # token through; refuse instead
+            logging.warning("token refused, user %s not read: %s",
+                            user_id, e)
+            return None
+        with self._lock:
+            self._remember(self._valid_after, user_id, (now, valid_after),
+                           self._size)
+        return valid_after
+
+    def verify(self, token):
+        """Return True if `token` is a valid, unexpired, unrevoked JWT."""
+        now = time.time()
+        with self._lock:
+            entry = self._verified.get(token)
+            if entry is not None:
+                if entry[0] > now:
+                    self._verified.move_to_end(token)
+                else:
+                    del self._verified[token]
+                    entry = None
+        if entry is None:
+            entry = self._decode(token, now)
+            if entry is None:
+                return False
+            with self._lock:
+                self._remember(self._verified, token, entry, self._size)
+        if self._users is None:
+            return True
+        _, user_id, issued = entry
+        valid_after = self._user_valid_after(user_id, now)
+        return valid_after is not None and issued > valid_after
+
+    def revoke(self, token):
+        """Refuse `token`, and every other token issued to its user
+        until now.  Return False if the revocation could not be
+        recorded; a token that does not verify needs none."""
+        now = time.time()
+        entry = self._decode(token, now)
+        if entry is None or self._users is None:
+            return True
+        user_id = entry[1]
+        # Rounded up, so no token issued by now is let through
+        valid_after = int(now * 1000) + 1
+        try:
+            if not self._users.set_valid_after(user_id, valid_after):
+                return False
+        except Exception as e:
+            logging.warning("tokens of user %s not revoked: %s", user_id, e)
+            return False
+        with self._lock:
+            self._remember(self._valid_after, user_id, (now, valid_after),
+                           self._size)
+        return True
+
+    def authorized(self, headers):
+        """Return True if the request `headers` pass the AUTH_MODE check."""
+        if 'Authorization' not in headers:
+            return False
+        if self._mode != 'jwt':
+            return True
+        parts = headers['Authorization'].split()
+        return len(parts) == 2 and parts[0] == 'Bearer' and \
+            self.verify(parts[1])
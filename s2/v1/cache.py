@@ -0,0 +1,67 @@
+"""
+SFU CMPT 756
+Bounded in-process cache for the music service.
+"""
+
+# Standard library modules
+import collections
+import threading
+import time
+
+
+class LRUCache():
+    """Thread-safe cache with LRU eviction and per-entry expiry.
+
+    Parameters
+    ----------
+    maxsize: int
+        Most entries held.  Adding to a full cache evicts the
+        least recently used entry.  A maxsize of 0 disables the
+        cache: nothing is stored and every lookup misses.
+    ttl: float
+        Default lifetime, in seconds, of an entry.
+    on_evict: function(reason)
+        Optional.  Called with 'size', 'expired' or 'invalidated'
+        whenever an entry is dropped.
+    """
+
+    def __init__(self, maxsize, ttl, on_evict=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._on_evict = on_evict or (lambda reason: None)
+        self._lock = threading.Lock()
+        # key -> (expiry time, value), oldest use first
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Return (True, value) on a hit and (False, None) on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                self._on_evict('expired')
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def put(self, key, value, ttl=None):
+        """Store `value`, living `ttl` seconds (default: the cache ttl)."""
+        if self._maxsize <= 0:
+            return
+        expiry = time.monotonic() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self._on_evict('size')
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._on_evict('invalidated')
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,159 @@
+"""
+SFU CMPT 756
+Asynchronous client for the database service, used by the
+asyncio version of the playlist service (`app_async.py`).
+
+This mirrors `dbclient.Datastore` and reads the same DB_*
+environment variables.
+"""
+
+# Standard library modules
+import asyncio
+import os
+import random
+import time
+import uuid
+
+# Installed packages
+import aiohttp
+
+from prometheus_client import Histogram
+
+import simplejson as json
+
+# Local modules
+import dbclient
+
+
+class AsyncDatastore():
+    """Pooled, keep-alive asyncio client for the database service.
+
+    All the calls of a process share one `aiohttp.ClientSession`,
+    which must be opened by `start()` inside the running event loop
+    and closed by `close()`.  Idempotent calls are retried with
+    jittered exponential backoff, as in `dbclient.Datastore`.
+
+    Every method returns a pair (status code, decoded JSON body).
+    The body is None if the response was not JSON.  Attempts are
+    timed in the same histogram as `dbclient.Datastore`'s, with the
+    trace id of the `headers` passed, if any, as an exemplar.  The
+    caller passes on its request's tracing headers (see
+    `dbclient.TRACE_HEADERS`).
+    """
+
+    def __init__(self, url=None, service=''):
+        self._url = url or os.getenv('DB_URL', dbclient.DEFAULT_URL)
+        self._service = service
+        self._duration = Histogram(
+            'db_client_request_duration_seconds',
+            'Duration of calls to the database service',
+            ['caller', 'db_endpoint', 'status'],
+            buckets=dbclient.LATENCY_BUCKETS)
+        self._pool_size = int(os.getenv('DB_POOL_SIZE', '100'))
+        self._timeout = aiohttp.ClientTimeout(
+            sock_connect=float(os.getenv('DB_CONNECT_TIMEOUT', '3.05')),
+            sock_read=float(os.getenv('DB_READ_TIMEOUT', '10')))
+        self._retries = int(os.getenv('DB_RETRIES', '2'))
+        self._backoff = float(os.getenv('DB_RETRY_BACKOFF_SEC', '0.05'))
+        self._session = None
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._pool_size),
+            timeout=self._timeout,
+            json_serialize=json.dumps)
+
+    async def close(self):
+        await self._session.close()
+
+    async def call(self, method, endpoint, idempotent, params=None,
+                   content=None, headers=None):
+        """Send a request to `endpoint`, retrying if `idempotent`."""
+        url = self._url + '/' + endpoint
+        trace_id = (headers or {}).get('x-b3-traceid')
+        exemplar = {'trace_id': trace_id} if trace_id and dbclient.EXEMPLARS \
+            else None
+        attempts = 1 + (self._retries if idempotent else 0)
+        for n in range(attempts):
+            last = n == attempts - 1
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                async with self._session.request(
+                        method, url, params=params, json=content,
+                        headers=headers) as response:
+                    status = response.status
+                    if last or response.status not in dbclient.RETRY_STATUS:
+                        text = await response.text()
+                        try:
+                            return response.status, json.loads(text)
+                        except ValueError:
+                            return response.status, None
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    raise
+            finally:
+                self.observe(endpoint, status,
+                             time.perf_counter() - start, exemplar)
+            await asyncio.sleep(random.uniform(0, self._backoff * (2 ** n)))
+
+    def observe(self, endpoint, status, seconds, exemplar):
+        histogram = self._duration.labels(self._service, endpoint, status)
+        if exemplar:
+            histogram.observe(seconds, exemplar)
+        else:
+            histogram.observe(seconds)
+
+    async def read(self, objtype, objkey, fields=None, consistent=False,
+                   headers=None):
+        params = {"objtype": objtype, "objkey": objkey}
+        if fields:
+            params['fields'] = ','.join(fields)
+        if consistent:
+            params['consistent'] = 'true'
+        return await self.call('GET', 'read', True, params=params,
+                               headers=headers)
+
+    async def write(self, obj, idempotency_key=None, headers=None):
+        headers = dict(headers or {})
+        headers['Idempotency-Key'] = idempotency_key or str(uuid.uuid4())
+        return await self.call('POST', 'write', True, content=obj,
+                               headers=headers)
+
+    async def update(self, objtype, objkey, content, expected_version=None,
+                     exists=False, headers=None):
+        params = {"objtype": objtype, "objkey": objkey}
+        if expected_version is not None:
+            params['expected_version'] = expected_version
+        if exists:
+            params['exists'] = 'true'
+        return await self.call('PUT', 'update', True,
+                               params=params,
+                               content=content,
+                               headers=headers)
+
+    async def delete(self, objtype, objkey, headers=None):
+        return await self.call('DELETE', 'delete', True,
+                               params={"objtype": objtype, "objkey": objkey},
+                               headers=headers)
+
+    async def list_append(self, objtype, objkey, attr, values, headers=None):
+        return await self.call('PUT', 'list_append', False,
+                               params={"objtype": objtype, "objkey": objkey},
+                               content={"attr": attr, "values": values},
+                               headers=headers)
+
+    async def list_remove(self, objtype, objkey, attr, value, index=None,
+                          headers=None):
+        content = {"attr": attr, "value": value}
+        if index is not None:
+            content['index'] = index
+        return await self.call('PUT', 'list_remove', False,
+                               params={"objtype": objtype, "objkey": objkey},
+                               content=content,
+                               headers=headers)
+
+    async def batch_read(self, keys, headers=None):
+        return await self.call('POST', 'batch_read', True,
+                               content={"keys": keys},
+                               headers=headers)
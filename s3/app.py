@@ -4,8 +4,9 @@ Sample application---playlist service.
 """
 
 # Standard library modules
+import concurrent.futures
 import logging
-# import os
+import os
 import sys
 
 # Installed packages
@@ -15,29 +16,157 @@ from flask import request
 from flask import Response
 
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import \
+    GunicornInternalPrometheusMetrics
 
 import requests
 
 import simplejson as json
 
+# Local modules
+import auth
+import dbclient
+import expand
+import membership
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+# Under gunicorn (see gunicorn.conf.py) the worker processes
+# share one set of metrics
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
 metrics.info('app_info', 'Playlist process')
 
-db = {
-    "name": "http://cmpt756db:30002/api/v1/datastore",
-    "endpoint": [
-        "read",
-        "write",
-        "delete",
-        "update"
-    ]
-}
+db = dbclient.Datastore(service='playlist',
+                        registry=metrics.registry,
+                        incoming_headers=dbclient.flask_request_headers)
+authenticator = auth.Authenticator(auth.UserRecords(db))
 bp = Blueprint('app', __name__)
 
+# The user attributes read when a playlist is created or deleted
+USER_FIELDS = ["playlist", "version"]
+
+# Tries of a conditional update before giving up on a user
+# that other requests keep changing
+UPDATE_ATTEMPTS = int(os.getenv('UPDATE_ATTEMPTS', '5'))
+
+# MEMBERSHIP_MODE=behind records the playlist ids added to and
+# removed from users in a local journal and updates the user
+# records in the background (see membership.py); the default,
+# 'sync', updates the user record before answering
+MEMBERSHIP_MODE = os.getenv('MEMBERSHIP_MODE', 'sync')
+MEMBERSHIP_JOURNAL_DIR = os.getenv('MEMBERSHIP_JOURNAL_DIR',
+                                   '/tmp/playlist-membership')
+MEMBERSHIP_JOURNAL_FSYNC = \
+    os.getenv('MEMBERSHIP_JOURNAL_FSYNC', 'true').lower() == 'true'
+
+membership_queue = None
+if MEMBERSHIP_MODE == 'behind':
+    membership_queue = membership.MembershipQueue(
+        db,
+        MEMBERSHIP_JOURNAL_DIR,
+        fsync=MEMBERSHIP_JOURNAL_FSYNC,
+        attempts=UPDATE_ATTEMPTS,
+        registry=metrics.registry)
+    membership_queue.start()
+
+
+def update_user_playlists(user_id, op, playlist_id, headers):
+    """
+    Add ('add') or remove ('remove') `playlist_id` in the user's list
+    of playlists, returning the status code of the last call.
+
+    The update is conditional on the version read, so concurrent
+    changes to the user are never overwritten: on a conflict the
+    change is applied to the current record and tried again.
+    """
+    response = db.read("user", user_id, fields=USER_FIELDS,
+                       consistent=True, headers=headers)
+    if response.status_code != 200:
+        return response.status_code
+    content = response.json()
+    if content['Count'] == 0:
+        return 404
+    item = content['Items'][0]
+    for _ in range(UPDATE_ATTEMPTS):
+        try:
+            playlist = membership.apply_change(item.get('playlist'), op,
+                                               playlist_id)
+        except ValueError as e:
+            logging.error("user %s not updated: %s", user_id, e)
+            return 500
+        if playlist is None:
+            return 200
+        response = db.update("user",
+                             user_id,
+                             {"playlist": playlist},
+                             expected_version=item.get('version', 0),
+                             headers=headers)
+        if response.status_code != 409:
+            return response.status_code
+        item = response.json()['Item']
+    return 409
+
+
+# Shared by all requests expanding playlists.  Each request has at
+# most EXPAND_CONCURRENCY batches on it, and it has that many threads
+# for each thread serving requests, so no request's batches wait for
+# another's.
+expand_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=expand.EXPAND_CONCURRENCY *
+    int(os.getenv('GUNICORN_THREADS', '8')))
+
+
+def map_limited(fn, items, limit):
+    '''Return [fn(item) for item in items], run on `expand_pool` with
+    at most `limit` calls in flight at once'''
+    futures = []
+    for item in items:
+        if len(futures) >= limit:
+            # Every call before this one has already finished
+            futures[-limit].result()
+        futures.append(expand_pool.submit(fn, item))
+    return [f.result() for f in futures]
+
+
+def read_songs(ids, headers):
+    '''
+    Return (a dict of the music records for `ids`, read in batches,
+    the list of ids that could not be read)
+
+    A single batch is read on the request's thread.  Several are read
+    on `expand_pool`, EXPAND_CONCURRENCY at a time.
+    '''
+    # The batches are read on the pool's threads, outside the request
+    # context, so its tracing headers are passed on explicitly
+    headers = dict(db.trace_headers(), **headers)
+
+    def read_batch(keys):
+        try:
+            response = db.batch_read(keys, headers=headers)
+        except requests.RequestException:
+            return expand.batch_result(keys, None, None)
+        return expand.batch_result(
+            keys, response.status_code,
+            response.json() if response.status_code == 200 else None)
+
+    batches = expand.batches(ids)
+    if len(batches) > 1:
+        results = map_limited(read_batch, batches, expand.EXPAND_CONCURRENCY)
+    else:
+        results = [read_batch(keys) for keys in batches]
+    songs = {}
+    unread = []
+    for items, failed in results:
+        for song in items:
+            songs[song['music_id']] = song
+        unread.extend(failed)
+    return songs, unread
+
 
 @bp.route('/health')
 @metrics.do_not_track()
@@ -55,7 +184,7 @@ def readiness():
 def create_playlist():
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
@@ -67,10 +196,9 @@ def create_playlist():
     except Exception:
         return json.dumps({"message": "error reading arguments"})
 
-    url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
-        url,
-        json={"objtype": "playlist", "title": PlaylistTitle, "songs": songs},
+    response = db.write(
+        {"objtype": "playlist", "title": PlaylistTitle, "songs": songs},
+        idempotency_key=headers.get('Idempotency-Key'),
         headers={'Authorization': headers['Authorization']})
 
     if response.status_code != 200:
@@ -79,35 +207,22 @@ def create_playlist():
 
     content = response.json()
     playlist_id = content['playlist_id']
-    url = db['name'] + '/' + db['endpoint'][0]
-    payload = {"objtype": "user", "objkey": user_id}
-    response_get = requests.get(
-        url,
-        payload,
-        headers={'Authorization': headers['Authorization']}
-    )
-
-    if response_get.status_code != 200:
-        print("Non-successful status code:", response_get.status_code)
+    # A repeated request may have stopped before the user was updated,
+    # so its user is checked directly
+    replayed = 'Idempotent-Replayed' in response.headers
+    if membership_queue and not replayed:
+        membership_queue.enqueue('add', user_id, playlist_id)
+        return content
+
+    status = update_user_playlists(
+        user_id,
+        'add',
+        playlist_id,
+        {'Authorization': headers['Authorization']})
+    if status != 200:
+        print("Non-successful status code:", status)
         return json.dumps({"message": "request not successful"})
 
-    content = response_get.json()
-    # print(content)
-    playlist = content['Items'][0]['playlist']
-    fname = content['Items'][0]['fname']
-    lname = content['Items'][0]['lname']
-    email = content['Items'][0]['email']
-    playlist.append(playlist_id)
-    url = db['name'] + '/' + db['endpoint'][3]
-    requests.put(
-        url,
-        params={"objtype": "user", "objkey": user_id},
-        json={"lname": lname,
-              "email": email,
-              "fname": fname,
-              "playlist": playlist}
-    )
-
     return (response.json())
 
 
@@ -115,141 +230,123 @@ def create_playlist():
 def add_song_to_playlist(playlist_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}), status=401,
                         mimetype='application/json')
 
     try:
         content = request.get_json()
-        title = content['title']
         music_id = content['music_id']
     except Exception:
         return json.dumps({"message": "error reading arguments"})
 
-    payload = {"objtype": "playlist", "objkey": playlist_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url,
-        params=payload,
-        headers={'Authorization': headers['Authorization']})
-    try:
-        content = response.json()
-        songs = content['Items'][0]['songs']
-    except Exception:
-        return json.dumps({"message": "error in getting existing song list"})
-
-    songs = list(songs)
-    songs.append(music_id)
-    url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
-        url,
-        params={"objtype": "playlist", "objkey": playlist_id},
-        json={"title": title, "songs": songs})
-    return (response.json())
+    auth = {'Authorization': headers['Authorization']}
+    # A single atomic append, whatever the length of the playlist
+    response = db.list_append(
+        "playlist",
+        playlist_id,
+        "songs",
+        [music_id],
+        headers=auth)
+    # The body may also give the playlist a new title, set by a
+    # separate update once the song is in
+    if response.status_code == 200 and 'title' in content:
+        response = db.update(
+            "playlist",
+            playlist_id,
+            {"title": content['title']},
+            exists=True,
+            headers=auth)
+    return Response(response.content,
+                    status=response.status_code,
+                    mimetype='application/json')
 
 
 @bp.route('/<playlist_id>/<music_id>', methods=['PUT'])
 def remove_song_from_playlist(playlist_id, music_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}), status=401,
                         mimetype='application/json')
-    try:
-        content = request.get_json()
-        title = content['title']
-        # music_id = content['music_id']
-    except Exception:
-        return json.dumps({"message": "error reading arguments"})
-
-    payload = {"objtype": "playlist", "objkey": playlist_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url,
-        params=payload,
+    # The body may give the song's position in the list, which saves
+    # the db service from looking it up
+    content = request.get_json(silent=True) or {}
+    index = content.get('index') if isinstance(content, dict) else None
+    if index is not None and not dbclient.is_list_index(index):
+        return Response(
+            json.dumps({"message": "index must be a non-negative integer"}),
+            status=400,
+            mimetype='application/json')
+    response = db.list_remove(
+        "playlist",
+        playlist_id,
+        "songs",
+        music_id,
+        index=index,
         headers={'Authorization': headers['Authorization']})
-    try:
-        content = response.json()
-        songs = content['Items'][0]['songs']
-    except Exception:
-        return json.dumps({"message": "error in getting existing song list"})
-
-    songs = list(songs)
-    songs.remove(music_id)
-    url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
-        url,
-        params={"objtype": "playlist", "objkey": playlist_id},
-        json={"title": title, "songs": songs})
-    return (response.json())
+    return Response(response.content,
+                    status=response.status_code,
+                    mimetype='application/json')
 
 
 @bp.route('/<playlist_id>', methods=['GET'])
 def get_playlist(playlist_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
-    payload = {"objtype": "playlist", "objkey": playlist_id}
-    url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
-        url,
-        params=payload,
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+    auth = {'Authorization': headers['Authorization']}
+    response = db.read(
+        "playlist",
+        playlist_id,
+        headers=auth)
+    content = response.json()
+    # ?expand=songs replaces the song ids by the songs' details
+    if request.args.get('expand') == 'songs' and \
+            response.status_code == 200 and content['Count'] > 0:
+        item = content['Items'][0]
+        ids = expand.song_ids(item.get('songs'))
+        songs, unread = read_songs(ids, auth)
+        expand.expand(item, ids, songs, unread)
+    return content
 
 
 @bp.route('/<playlist_id>', methods=['DELETE'])
 def delete_playlist(playlist_id):
     headers = request.headers
     # check header here
-    if 'Authorization' not in headers:
+    if not authenticator.authorized(headers):
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
     content = request.get_json()
     user_id = content['user_id']
 
-    url = db['name'] + '/' + db['endpoint'][2]
-    response = requests.delete(
-        url,
-        params={"objtype": "playlist", "objkey": playlist_id},
+    response = db.delete(
+        "playlist",
+        playlist_id,
         headers={'Authorization': headers['Authorization']})
 
     if response.status_code != 200:
         print("Non-successful status code:", response.status_code)
         return json.dumps({"message": "request not successful"})
 
-    url = db['name'] + '/' + db['endpoint'][0]
-    payload = {"objtype": "user", "objkey": user_id}
-    response_get = requests.get(
-        url,
-        payload,
-        headers={'Authorization': headers['Authorization']}
-    )
-
-    if response_get.status_code != 200:
-        print("Non-successful status code:", response_get.status_code)
+    if membership_queue:
+        membership_queue.enqueue('remove', user_id, playlist_id)
+        return response.json()
+
+    status = update_user_playlists(
+        user_id,
+        'remove',
+        playlist_id,
+        {'Authorization': headers['Authorization']})
+    if status != 200:
+        print("Non-successful status code:", status)
         return json.dumps({"message": "request not successful"})
 
-    content = response_get.json()
-    playlist = content['Items'][0]['playlist']
-    fname = content['Items'][0]['fname']
-    lname = content['Items'][0]['lname']
-    email = content['Items'][0]['email']
-    playlist.remove(playlist_id)
-    url = db['name'] + '/' + db['endpoint'][3]
-    requests.put(
-        url,
-        params={"objtype": "user", "objkey": user_id},
-        json={"lname": lname,
-              "email": email,
-              "fname": fname,
-              "playlist": playlist}
-    )
-
     return (response.json())
 
 
@@ -0,0 +1,369 @@
+"""
+SFU CMPT 756
+Sample application---playlist service, asyncio version.
+
+This serves the same routes as `app.py` but runs every request
+on one event loop.  A request waiting on the database service
+holds no thread, and calls that do not depend on each other,
+such as writing a playlist and reading its user, run concurrently.
+"""
+
+# Standard library modules
+import asyncio
+import logging
+import os
+import sys
+import time
+
+# Installed packages
+import aiohttp
+from aiohttp import web
+
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import Counter
+from prometheus_client import generate_latest
+from prometheus_client import Histogram
+from prometheus_client import Info
+
+import simplejson as json
+
+# Local modules
+import aiodbclient
+import auth
+import dbclient
+import expand
+import membership
+
+# The application
+
+PREFIX = '/api/v1/playlist/'
+
+# The same names as the Flask exporter's metrics, so the
+# existing dashboards cover both versions of the service
+request_duration = Histogram('flask_http_request_duration_seconds',
+                             'Flask HTTP request duration in seconds',
+                             ['method', 'path', 'status'])
+request_total = Counter('flask_http_request_total',
+                        'Total number of HTTP requests',
+                        ['method', 'status'])
+Info('app', 'Playlist process').info({})
+
+db = aiodbclient.AsyncDatastore(service='playlist')
+
+
+class LoopUserRecords(auth.UserRecords):
+    """`auth.UserRecords` for checks run on the executor's threads:
+    each call to `db` runs on the event loop, `loop`, while the
+    thread waits for it."""
+
+    loop = None
+
+    def _call(self, method, *args, **kwargs):
+        coroutine = getattr(self._datastore, method)(*args, **kwargs)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+users = LoopUserRecords(db)
+authenticator = auth.Authenticator(users)
+routes = web.RouteTableDef()
+
+# The user attributes read when a playlist is created or deleted
+USER_FIELDS = ["playlist", "version"]
+
+# Tries of a conditional update before giving up on a user
+# that other requests keep changing
+UPDATE_ATTEMPTS = int(os.getenv('UPDATE_ATTEMPTS', '5'))
+
+# Only the Flask version has the write-behind membership queue
+# (MEMBERSHIP_MODE=behind); this one always updates the user record
+# before answering
+if os.getenv('MEMBERSHIP_MODE', 'sync') != 'sync':
+    logging.warning("MEMBERSHIP_MODE is ignored by the asyncio version")
+
+
+def json_response(content, status=200):
+    return web.Response(text=json.dumps(content),
+                        status=status,
+                        content_type='application/json')
+
+
+async def authorized(headers):
+    """Run `authenticator.authorized` on the default executor, as it
+    may have to read the user's revocation time."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, authenticator.authorized, headers)
+
+
+def db_headers(headers):
+    """Return the headers of a request to pass on to the database
+    service: its Authorization and its tracing headers, so the calls
+    join the request's trace."""
+    passed = {h: headers[h] for h in dbclient.TRACE_HEADERS if h in headers}
+    passed['Authorization'] = headers['Authorization']
+    return passed
+
+
+def missing_auth():
+    return json_response({"error": "missing auth"}, status=401)
+
+
+@web.middleware
+async def track_requests(request, handler):
+    if not request.path.startswith(PREFIX) or \
+            request.path in (PREFIX + 'health', PREFIX + 'readiness'):
+        return await handler(request)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        request_duration.labels(request.method, request.path,
+                                status).observe(time.perf_counter() - start)
+        request_total.labels(request.method, status).inc()
+
+
+@routes.get('/metrics')
+async def prometheus_metrics(request):
+    return web.Response(body=generate_latest(),
+                        headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+@routes.get(PREFIX + 'health')
+async def health(request):
+    return web.Response(status=200, content_type="application/json")
+
+
+@routes.get(PREFIX + 'readiness')
+async def readiness(request):
+    return web.Response(status=200, content_type="application/json")
+
+
+async def read_json(request):
+    try:
+        return await request.json(loads=json.loads)
+    except ValueError:
+        return None
+
+
+def read_user(user_id, headers):
+    return db.read("user", user_id, fields=USER_FIELDS, consistent=True,
+                   headers=headers)
+
+
+async def update_user_playlists(user_id, op, playlist_id, user, headers):
+    """
+    Add ('add') or remove ('remove') `playlist_id` in the list of
+    playlists of the user read as `user`, a (status, content) pair
+    from `read_user`.  Returns the status code of the last call.
+
+    As in `app.py`, the update is conditional on the version read
+    and is redone on the current record after a conflict.
+    """
+    status, content = user
+    if status != 200:
+        return status
+    if content['Count'] == 0:
+        return 404
+    item = content['Items'][0]
+    for _ in range(UPDATE_ATTEMPTS):
+        try:
+            playlist = membership.apply_change(item.get('playlist'), op,
+                                               playlist_id)
+        except ValueError as e:
+            logging.error("user %s not updated: %s", user_id, e)
+            return 500
+        if playlist is None:
+            return 200
+        status, content = await db.update(
+            "user",
+            user_id,
+            {"playlist": playlist},
+            expected_version=item.get('version', 0),
+            headers=headers)
+        if status != 409:
+            return status
+        item = content['Item']
+    return 409
+
+
+@routes.post(PREFIX)
+async def create_playlist(request):
+    headers = request.headers
+    if not await authorized(headers):
+        return missing_auth()
+    try:
+        content = await read_json(request)
+        PlaylistTitle = content['title']
+        user_id = content['user_id']
+        songs = content['songs'] if 'songs' in content else []
+    except Exception:
+        return json_response({"message": "error reading arguments"})
+
+    auth = db_headers(headers)
+    # The new playlist and the user record do not depend on each
+    # other, so write the one while reading the other
+    (status, created), user = await asyncio.gather(
+        db.write({"objtype": "playlist",
+                  "title": PlaylistTitle,
+                  "songs": songs},
+                 idempotency_key=headers.get('Idempotency-Key'),
+                 headers=auth),
+        read_user(user_id, auth))
+
+    if status != 200:
+        print("Non-successful status code:", status)
+        return json_response({"message": "request not successful"})
+    status = await update_user_playlists(
+        user_id, 'add', created['playlist_id'], user, auth)
+    if status != 200:
+        print("Non-successful status code:", status)
+        return json_response({"message": "request not successful"})
+    return json_response(created)
+
+
+@routes.put(PREFIX + '{playlist_id}')
+async def add_song_to_playlist(request):
+    headers = request.headers
+    if not await authorized(headers):
+        return missing_auth()
+    try:
+        content = await read_json(request)
+        music_id = content['music_id']
+    except Exception:
+        return json_response({"message": "error reading arguments"})
+
+    auth = db_headers(headers)
+    status, result = await db.list_append(
+        "playlist",
+        request.match_info['playlist_id'],
+        "songs",
+        [music_id],
+        headers=auth)
+    # As in app.py, a title in the body is set once the song is in
+    if status == 200 and 'title' in content:
+        status, result = await db.update(
+            "playlist",
+            request.match_info['playlist_id'],
+            {"title": content['title']},
+            exists=True,
+            headers=auth)
+    return json_response(result, status=status)
+
+
+@routes.put(PREFIX + '{playlist_id}/{music_id}')
+async def remove_song_from_playlist(request):
+    headers = request.headers
+    if not await authorized(headers):
+        return missing_auth()
+    content = await read_json(request) or {}
+    index = content.get('index') if isinstance(content, dict) else None
+    if index is not None and not dbclient.is_list_index(index):
+        return json_response(
+            {"message": "index must be a non-negative integer"}, status=400)
+    status, content = await db.list_remove(
+        "playlist",
+        request.match_info['playlist_id'],
+        "songs",
+        request.match_info['music_id'],
+        index=index,
+        headers=db_headers(headers))
+    return json_response(content, status=status)
+
+
+async def read_songs(ids, headers):
+    '''Return (a dict of the music records for `ids`, read in batches,
+    the list of ids that could not be read)'''
+    limit = asyncio.Semaphore(expand.EXPAND_CONCURRENCY)
+
+    async def read_batch(keys):
+        async with limit:
+            try:
+                status, content = await db.batch_read(keys, headers=headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                status, content = None, None
+        return expand.batch_result(keys, status, content)
+
+    songs = {}
+    unread = []
+    for items, failed in await asyncio.gather(
+            *[read_batch(keys) for keys in expand.batches(ids)]):
+        for song in items:
+            songs[song['music_id']] = song
+        unread.extend(failed)
+    return songs, unread
+
+
+@routes.get(PREFIX + '{playlist_id}')
+async def get_playlist(request):
+    headers = request.headers
+    if not await authorized(headers):
+        return missing_auth()
+    auth = db_headers(headers)
+    status, content = await db.read(
+        "playlist",
+        request.match_info['playlist_id'],
+        headers=auth)
+    # ?expand=songs replaces the song ids by the songs' details
+    if request.query.get('expand') == 'songs' and \
+            status == 200 and content['Count'] > 0:
+        item = content['Items'][0]
+        ids = expand.song_ids(item.get('songs'))
+        songs, unread = await read_songs(ids, auth)
+        expand.expand(item, ids, songs, unread)
+    return json_response(content, status=status)
+
+
+@routes.delete(PREFIX + '{playlist_id}')
+async def delete_playlist(request):
+    headers = request.headers
+    if not await authorized(headers):
+        return missing_auth()
+    content = await read_json(request)
+    user_id = content['user_id']
+    playlist_id = request.match_info['playlist_id']
+
+    auth = db_headers(headers)
+    (status, deleted), user = await asyncio.gather(
+        db.delete("playlist", playlist_id, headers=auth),
+        read_user(user_id, auth))
+
+    if status != 200:
+        print("Non-successful status code:", status)
+        return json_response({"message": "request not successful"})
+    status = await update_user_playlists(
+        user_id, 'remove', playlist_id, user, auth)
+    if status != 200:
+        print("Non-successful status code:", status)
+        return json_response({"message": "request not successful"})
+    return json_response(deleted)
+
+
+async def start_db(app):
+    users.loop = asyncio.get_running_loop()
+    await db.start()
+
+
+async def close_db(app):
+    await db.close()
+
+
+def make_app():
+    app = web.Application(middlewares=[track_requests])
+    app.add_routes(routes)
+    app.on_startup.append(start_db)
+    app.on_cleanup.append(close_db)
+    return app
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        logging.error("missing port arg 1")
+        sys.exit(-1)
+
+    p = int(sys.argv[1])
+    web.run_app(make_app(), host='0.0.0.0', port=p)
@@ -0,0 +1,273 @@
+"""
+SFU CMPT 756
+Client for the database service, shared by the user, music
+and playlist services.
+
+Each service directory holds an identical copy of this file
+because each service is built from its own directory.  Change
+all the copies together.
+"""
+
+# Standard library modules
+import inspect
+import os
+import random
+import threading
+import time
+import uuid
+
+# Installed packages
+from flask import has_request_context
+from flask import request
+
+from prometheus_client import Histogram
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_URL = "http://cmpt756db:30002/api/v1/datastore"
+
+# Status codes that mean the db service (or its proxy) was briefly
+# unavailable rather than that the request itself was bad
+RETRY_STATUS = frozenset([502, 503, 504])
+
+# Finer than the default buckets at the low end, where most calls are
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Istio's tracing headers, which must be passed from each incoming
+# request to the calls it makes for the calls to join its trace
+TRACE_HEADERS = ('x-request-id', 'x-b3-traceid', 'x-b3-spanid',
+                 'x-b3-parentspanid', 'x-b3-sampled', 'x-b3-flags',
+                 'x-ot-span-context')
+
+# Older prometheus_client releases cannot attach exemplars
+EXEMPLARS = 'exemplar' in inspect.signature(Histogram.observe).parameters
+
+
+def is_list_index(index):
+    """Return True if `index`, from a JSON body, is a position in a
+    list that `Datastore.list_remove` may be given."""
+    # bool is a subclass of int, but true is not an index
+    return isinstance(index, int) and not isinstance(index, bool) and \
+        index >= 0
+
+
+def flask_request_headers():
+    """Return the headers of the Flask request being served, if any.
+
+    Pass this as the `incoming_headers` of a `Datastore` used by a
+    Flask application.
+    """
+    return request.headers if has_request_context() else None
+
+
+class Datastore():
+    """Pooled, keep-alive client for the database service.
+
+    Every call goes through one `requests.Session` per process, so
+    connections to the database service are reused rather than set
+    up for each call.  Idempotent calls are retried with jittered
+    exponential backoff on connection errors and 502/503/504.
+
+    Every method returns the `requests.Response`.
+
+    Each attempt is timed in the histogram
+    `db_client_request_duration_seconds`, labelled by the calling
+    service (`caller`), the db service endpoint (`db_endpoint`) and the
+    response `status` ('error' if there was none).  The label names
+    avoid `service` and `endpoint`, which Prometheus gives each target.
+
+    If `incoming_headers` is given, it is called for the headers of
+    the request being served, whose tracing headers are passed on;
+    the trace id is attached to the observation as an exemplar.
+
+    Environment variables
+    ---------------------
+    DB_URL: string
+        Base URL of the database service.
+    DB_POOL_SIZE: int
+        Connections kept open to the database service.  Set it
+        to at least the number of threads serving requests.
+    DB_CONNECT_TIMEOUT, DB_READ_TIMEOUT: float
+        Timeouts, in seconds, for each call.
+    DB_RETRIES: int
+        Retries after the first attempt of an idempotent call.
+    DB_RETRY_BACKOFF_SEC: float
+        Base of the backoff.  Retry n sleeps a random time
+        between 0 and DB_RETRY_BACKOFF_SEC * 2**n.
+    """
+
+    def __init__(self, url=None, service='', registry=None,
+                 incoming_headers=None):
+        self._url = url or os.getenv('DB_URL', DEFAULT_URL)
+        self._service = service
+        self._incoming_headers = incoming_headers
+        self._duration = Histogram(
+            'db_client_request_duration_seconds',
+            'Duration of calls to the database service',
+            ['caller', 'db_endpoint', 'status'],
+            buckets=LATENCY_BUCKETS,
+            registry=registry)
+        self._pool_size = int(os.getenv('DB_POOL_SIZE', '10'))
+        self._timeout = (float(os.getenv('DB_CONNECT_TIMEOUT', '3.05')),
+                         float(os.getenv('DB_READ_TIMEOUT', '10')))
+        self._retries = int(os.getenv('DB_RETRIES', '2'))
+        self._backoff = float(os.getenv('DB_RETRY_BACKOFF_SEC', '0.05'))
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def session(self):
+        """Return the Session for this process.
+
+        A forked worker must not share its parent's sockets, so
+        a new Session is built whenever the process id changes.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=self._pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._pid = pid
+        return self._session
+
+    def trace_headers(self):
+        """Return the tracing headers of the request being served."""
+        incoming = self._incoming_headers() if self._incoming_headers \
+            else None
+        if not incoming:
+            return {}
+        return {h: incoming[h] for h in TRACE_HEADERS if h in incoming}
+
+    def call(self, method, endpoint, idempotent, headers=None, **kwargs):
+        """Send a request to `endpoint`, retrying if `idempotent`."""
+        url = self._url + '/' + endpoint
+        headers = dict(self.trace_headers(), **(headers or {}))
+        trace_id = headers.get('x-b3-traceid')
+        exemplar = {'trace_id': trace_id} if trace_id and EXEMPLARS else None
+        attempts = 1 + (self._retries if idempotent else 0)
+        for n in range(attempts):
+            last = n == attempts - 1
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                response = self.session().request(
+                    method, url, timeout=self._timeout, headers=headers,
+                    **kwargs)
+                status = response.status_code
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+            else:
+                if last or response.status_code not in RETRY_STATUS:
+                    return response
+            finally:
+                self.observe(endpoint, status,
+                             time.perf_counter() - start, exemplar)
+            time.sleep(random.uniform(0, self._backoff * (2 ** n)))
+
+    def observe(self, endpoint, status, seconds, exemplar):
+        histogram = self._duration.labels(self._service, endpoint, status)
+        if exemplar:
+            histogram.observe(seconds, exemplar)
+        else:
+            histogram.observe(seconds)
+
+    def read(self, objtype, objkey, fields=None, consistent=False,
+             headers=None):
+        """Read one object, optionally only the attributes in `fields`."""
+        params = {"objtype": objtype, "objkey": objkey}
+        if fields:
+            params['fields'] = ','.join(fields)
+        if consistent:
+            params['consistent'] = 'true'
+        return self.call('GET', 'read', True, params=params, headers=headers)
+
+    def write(self, obj, idempotency_key=None, headers=None):
+        """Create `obj`.
+
+        The call carries `idempotency_key`, or a fresh one, as its
+        Idempotency-Key, so the db service creates the object once
+        however many times the call is retried.  Pass on the client's
+        Idempotency-Key to make the client's own retries safe too.
+        """
+        headers = dict(headers or {})
+        headers['Idempotency-Key'] = idempotency_key or str(uuid.uuid4())
+        return self.call('POST', 'write', True, json=obj, headers=headers)
+
+    def update(self, objtype, objkey, content, expected_version=None,
+               exists=False, return_values=None, headers=None):
+        """Set the attributes in `content`.
+
+        With `expected_version`, the update is refused with a 409,
+        whose body holds the current object in `Item`, if the object
+        is no longer at that version.  With `exists`, it is refused
+        with a 404 if the object does not exist.  `return_values`
+        ('UPDATED_NEW', for example) selects the attributes returned
+        in the response's `Attributes`.
+        """
+        params = {"objtype": objtype, "objkey": objkey}
+        if expected_version is not None:
+            params['expected_version'] = expected_version
+        if exists:
+            params['exists'] = 'true'
+        if return_values:
+            params['return_values'] = return_values
+        return self.call('PUT', 'update', True,
+                         params=params,
+                         json=content,
+                         headers=headers)
+
+    def delete(self, objtype, objkey, headers=None):
+        return self.call('DELETE', 'delete', True,
+                         params={"objtype": objtype, "objkey": objkey},
+                         headers=headers)
+
+    def list_append(self, objtype, objkey, attr, values, headers=None):
+        """Append `values` to list `attr` in one atomic update."""
+        return self.call('PUT', 'list_append', False,
+                         params={"objtype": objtype, "objkey": objkey},
+                         json={"attr": attr, "values": values},
+                         headers=headers)
+
+    def list_remove(self, objtype, objkey, attr, value, index=None,
+                    headers=None):
+        """Remove `value` (at `index`, if given) from list `attr`."""
+        content = {"attr": attr, "value": value}
+        if index is not None:
+            content['index'] = index
+        return self.call('PUT', 'list_remove', False,
+                         params={"objtype": objtype, "objkey": objkey},
+                         json=content,
+                         headers=headers)
+
+    def scan(self, objtype, limit=None, cursor=None, headers=None):
+        """Read one page of `objtype`, starting after `cursor`."""
+        params = {"objtype": objtype}
+        if limit is not None:
+            params['limit'] = limit
+        if cursor:
+            params['cursor'] = cursor
+        return self.call('GET', 'scan', True, params=params, headers=headers)
+
+    def query(self, objtype, index, value, limit=None, cursor=None,
+              headers=None):
+        """Read one page of the `objtype` objects whose `index` is `value`."""
+        params = {"objtype": objtype, "index": index, "value": value}
+        if limit is not None:
+            params['limit'] = limit
+        if cursor:
+            params['cursor'] = cursor
+        return self.call('GET', 'query', True, params=params, headers=headers)
+
+    def batch_read(self, keys, headers=None):
+        """Read a list of {"objtype", "objkey"} pairs in one call."""
+        return self.call('POST', 'batch_read', True,
+                         json={"keys": keys},
+                         headers=headers)
@@ -0,0 +1,69 @@
+"""
+SFU CMPT 756
+Helpers for returning a playlist with its songs' details,
+shared by `app.py` and `app_async.py`.
+"""
+
+# Standard library modules
+import logging
+import os
+
+# Local modules
+import idlist
+
+# Song ids per batch_read call, and batch_read calls in flight at once
+EXPAND_BATCH_SIZE = int(os.getenv('EXPAND_BATCH_SIZE', '100'))
+EXPAND_CONCURRENCY = int(os.getenv('EXPAND_CONCURRENCY', '4'))
+
+
+def song_ids(songs):
+    """
+    Return the list of song ids in a playlist's `songs` attribute
+    (see `idlist.id_list`), or an empty list if it holds anything
+    else, which is logged.
+    """
+    try:
+        return idlist.id_list(songs)
+    except ValueError as e:
+        logging.warning("songs attribute ignored: %s", e)
+        return []
+
+
+def batches(ids):
+    """Split the distinct ids, in first-seen order, into batch_read bodies."""
+    unique = list(dict.fromkeys(ids))
+    return [[{"objtype": "music", "objkey": i}
+             for i in unique[start:start + EXPAND_BATCH_SIZE]]
+            for start in range(0, len(unique), EXPAND_BATCH_SIZE)]
+
+
+def batch_result(keys, status, content):
+    """
+    Return (records, unread ids) for a batch_read of `keys` that
+    answered `status` with `content`.
+
+    The unread ids are those of a failed call and those the database
+    service left unprocessed; their songs may or may not exist.
+    """
+    if status != 200:
+        return [], [k['objkey'] for k in keys]
+    return content['Items'], [k['objkey']
+                              for k in content.get('Unprocessed', [])]
+
+
+def expand(item, ids, songs, unread=()):
+    """
+    Replace `item`'s songs by their details, in playlist order.
+
+    `songs` maps each found id to its music record and `unread` lists
+    the ids that could not be read.  Those are listed in the item's
+    `unread_songs`, and `partial` is true if there are any.  The other
+    ids, which were not found, are listed in its `missing_songs`.
+    """
+    unread = set(unread)
+    item['songs'] = [songs[i] for i in ids if i in songs]
+    item['missing_songs'] = list(dict.fromkeys(
+        i for i in ids if i not in songs and i not in unread))
+    item['unread_songs'] = list(dict.fromkeys(i for i in ids if i in unread))
+    item['partial'] = bool(unread)
+    return item
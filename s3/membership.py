@@ -0,0 +1,302 @@
+"""
+SFU CMPT 756
+Write-behind queue for the users' playlist lists.
+
+In write-behind mode the playlist service records each playlist
+added to or removed from a user in a local journal and answers
+the client at once.  A background thread applies the changes to
+the user records, coalescing all the pending changes of a user.
+"""
+
+# Standard library modules
+import collections
+import fcntl
+import glob
+import logging
+import os
+import threading
+import time
+
+# Installed packages
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import requests
+
+import simplejson as json
+
+# Local modules
+import idlist
+
+# Seconds to wait before retrying changes the db service did not take
+RETRY_DELAY_SEC = 1.0
+
+# The user attributes read to apply a change
+USER_FIELDS = ["playlist", "version"]
+
+
+def apply_change(playlist, op, playlist_id):
+    """Return the list of ids in `playlist`, a user's `playlist`
+    attribute, after adding ('add') or removing ('remove')
+    `playlist_id`, or None if the attribute already reflects the
+    change.  An attribute in the loader's string form is always
+    returned as a list.  Raises ValueError, as `idlist.id_list`, if
+    the attribute is not a list of ids, so it is never overwritten
+    blindly."""
+    ids = idlist.id_list(playlist)
+    if (playlist_id in ids) != (op == 'add'):
+        if op == 'add':
+            ids.append(playlist_id)
+        else:
+            ids.remove(playlist_id)
+    elif ids == playlist:
+        return None
+    return ids
+
+
+class MembershipQueue():
+    """Durable queue of changes to users' `playlist` attribute.
+
+    Every change is appended, as a line of JSON, to a journal file
+    owned by this process before `enqueue` returns.  The
+    journal is rewritten to hold only the unapplied changes after
+    each pass of the worker.  On startup, journals left by processes
+    that have exited (they are no longer locked) are replayed, so a
+    crash loses no change.
+
+    The worker applies the pending changes of each user together,
+    in a single update conditional on the version it read (see
+    `apply_change`), redone on the current record after a conflict.
+    The last change of each playlist id wins, so an add followed by
+    a remove of the same playlist cancel.  The update sets the
+    user's list to the ids it should hold rather than adding or
+    removing ids, so a batch retried after a failure, or replayed
+    after a crash, is applied once.
+
+    Each process has its own queue, so the add of a playlist and its
+    removal may be applied by different processes in either order.
+    The outcome does not depend on the order: after reading the user,
+    the worker reads each playlist it adds, and removes instead a
+    playlist that has been deleted.  A removal always updates the
+    user, even if the playlist is not (yet) in the list, so that an
+    add that read the playlist before its deletion conflicts, and is
+    redone on the new record.
+
+    Parameters
+    ----------
+    db: dbclient.Datastore
+        Client for the database service.
+    journal_dir: string
+        Directory holding the journals.  It must survive restarts of
+        the container (for example, a mounted volume) for the queue
+        to be durable.
+    fsync: bool
+        Whether to fsync the journal on every change.
+    attempts: int
+        Tries of a conditional update of a user before the changes
+        are put back in the queue.
+    registry: prometheus_client.CollectorRegistry
+        Where to register the queue's metrics.
+    """
+
+    def __init__(self, db, journal_dir, fsync=True, attempts=5,
+                 registry=None):
+        self._db = db
+        self._dir = journal_dir
+        self._fsync = fsync
+        self._attempts = attempts
+        self._depth = Gauge('membership_queue_depth',
+                            'Playlist membership changes not yet applied',
+                            registry=registry,
+                            multiprocess_mode='livesum')
+        self._lag = Gauge('membership_queue_lag_seconds',
+                          'Age of the oldest unapplied membership change',
+                          registry=registry,
+                          multiprocess_mode='livemax')
+        self._changes = Counter('membership_changes',
+                                'Membership changes taken off the queue',
+                                ['outcome'],
+                                registry=registry)
+        self._dropped = Counter('membership_updates_dropped',
+                                'Membership updates refused by the db service',
+                                registry=registry)
+        self._cond = threading.Condition()
+        # Entries not yet applied, oldest first
+        self._pending = collections.deque()
+        self._path = None
+        self._journal = None
+
+    def start(self):
+        """Open this process's journal, replay orphans, start the worker."""
+        os.makedirs(self._dir, exist_ok=True)
+        self._path = os.path.join(self._dir,
+                                  'membership-{}.log'.format(os.getpid()))
+        self._journal = open(self._path, 'a+')
+        fcntl.flock(self._journal, fcntl.LOCK_EX)
+        # A restarted container may reuse the pid of its previous life
+        self._journal.seek(0)
+        self._pending.extend(json.loads(line)
+                             for line in self._journal if line.strip())
+        for orphan in glob.glob(os.path.join(self._dir, 'membership-*.log')):
+            if orphan != self._path:
+                self._adopt(orphan)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _adopt(self, path):
+        """Queue the changes in the journal of a process that has exited."""
+        with open(path, 'r+') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # A live process owns it
+            entries = [json.loads(line) for line in f if line.strip()]
+            for entry in entries:
+                self.enqueue(entry['op'], entry['user_id'],
+                             entry['playlist_id'], entry['time'])
+            os.remove(path)
+
+    def enqueue(self, op, user_id, playlist_id, when=None):
+        """Record that `playlist_id` was added to ('add') or removed
+        from ('remove') the playlists of `user_id`."""
+        entry = {"op": op,
+                 "user_id": user_id,
+                 "playlist_id": playlist_id,
+                 "time": when or time.time()}
+        with self._cond:
+            self._journal.write(json.dumps(entry) + '\n')
+            self._journal.flush()
+            if self._fsync:
+                os.fsync(self._journal.fileno())
+            self._pending.append(entry)
+            self._report()
+            self._cond.notify()
+
+    def _rewrite(self):
+        """Replace the journal by one holding only the pending changes;
+        the caller holds the lock."""
+        tmp = self._path + '.tmp'
+        journal = open(tmp, 'w')
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        for entry in self._pending:
+            journal.write(json.dumps(entry) + '\n')
+        journal.flush()
+        if self._fsync:
+            os.fsync(journal.fileno())
+        os.replace(tmp, self._path)
+        self._journal.close()
+        self._journal = journal
+
+    def _report(self):
+        """Update the gauges; the caller holds the lock."""
+        self._depth.set(len(self._pending))
+        self._lag.set(time.time() - self._pending[0]['time']
+                      if self._pending else 0.0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Wake up now and then to keep the lag gauge current
+                while not self._pending:
+                    self._cond.wait(RETRY_DELAY_SEC)
+                    self._report()
+                batch = list(self._pending)
+            failed = self._apply(batch)
+            with self._cond:
+                for _ in batch:
+                    self._pending.popleft()
+                self._pending.extendleft(reversed(failed))
+                self._rewrite()
+                self._report()
+            self._changes.labels('retried').inc(len(failed))
+            if failed:
+                time.sleep(RETRY_DELAY_SEC)
+
+    def _apply(self, batch):
+        """Apply `batch`, returning the entries to retry."""
+        by_user = collections.OrderedDict()
+        for entry in batch:
+            by_user.setdefault(entry['user_id'], []).append(entry)
+        failed = []
+        for user_id, entries in by_user.items():
+            if not self._apply_user(user_id, entries):
+                failed.extend(entries)
+        self._changes.labels('applied').inc(len(batch) - len(failed))
+        return failed
+
+    def _apply_user(self, user_id, entries):
+        """Apply the changes of `user_id` in one versioned update,
+        returning False if they should be retried later."""
+        # The last change of each playlist id decides whether the
+        # user has it, so applying the changes again does nothing
+        changes = collections.OrderedDict()
+        for entry in entries:
+            changes.pop(entry['playlist_id'], None)
+            changes[entry['playlist_id']] = entry['op']
+        try:
+            response = self._db.read("user", user_id, fields=USER_FIELDS,
+                                     consistent=True)
+            if response.status_code != 200:
+                return self._done(response, user_id)
+            content = response.json()
+            if content['Count'] == 0:
+                self._drop(user_id, "no such user")
+                return True
+            item = content['Items'][0]
+            for _ in range(self._attempts):
+                # Read after the user, so that a playlist deleted
+                # before this update lands is seen as removed
+                ops = collections.OrderedDict()
+                for playlist_id, op in changes.items():
+                    if op == 'add' and not self._exists(playlist_id):
+                        op = 'remove'
+                    ops[playlist_id] = op
+                try:
+                    playlist = item.get('playlist')
+                    for playlist_id, op in ops.items():
+                        changed = apply_change(playlist, op, playlist_id)
+                        if changed is not None:
+                            playlist = changed
+                except ValueError as e:
+                    self._drop(user_id, e)
+                    return True
+                if playlist is item.get('playlist'):
+                    if 'remove' not in ops.values():
+                        return True
+                    # Written anyway, to change the version: an add
+                    # of the playlist read before its deletion then
+                    # conflicts, and is redone
+                    playlist = idlist.id_list(playlist)
+                response = self._db.update(
+                    "user", user_id, {"playlist": playlist},
+                    expected_version=item.get('version', 0))
+                if response.status_code != 409:
+                    return self._done(response, user_id)
+                item = response.json()['Item']
+        except requests.RequestException as e:
+            logging.warning("membership update for %s failed: %s",
+                            user_id, e)
+            return False
+        # Other requests keep changing the user; try again later
+        return False
+
+    def _exists(self, playlist_id):
+        """Return True if the playlist exists.  Raises
+        requests.HTTPError if it could not be read."""
+        response = self._db.read("playlist", playlist_id,
+                                 fields=["playlist_id"], consistent=True)
+        response.raise_for_status()
+        return response.json()['Count'] > 0
+
+    def _done(self, response, user_id):
+        """Return False if the call should be retried later."""
+        if response.status_code >= 500:
+            return False
+        if response.status_code != 200:
+            # The user is gone; retrying cannot help
+            self._drop(user_id, response.text)
+        return True
+
+    def _drop(self, user_id, reason):
+        logging.warning("membership update for %s dropped: %s",
+                        user_id, reason)
+        self._dropped.inc()